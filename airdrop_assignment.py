@@ -0,0 +1,97 @@
+import hashlib
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Any, Callable, Container, Dict, List, Optional, Sequence, Tuple
+
+LEVELS = ["легкий", "средний", "сложный"]
+MAX_DAILY_LIMIT = 5
+SUSPICIOUS_SHARE = 0.3  # Доля слотов, в которых подозрительный аккаунт все же получает airdrop
+
+
+# Ключ слота: дата и время рассылки (как в pending_airdrops.slot)
+def slot_key(day: date, slot: str) -> str:
+    return f"{day:%Y-%m-%d} {slot}"
+
+
+# Параметр deep link слота: drop_20261019_100000 (t.me/<bot>?start=drop_...)
+def slot_payload(day: date, slot: str) -> str:
+    return f"drop_{day:%Y%m%d}_{slot.replace(':', '')}"
+
+
+def parse_slot_payload(payload: Optional[str]) -> Optional[Tuple[date, str]]:
+    match = re.fullmatch(r"drop_(\d{8})_(\d{6})", payload or "")
+    if match is None:
+        return None
+    try:
+        day = datetime.strptime(match[1], "%Y%m%d").date()
+        at = datetime.strptime(match[2], "%H%M%S").time()
+    except ValueError:
+        return None
+    return day, at.strftime("%H:%M:%S")
+
+
+# Детерминированная выдача airdrop: дневной лимит, уровень и вопрос для (user_id, дата, слот)
+# вычисляются из ключевого хеша. Рассылке не нужно ничего записывать по пользователям,
+# а /claim пересчитывает ту же выдачу по требованию.
+class HashedAssigner:
+    def __init__(self, secret: bytes, slot_times: Sequence[str] = ()):
+        self.secret = secret
+        self.set_slots(slot_times)
+
+    # slot_times - время слотов за день ("10:00:00"); номер слота по порядку ограничивается дневным лимитом
+    def set_slots(self, slot_times: Sequence[str]):
+        self.slot_times = sorted(slot_times)
+        self._slot_index = {slot: index for index, slot in enumerate(self.slot_times)}
+
+    # Равномерное число из [0, 1), зависящее только от ключа и частей
+    def _unit(self, *parts) -> float:
+        digest = hashlib.blake2b("\x1f".join(map(str, parts)).encode("utf-8"),
+                                 key=self.secret, digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64
+
+    def daily_limit(self, user_id: int, day: date) -> int:
+        return 1 + int(self._unit("limit", user_id, day) * MAX_DAILY_LIMIT)
+
+    # Номер airdrop пользователя за день (с 1) или None, если в этом слоте он ничего не получает
+    def airdrop_number(self, user_id: int, day: date, slot: str, is_suspicious: bool = False) -> Optional[int]:
+        index = self._slot_index.get(slot)
+        if index is None or index >= self.daily_limit(user_id, day):
+            return None
+        if is_suspicious and self._unit("suspicious", user_id, day, slot) >= SUSPICIOUS_SHARE:
+            return None
+        return index + 1
+
+    def level(self, user_id: int, day: date, slot: str) -> str:
+        return LEVELS[int(self._unit("level", user_id, day, slot) * len(LEVELS))]
+
+    # Вопрос уровня: стартовая позиция из хеша, дальше - первый неотвеченный по кругу.
+    # answered - индексы отвеченных задач в каталоге, first - индекс первой задачи уровня
+    def task(self, user_id: int, day: date, slot: str, tasks: Sequence[Dict[str, Any]],
+             answered: Container[int] = frozenset(), first: int = 0) -> Optional[Dict[str, Any]]:
+        if not tasks:
+            return None
+        start = int(self._unit("task", user_id, day, slot) * len(tasks))
+        for offset in range(len(tasks)):
+            position = (start + offset) % len(tasks)
+            if first + position not in answered:
+                return tasks[position]
+        return tasks[start]
+
+    # Слоты, airdrop которых еще можно забрать в момент now (не старше ttl_minutes), от старых к новым.
+    # delivery(day, slot) - момент доставки пользователю, если слот сдвинут часовым поясом или волной.
+    def open_slots(self, now: datetime, ttl_minutes: int,
+                   delivery: Optional[Callable[[date, str], datetime]] = None) -> List[Tuple[date, str]]:
+        earliest = now - timedelta(minutes=ttl_minutes)
+        delivery = delivery or (lambda day, slot: datetime.combine(day, time.fromisoformat(slot)))
+        slots = []
+        for day in (now.date() - timedelta(days=1), now.date(), now.date() + timedelta(days=1)):
+            for slot in self.slot_times:
+                at = delivery(day, slot)
+                if earliest < at <= now:
+                    slots.append((at, day, slot))
+        return [(day, slot) for at, day, slot in sorted(slots)]
+
+
+# Капча: у подозрительных всегда, у остальных - на каждом третьем airdrop за день
+def requires_captcha(number: int, is_suspicious: bool) -> bool:
+    return is_suspicious or number % 3 == 0
@@ -0,0 +1,157 @@
+import logging
+import select
+import socket
+import threading
+from datetime import date, datetime, time, timedelta
+from typing import Any, Callable, Hashable, Iterable, List, Optional, Set, Tuple
+
+import psycopg2
+import schedule
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_CHANNEL = "airdrop_schedule"
+# Полезная нагрузка NOTIFY от останавливающегося экземпляра: есть приостановленные рассылки
+RESUME_PAYLOAD = "resume"
+# Пользователь задал новый часовой пояс: расписание перечитывается вместе с поясами
+TIMEZONE_PAYLOAD = "timezone"
+RECONNECT_SECONDS = 5.0
+
+
+# Планировщик слотов airdrop: спит ровно до ближайшего слота или периодической задачи schedule
+# и просыпается раньше по NOTIFY из триггера на airdrop_schedule, перечитывая расписание.
+# Слоты, пропущенные не больше чем на catchup_minutes (перезапуск, скачок часов вперед),
+# запускаются с опозданием; защита от повторного запуска - на стороне fire (airdrop_runs).
+# NOTIFY с RESUME_PAYLOAD сбрасывает отметки о запуске: слоты окна догоняния запускаются снова,
+# и fire продолжает приостановленные другим экземпляром рассылки.
+# expand(day, slot) делит слот на части со своими моментами запуска [(момент, часть)],
+# fire вызывается для каждой части отдельно; по умолчанию часть одна (None) во время слота.
+# Без connect (хранилище без LISTEN/NOTIFY, один экземпляр) планировщик будится только notify().
+class SlotScheduler:
+    def __init__(self, connect: Optional[Callable], load_slots: Callable[[], List[str]],
+                 fire: Callable[[date, str, Any], None], catchup_minutes: int = 30,
+                 periodic: schedule.Scheduler = schedule.default_scheduler,
+                 expand: Optional[Callable[[date, str], Iterable[Tuple[datetime, Hashable]]]] = None):
+        self._connect = connect
+        self._load_slots = load_slots
+        self._fire = fire
+        self._expand = expand or (lambda day, slot: [(datetime.combine(day, time.fromisoformat(slot)), None)])
+        self.catchup = timedelta(minutes=catchup_minutes)
+        self.periodic = periodic
+        self.slot_times: List[str] = []
+        self._fired: Set[Tuple[date, str, Hashable]] = set()
+        self._listen_conn = None
+        self._stopped = threading.Event()
+        # Пробуждение из stop() и notify(): ожидание в select не дожидается таймаута
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._local_payloads: Set[str] = set()
+        self._local_lock = threading.Lock()
+
+    def reload(self):
+        self.slot_times = sorted(set(self._load_slots()))
+        logger.info("Расписание airdrop: %s", ", ".join(self.slot_times) or "пусто")
+
+    # Дни слотов вокруг now: день слота может отличаться от дня сервера (часовые пояса в expand)
+    def _slots_around(self, now: datetime):
+        for day in (now.date() - timedelta(days=1), now.date(), now.date() + timedelta(days=1)):
+            for slot in self.slot_times:
+                for at, part in self._expand(day, slot):
+                    yield at, day, slot, part
+
+    # Части слотов, время которых наступило (не раньше окна догоняния) и которые еще не запускались здесь
+    def due_slots(self, now: datetime) -> List[Tuple[datetime, date, str, Hashable]]:
+        earliest = now - self.catchup
+        return sorted((entry for entry in self._slots_around(now)
+                       if earliest < entry[0] <= now and entry[1:] not in self._fired),
+                      key=lambda entry: entry[0])
+
+    def next_fire(self, now: datetime) -> Optional[datetime]:
+        return min((at for at, day, slot, part in self._slots_around(now) if at > now), default=None)
+
+    def _fire_due(self):
+        now = datetime.now()
+        for at, day, slot, part in self.due_slots(now):
+            self._fired.add((day, slot, part))
+            late = (now - at).total_seconds()
+            if late > 1:
+                logger.warning("Слот %s %s%s запущен с опозданием %.0f с", day, slot,
+                               "" if part is None else f" {part}", late)
+            try:
+                self._fire(day, slot, part)
+            except Exception as e:
+                logger.error("Ошибка при запуске слота %s %s: %s", day, slot, e)
+        # Старые отметки больше не попадут в окно догоняния
+        self._fired = {entry for entry in self._fired if entry[0] >= now.date() - timedelta(days=2)}
+
+    def _timeout(self) -> float:
+        now = datetime.now()
+        candidates = []
+        next_slot = self.next_fire(now)
+        if next_slot is not None:
+            candidates.append((next_slot - now).total_seconds())
+        idle = self.periodic.idle_seconds
+        if idle is not None:
+            candidates.append(idle)
+        return max(0.0, min(candidates)) if candidates else 60.0
+
+    def _listen(self):
+        if self._connect is None:
+            return None
+        if self._listen_conn is None or self._listen_conn.closed:
+            reconnect = self._listen_conn is not None
+            self._listen_conn = self._connect()
+            self._listen_conn.autocommit = True
+            with self._listen_conn.cursor() as cur:
+                cur.execute(f"LISTEN {SCHEDULE_CHANNEL};")
+            # Изменения, сделанные пока соединения не было, не придут уведомлением
+            if reconnect:
+                self.reload()
+        return self._listen_conn
+
+    # Уведомление в этом же процессе, как NOTIFY с payload
+    def notify(self, payload: str):
+        with self._local_lock:
+            self._local_payloads.add(payload)
+        self._wakeup_write.send(b"\0")
+
+    def _handle(self, payloads: Set[str]):
+        if RESUME_PAYLOAD in payloads:
+            self._fired.clear()
+        if payloads - {RESUME_PAYLOAD}:
+            self.reload()
+
+    # Ожидание до timeout секунд или до NOTIFY об изменении расписания
+    def _wait(self, timeout: float):
+        try:
+            conn = self._listen()
+            waiting = [self._wakeup_read] if conn is None else [conn, self._wakeup_read]
+            readable, _, _ = select.select(waiting, [], [], timeout)
+            payloads = set()
+            if self._wakeup_read in readable:
+                self._wakeup_read.recv(4096)
+                with self._local_lock:
+                    payloads, self._local_payloads = self._local_payloads, set()
+            if conn is not None and conn in readable:
+                conn.poll()
+                payloads.update(notify.payload for notify in conn.notifies)
+                conn.notifies.clear()
+            if payloads:
+                self._handle(payloads)
+        except (psycopg2.Error, OSError) as e:
+            logger.error("Ошибка соединения LISTEN: %s", e)
+            if self._listen_conn is not None:
+                self._listen_conn.close()
+            self._stopped.wait(min(timeout, RECONNECT_SECONDS))
+
+    def run_forever(self):
+        self.reload()
+        while not self._stopped.is_set():
+            self._fire_due()
+            self.periodic.run_pending()
+            self._wait(self._timeout())
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup_write.send(b"\0")
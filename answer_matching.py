@@ -0,0 +1,123 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+# Все, что не буква и не цифра (пунктуация, дефисы, кавычки, подчеркивание), - разделитель слов
+SEPARATORS = re.compile(r"[\W_]+")
+
+# Числительные: единицы и десятки складываются, сотни тоже (у русских - отдельные слова),
+# hundred/тысяча/миллион умножают накопленное
+NUMBER_WORDS = {
+    "ноль": 0, "нуль": 0, "zero": 0,
+    "один": 1, "одна": 1, "одно": 1, "one": 1,
+    "два": 2, "две": 2, "two": 2,
+    "три": 3, "three": 3,
+    "четыре": 4, "four": 4,
+    "пять": 5, "five": 5,
+    "шесть": 6, "six": 6,
+    "семь": 7, "seven": 7,
+    "восемь": 8, "eight": 8,
+    "девять": 9, "nine": 9,
+    "десять": 10, "ten": 10,
+    "одиннадцать": 11, "eleven": 11,
+    "двенадцать": 12, "twelve": 12,
+    "тринадцать": 13, "thirteen": 13,
+    "четырнадцать": 14, "fourteen": 14,
+    "пятнадцать": 15, "fifteen": 15,
+    "шестнадцать": 16, "sixteen": 16,
+    "семнадцать": 17, "seventeen": 17,
+    "восемнадцать": 18, "eighteen": 18,
+    "девятнадцать": 19, "nineteen": 19,
+    "двадцать": 20, "twenty": 20,
+    "тридцать": 30, "thirty": 30,
+    "сорок": 40, "forty": 40,
+    "пятьдесят": 50, "fifty": 50,
+    "шестьдесят": 60, "sixty": 60,
+    "семьдесят": 70, "seventy": 70,
+    "восемьдесят": 80, "eighty": 80,
+    "девяносто": 90, "ninety": 90,
+    "сто": 100, "двести": 200, "триста": 300, "четыреста": 400, "пятьсот": 500,
+    "шестьсот": 600, "семьсот": 700, "восемьсот": 800, "девятьсот": 900,
+}
+NUMBER_SCALES = {
+    "hundred": 100,
+    "тысяча": 1000, "тысячи": 1000, "тысяч": 1000, "thousand": 1000,
+    "миллион": 10 ** 6, "миллиона": 10 ** 6, "миллионов": 10 ** 6, "million": 10 ** 6,
+}
+# "one hundred and sixteen": and внутри числа пропускается
+NUMBER_JOINERS = {"and"}
+
+
+# Можно ли дописать числительное value к накопленному current: "сорок" + "шесть" - да, "два" + "три" - нет
+def continues_number(current: int, value: int) -> bool:
+    if value < 10:
+        return current % 10 == 0
+    if value < 100:
+        return current % 100 == 0
+    return current == 0
+
+
+# Подряд идущие числительные - одно число цифрами: "сто шестнадцать" -> "116", "forty-six" -> "46";
+# числительные, которые не складываются в одно число ("два три"), остаются отдельными числами
+def fold_numbers(words: List[str]) -> List[str]:
+    folded = []
+    total = current = 0
+    in_number = False
+    for i, word in enumerate(words):
+        value = NUMBER_WORDS.get(word)
+        scale = NUMBER_SCALES.get(word)
+        if value is not None:
+            if in_number and not continues_number(current, value):
+                folded.append(str(total + current))
+                total = current = 0
+            current += value
+            in_number = True
+        elif scale is not None and (in_number or scale > 100):
+            current = (current or 1) * scale
+            if scale > 100:
+                total += current
+                current = 0
+            in_number = True
+        elif word in NUMBER_JOINERS and in_number and i + 1 < len(words) and words[i + 1] in NUMBER_WORDS:
+            continue
+        else:
+            if in_number:
+                folded.append(str(total + current))
+                total = current = 0
+                in_number = False
+            folded.append(word)
+    if in_number:
+        folded.append(str(total + current))
+    return folded
+
+
+# Ключ сравнения ответа: регистр (casefold), ё -> е, пунктуация и пробелы схлопнуты в один пробел,
+# числительные словами заменены цифрами. "  Улан-Батор! " -> "улан батор", "Сорок шесть" -> "46"
+def normalize_answer(text: str) -> str:
+    words = SEPARATORS.sub(" ", text.casefold().replace("ё", "е")).split()
+    return " ".join(fold_numbers(words))
+
+
+# Допустимые ответы задачи: answer и необязательный список aliases
+def accepted_answers(task: Dict[str, Any]) -> List[str]:
+    answers = [str(task["answer"])] if "answer" in task else []
+    return answers + [str(alias) for alias in task.get("aliases") or []]
+
+
+# Проверка ответов: допустимые ключи (answer и необязательный список aliases задачи) нормализуются
+# один раз при загрузке задач, проверка ответа - нормализация и одна выборка из множества
+# по ключу (уровень, вопрос, нормализованный ответ).
+class AnswerMatcher:
+    def __init__(self, tasks: Dict[str, Iterable[Dict[str, Any]]]):
+        self._accepted = set()
+        for level, level_tasks in tasks.items():
+            for task in level_tasks:
+                for answer in accepted_answers(task):
+                    key = normalize_answer(answer)
+                    if key:
+                        self._accepted.add((level, task["question"], key))
+
+    def __len__(self) -> int:
+        return len(self._accepted)
+
+    def matches(self, level: str, question: str, answer: Optional[str]) -> bool:
+        return answer is not None and (level, question, normalize_answer(answer)) in self._accepted
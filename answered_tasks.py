@@ -0,0 +1,168 @@
+import random
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+SPARSE = 0
+DENSE = 1
+# Попыток случайной позиции до перебора по кругу: при немногих отвеченных выбор почти равномерный
+RANDOM_PROBES = 8
+
+
+# Отпечаток каталога: индексы задач действительны, пока не изменились уровни, вопросы и их порядок
+def catalog_fingerprint(keys: Iterable[Tuple[str, str]]) -> int:
+    crc = 0
+    for level, question in keys:
+        crc = zlib.crc32(f"{level}\0{question}\n".encode("utf-8"), crc)
+    return crc
+
+
+# Отвеченные задачи одного пользователя по индексу задачи в каталоге.
+# Пока их мало - отсортированный массив индексов (4 байта на задачу), когда больше 1/32 каталога -
+# битовая карта (бит на задачу каталога). Проверка - бисекция или битовая операция, без строк.
+class TaskSet:
+    __slots__ = ("_ids", "_bits")
+
+    def __init__(self):
+        self._ids = array("I")
+        self._bits: Optional[bytearray] = None
+
+    def __contains__(self, task_id: int) -> bool:
+        if self._bits is not None:
+            byte = task_id >> 3
+            return byte < len(self._bits) and (self._bits[byte] >> (task_id & 7)) & 1 == 1
+        position = bisect_left(self._ids, task_id)
+        return position < len(self._ids) and self._ids[position] == task_id
+
+    # size - число задач каталога; True, если задачи еще не было
+    def add(self, task_id: int, size: int) -> bool:
+        if self._bits is not None:
+            byte = task_id >> 3
+            if byte >= len(self._bits):
+                self._bits.extend(bytes(byte + 1 - len(self._bits)))
+            mask = 1 << (task_id & 7)
+            if self._bits[byte] & mask:
+                return False
+            self._bits[byte] |= mask
+            return True
+        position = bisect_left(self._ids, task_id)
+        if position < len(self._ids) and self._ids[position] == task_id:
+            return False
+        self._ids.insert(position, task_id)
+        if len(self._ids) * 32 > size:
+            self._bits = bytearray((size + 7) // 8)
+            for known in self._ids:
+                self._bits[known >> 3] |= 1 << (known & 7)
+            self._ids = array("I")
+        return True
+
+    def task_ids(self) -> List[int]:
+        if self._bits is None:
+            return list(self._ids)
+        return [byte * 8 + bit for byte, value in enumerate(self._bits) if value
+                for bit in range(8) if (value >> bit) & 1]
+
+    # Первая неотвеченная позиция среди count задач уровня, начинающегося с индекса first:
+    # несколько случайных позиций, затем перебор по кругу. None - отвечено все
+    def pick(self, first: int, count: int, rng=random) -> Optional[int]:
+        if count <= 0:
+            return None
+        for _ in range(RANDOM_PROBES):
+            position = rng.randrange(count)
+            if first + position not in self:
+                return position
+        start = rng.randrange(count)
+        for offset in range(count):
+            position = (start + offset) % count
+            if first + position not in self:
+                return position
+        return None
+
+    # Сериализация для bytea: байт вида, затем индексы uint32 little-endian или битовая карта
+    def encode(self) -> bytes:
+        if self._bits is not None:
+            return bytes([DENSE]) + self._bits
+        ids = array("I", self._ids)
+        if sys.byteorder == "big":
+            ids.byteswap()
+        return bytes([SPARSE]) + ids.tobytes()
+
+    @classmethod
+    def decode(cls, data: bytes) -> "TaskSet":
+        task_set = cls()
+        if data[0] == DENSE:
+            task_set._bits = bytearray(data[1:])
+        else:
+            task_set._ids.frombytes(bytes(data[1:]))
+            if sys.byteorder == "big":
+                task_set._ids.byteswap()
+        return task_set
+
+    def memory_bytes(self) -> int:
+        return len(self._bits) if self._bits is not None else self._ids.itemsize * len(self._ids)
+
+
+EMPTY = TaskSet()
+
+
+# Отвеченные задачи всех пользователей в памяти: строятся один раз из истории ответов,
+# дополняются на каждом ответе и сохраняются пачками измененных (take_dirty)
+class AnsweredTasks:
+    def __init__(self, size: int):
+        self.size = size
+        self._users: Dict[int, TaskSet] = {}
+        self._dirty: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    # Только для чтения; у пользователя без ответов - общий пустой набор
+    def get(self, user_id: int) -> TaskSet:
+        return self._users.get(user_id, EMPTY)
+
+    def add(self, user_id: int, task_id: int):
+        with self._lock:
+            task_set = self._users.get(user_id)
+            if task_set is None:
+                task_set = self._users[user_id] = TaskSet()
+            if task_set.add(task_id, self.size):
+                self._dirty.add(user_id)
+
+    # Сохраненные наборы (user_id, encode()); объединяются с тем, что уже есть в памяти
+    def merge(self, rows: Iterable[Tuple[int, bytes]]):
+        with self._lock:
+            for user_id, data in rows:
+                loaded = TaskSet.decode(data)
+                task_set = self._users.get(user_id)
+                if task_set is None:
+                    self._users[user_id] = loaded
+                    continue
+                for task_id in loaded.task_ids():
+                    if task_set.add(task_id, self.size):
+                        self._dirty.add(user_id)
+
+    # Наборы, которые не удалось сохранить, сохраняются при следующей попытке
+    def requeue(self, user_ids: Iterable[int]):
+        with self._lock:
+            self._dirty.update(user_id for user_id in user_ids if user_id in self._users)
+
+    # Пользователи с несохраненными изменениями, по возрастанию user_id
+    def dirty_users(self) -> List[int]:
+        with self._lock:
+            return sorted(self._dirty)
+
+    # Наборы (user_id, encode()) измененных пользователей; user_ids - только из этих пользователей,
+    # остальные изменения ждут следующего сохранения
+    def take_dirty(self, user_ids: Optional[Iterable[int]] = None) -> List[Tuple[int, bytes]]:
+        with self._lock:
+            taken = set(self._dirty) if user_ids is None else self._dirty.intersection(user_ids)
+            rows = [(user_id, self._users[user_id].encode()) for user_id in taken]
+            self._dirty -= taken
+        return rows
+
+    def memory_bytes(self) -> int:
+        return sum(task_set.memory_bytes() for task_set in list(self._users.values()))
@@ -0,0 +1,468 @@
+# Сквозной бенчмарк бота: локальная заглушка Bot API + отдельная база с синтетическими пользователями.
+# Запуск из корня репозитория: python -m bench.e2e_bench --users 1000 --output bench_output.json
+# База BENCH_DB_NAME (по умолчанию airdrop_bench) полностью пересоздается при каждом запуске.
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from bench.fake_bot_api import FakeBotApi
+from delivery_windows import DeliveryWindows
+from metrics import DB_QUERY_SECONDS
+from session_journal import SessionJournal
+
+SCHEMA_FILE = "SQL code1.txt"
+LEVELS = ["легкий", "средний", "сложный"]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# Рабочая часть SQL code1.txt: все, что идет до служебных DROP/SELECT
+def load_schema() -> str:
+    with open(SCHEMA_FILE, "r", encoding="utf-8") as f:
+        text = f.read()
+    return text.split("\nDROP TABLE", 1)[0]
+
+
+def connect(dbname: str):
+    return psycopg2.connect(
+        dbname=dbname,
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASSWORD", "123"),
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+    )
+
+
+def seed_database(conn, tasks, users: int, history: int, dormant_percent: float, rng: random.Random):
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+        cur.execute(load_schema())
+
+        user_rows = []
+        for user_id in range(1, users + 1):
+            language_code = "en" if user_id % 5 == 0 else "ru"
+            user_rows.append((
+                user_id, f"user{user_id}", f"User{user_id}", None, rng.randint(0, 100),
+                False, json.dumps({"language_code": language_code, "is_bot": False, "client_type": "desktop"}),
+                False,
+            ))
+        execute_values(cur, """
+            INSERT INTO users (user_id, username, first_name, last_name, balance,
+                               require_captcha, device_fingerprint, is_suspicious)
+            VALUES %s;
+        """, user_rows, page_size=1000)
+
+        # Часть пользователей давно не заходила в бота
+        cur.execute("""
+            UPDATE users SET last_seen = CURRENT_TIMESTAMP - INTERVAL '90 days'
+            WHERE user_id %% 100 < %s;
+        """, (dormant_percent,))
+
+        answer_rows = []
+        for user_id in range(1, users + 1):
+            for _ in range(history):
+                level = rng.choice(LEVELS)
+                if not tasks.get(level):
+                    continue
+                task = rng.choice(tasks[level])
+                is_correct = rng.random() < 0.6
+                answer_rows.append((user_id, task["question"], task["answer"] if is_correct else "x",
+                                    is_correct, level))
+            if len(answer_rows) >= 10000:
+                execute_values(cur, """
+                    INSERT INTO user_answers (user_id, question, answer, is_correct, level) VALUES %s;
+                """, answer_rows, page_size=1000)
+                answer_rows = []
+        if answer_rows:
+            execute_values(cur, """
+                INSERT INTO user_answers (user_id, question, answer, is_correct, level) VALUES %s;
+            """, answer_rows, page_size=1000)
+    conn.commit()
+
+
+def make_message(types, user_id: int, text: str, message_id: int):
+    return types.Message.de_json({
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                 "language_code": "en" if user_id % 5 == 0 else "ru"},
+        "text": text,
+    })
+
+
+class Bench:
+    def __init__(self, bot_module, api: FakeBotApi):
+        self.bot = bot_module
+        self.api = api
+        self.message_id = 0
+
+    def db_round_trips(self) -> int:
+        return sum(count for count, _ in DB_QUERY_SECONDS.snapshot().values())
+
+    def db_seconds(self) -> float:
+        return sum(total for _, total in DB_QUERY_SECONDS.snapshot().values())
+
+    def _result(self, operations, elapsed, latencies, db_before, api_before):
+        db_trips = self.db_round_trips() - db_before
+        return {
+            "operations": operations,
+            "duration_s": round(elapsed, 4),
+            "throughput_ops": round(operations / elapsed, 2) if elapsed > 0 else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "db_round_trips": db_trips,
+            "db_round_trips_per_op": round(db_trips / operations, 2) if operations else 0.0,
+            "api_calls": self.api.total_calls() - api_before,
+        }
+
+    # Последовательная обработка сообщений через основной обработчик бота
+    def drive(self, messages):
+        from telebot import types
+
+        db_before = self.db_round_trips()
+        api_before = self.api.total_calls()
+        latencies = []
+        started = time.perf_counter()
+        for user_id, text in messages:
+            self.message_id += 1
+            message = make_message(types, user_id, text, self.message_id)
+            # Написавший боту пользователь его уже разблокировал
+            self.api.blocked.discard(user_id)
+            op_started = time.perf_counter()
+            self.bot.handle_message(message)
+            latencies.append(time.perf_counter() - op_started)
+        elapsed = time.perf_counter() - started
+        return self._result(len(messages), elapsed, latencies, db_before, api_before)
+
+    # Очистка невостребованных airdrop: часть уже просрочена, часть скоро сгорит
+    def sweep(self, seed_conn, ttl_minutes: int):
+        with seed_conn.cursor() as cur:
+            cur.execute("""
+                UPDATE pending_airdrops SET created_at = CURRENT_TIMESTAMP - make_interval(mins => %s)
+                WHERE user_id %% 4 = 0;
+            """, (ttl_minutes + 1,))
+            cur.execute("""
+                UPDATE pending_airdrops SET created_at = CURRENT_TIMESTAMP - make_interval(mins => %s)
+                WHERE user_id %% 4 = 1;
+            """, (ttl_minutes - 5,))
+            cur.execute("SELECT COUNT(*) FROM pending_airdrops;")
+            pending = cur.fetchone()[0]
+        seed_conn.commit()
+
+        self.api.reset()
+        db_before = self.db_round_trips()
+        db_seconds_before = self.db_seconds()
+        started = time.perf_counter()
+        self.bot.sweep_pending_airdrops()
+        if self.bot.reminder_thread is not None:
+            self.bot.reminder_thread.join()
+        elapsed = time.perf_counter() - started
+        result = self._result(pending, elapsed, [elapsed], db_before, 0)
+        # Время SQL отдельно от отправки напоминаний
+        result["db_ms"] = round((self.db_seconds() - db_seconds_before) * 1000, 3)
+        result["reminders_sent"] = len(self.api.timestamps.get("sendMessage", []))
+        return result
+
+    # Полная рассылка; задержка на пользователя - интервал между соседними sendMessage
+    def fanout(self, job, slot: str):
+        self.api.reset()
+        db_before = self.db_round_trips()
+        started = time.perf_counter()
+        job(slot)
+        elapsed = time.perf_counter() - started
+        stamps = self.api.timestamps.get("sendMessage", [])
+        latencies = [b - a for a, b in zip([started] + stamps, stamps)]
+        return self._result(len(stamps), elapsed, latencies, db_before, 0)
+
+    # Кривая нагрузки /claim при рассылке слота частями окна доставки. Время виртуальное: части
+    # запускаются подряд, а каждый уведомленный пользователь приходит за airdrop в момент своей
+    # части плюс случайная задержка реакции. Пики считаются по секундам, кривая - по минутам.
+    def load_curve(self, job, windows: DeliveryWindows, day, slot: str, reaction_seconds: float,
+                   rng: random.Random):
+        self.api.reset()
+        db_before = self.db_round_trips()
+        parts = windows.parts(day, slot)
+        first = min(at for at, _ in parts)
+        arrivals = []
+        latencies = []
+        started = time.perf_counter()
+        for at, part in parts:
+            notified_before = len(self.api.timestamps.get("sendMessage", []))
+            part_started = time.perf_counter()
+            job(slot, day=day, part=part)
+            latencies.append(time.perf_counter() - part_started)
+            notified = len(self.api.timestamps.get("sendMessage", [])) - notified_before
+            offset = (at - first).total_seconds()
+            arrivals.extend(offset + rng.expovariate(1 / reaction_seconds) for _ in range(notified))
+        elapsed = time.perf_counter() - started
+
+        per_second = {}
+        per_minute = {}
+        for arrival in arrivals:
+            per_second[int(arrival)] = per_second.get(int(arrival), 0) + 1
+            per_minute[int(arrival // 60)] = per_minute.get(int(arrival // 60), 0) + 1
+        result = self._result(len(arrivals), elapsed, latencies, db_before, 0)
+        result["parts"] = len(parts)
+        result["peak_claim_qps"] = max(per_second.values(), default=0)
+        result["claims_per_minute"] = [per_minute.get(minute, 0) for minute in range(max(per_minute, default=-1) + 1)]
+        return result
+
+    # Сроки, наступившие разом: сессии с уже истекшим сроком восстанавливаются из журнала, и таймеры
+    # сразу выполняют таймауты ответов и истечения капч (запись ответа, сообщение пользователю).
+    # Время - до завершения последнего обработчика при workers потоках таймеров и задержке Bot API latency
+    def expiry_burst(self, sessions: int, workers: int, latency: float, rng: random.Random):
+        from deadline_timers import DeadlineTimers
+
+        path = self.bot.journal.path + ".expired"
+        if os.path.exists(path):
+            os.remove(path)
+        journal = SessionJournal(path)
+        tasks = [(level, task) for level, items in self.bot.TASKS.items() for task in items]
+        expire_ms = int((time.time() - 1) * 1000)
+        # Заблокировавшим бота сообщение не доходит, и их сессия остается незавершенной
+        user_ids = [user_id for user_id in range(1, sessions + 1) if user_id not in self.api.blocked]
+        for user_id in user_ids:
+            level, task = rng.choice(tasks)
+            if user_id % 4 == 0:
+                journal.put(user_id, ["C", level, task["question"], "ru", expire_ms, "AB12"])
+            else:
+                journal.put(user_id, ["A", level, task["question"], "ru", expire_ms, expire_ms - 20000, 0])
+        journal.close()
+
+        timers, journal, latency_before = self.bot.timers, self.bot.journal, self.api.latency
+        self.bot.timers = DeadlineTimers(workers=workers)
+        self.bot.journal = SessionJournal(path)
+        self.bot.user_states.clear()
+        self.bot.user_captchas.clear()
+        self.api.reset()
+        self.api.latency = latency
+        db_before = self.db_round_trips()
+        started = time.perf_counter()
+        restored = self.bot.restore_sessions()
+        waiting = set(user_ids)
+        while waiting and time.perf_counter() - started < 300:
+            waiting = {user_id for user_id in waiting
+                       if self.bot.user_states.get(user_id, {}).get("state") != "MAIN_MENU"}
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+
+        self.bot.timers.stop()
+        self.bot.journal.close()
+        self.bot.timers, self.bot.journal, self.api.latency = timers, journal, latency_before
+        self.bot.user_states.clear()
+        self.bot.user_captchas.clear()
+        os.remove(path)
+        result = self._result(restored, elapsed, [elapsed], db_before, 0)
+        result["workers"] = workers
+        result["unfinished"] = len(waiting)
+        result["messages_sent"] = len(self.api.timestamps.get("sendMessage", []))
+        return result
+
+    # Восстановление после перезапуска: в журнал пишется в полтора раза больше сессий, треть из них
+    # завершается, и оставшиеся sessions вопросов и капч читаются новым SessionJournal,
+    # восстанавливаются, а их сроки взводятся заново
+    def session_recovery(self, sessions: int, rng: random.Random):
+        path = self.bot.journal.path + ".recovery"
+        if os.path.exists(path):
+            os.remove(path)
+        journal = SessionJournal(path)
+        tasks = [(level, task) for level, items in self.bot.TASKS.items() for task in items]
+        expire_ms = int((time.time() + 3600) * 1000)
+        written = sessions * 3 // 2
+        started = time.perf_counter()
+        for user_id in range(1, written + 1):
+            level, task = rng.choice(tasks)
+            if user_id % 4 == 0:
+                session = ["C", level, task["question"], "ru", expire_ms, "AB12"]
+            else:
+                session = ["A", level, task["question"], "ru", expire_ms, expire_ms - 20000, 0]
+            journal.put(user_id, session)
+        for user_id in range(3, written + 1, 3):
+            journal.drop(user_id)
+        put_elapsed = time.perf_counter() - started
+        journal.close()
+        journal_bytes = os.path.getsize(path)
+
+        self.bot.user_states.clear()
+        self.bot.user_captchas.clear()
+        self.bot.journal = SessionJournal(path)
+        started = time.perf_counter()
+        restored = self.bot.restore_sessions()
+        elapsed = time.perf_counter() - started
+        armed = len(self.bot.timers)
+        self.bot.timers.clear()
+        self.bot.user_states.clear()
+        self.bot.user_captchas.clear()
+        self.bot.journal.close()
+        os.remove(path)
+        return {
+            "operations": restored,
+            "duration_s": round(elapsed, 4),
+            "throughput_ops": round(restored / elapsed, 2) if elapsed > 0 else 0.0,
+            "timers_armed": armed,
+            "journal_bytes": journal_bytes,
+            "journal_write_us": round(put_elapsed / (written + written // 3) * 1e6, 3),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк airdrop-бота")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=20, help="ответов в истории на пользователя")
+    parser.add_argument("--claims", type=int, default=500)
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--blocked-percent", type=int, default=5, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--dormant-percent", type=int, default=10, help="доля спящих пользователей")
+    parser.add_argument("--sessions", type=int, default=100000, help="активных сессий в сценарии восстановления")
+    parser.add_argument("--expired-sessions", type=int, default=500,
+                        help="сессий с истекшим сроком в сценарии срабатывания таймеров")
+    parser.add_argument("--timer-api-latency-ms", type=float, default=20.0,
+                        help="задержка Bot API в сценарии срабатывания таймеров")
+    parser.add_argument("--window-minutes", type=int, default=30, help="окно доставки для сценария кривой нагрузки")
+    parser.add_argument("--reaction-seconds", type=float, default=20.0,
+                        help="средняя задержка /claim после уведомления")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON-результатов")
+    args = parser.parse_args()
+
+    load_dotenv()
+    bench_db = os.getenv("BENCH_DB_NAME", "airdrop_bench")
+    if bench_db == os.getenv("DB_NAME", "postgres"):
+        sys.exit("BENCH_DB_NAME совпадает с DB_NAME: бенчмарк пересоздает схему, нужна отдельная база")
+
+    rng = random.Random(args.seed)
+    with open("task_data.json", "r", encoding="utf-8") as f:
+        tasks = json.load(f)
+
+    seed_conn = connect(bench_db)
+    seed_started = time.perf_counter()
+    seed_database(seed_conn, tasks, args.users, args.history, args.dormant_percent, rng)
+    seed_elapsed = time.perf_counter() - seed_started
+
+    blocked = [user_id for user_id in range(1, args.users + 1)
+               if args.dormant_percent <= user_id % 100 < args.dormant_percent + args.blocked_percent]
+    api = FakeBotApi(latency=args.api_latency_ms / 1000, blocked=blocked).start()
+    os.environ["DB_NAME"] = bench_db
+    os.environ["TELEGRAM_TOKEN"] = "0:bench"
+    os.environ["REMINDER_RATE"] = "0"
+    # Сценарии ниже повторяют нажатия одних и тех же пользователей; ограничение частоты
+    # включается только в сценарии abusive_balance_storm
+    os.environ["FLOOD_CONTROL"] = "0"
+    bench_dir = tempfile.mkdtemp(prefix="airdrop_bench_")
+    os.environ["SESSION_JOURNAL"] = os.path.join(bench_dir, "sessions.journal")
+    os.environ["WRITE_SPOOL"] = os.path.join(bench_dir, "writes.spool")
+    from telebot import apihelper
+    apihelper.API_URL = api.api_url
+
+    import main2
+    main2.load_answered_tasks()
+    bench = Bench(main2, api)
+    scenarios = {}
+
+    scenarios["fanout"] = bench.fanout(main2.send_airdrop_to_users, "bench")
+
+    with seed_conn.cursor() as cur:
+        cur.execute("UPDATE pending_airdrops SET require_captcha = FALSE;")
+        cur.execute("SELECT DISTINCT user_id FROM pending_airdrops ORDER BY user_id LIMIT %s;", (args.claims,))
+        claimers = [row[0] for row in cur.fetchall()]
+    seed_conn.commit()
+    scenarios["claim_burst"] = bench.drive([(user_id, "/claim") for user_id in claimers])
+
+    answers = []
+    for index, (user_id, state) in enumerate(list(main2.user_states.items())):
+        if state.get("state") == "AWAITING_AIRDROP_ANSWER":
+            answers.append((user_id, state["current_task"]["answer"] if index % 2 == 0 else "неверный ответ"))
+    scenarios["answer_burst"] = bench.drive(answers)
+
+    readers = [rng.randint(1, args.users) for _ in range(args.reads)]
+    scenarios["balance_storm"] = bench.drive([(user_id, "Баланс") for user_id in readers])
+    scenarios["stats_storm"] = bench.drive([(user_id, "Статистика") for user_id in readers])
+    # Один пользователь жмет "Баланс" без остановки: до БД доходят только первые нажатия
+    main2.router.set_admission(main2.admit_update)
+    scenarios["abusive_balance_storm"] = bench.drive([(readers[0], "Баланс")] * args.reads)
+    main2.router.set_admission(None)
+    scenarios["pending_sweep"] = bench.sweep(seed_conn, main2.PENDING_TTL_MINUTES)
+
+    # Один и тот же слот сразу всем и волнами окна доставки (и по местному времени пользователей)
+    curve_day = datetime.now().date()
+    for name, windows in (
+            ("claim_curve_burst", DeliveryWindows()),
+            ("claim_curve_staggered", DeliveryWindows(window_minutes=args.window_minutes)),
+            ("claim_curve_local_time", DeliveryWindows(window_minutes=args.window_minutes, local_time=True))):
+        with seed_conn.cursor() as cur:
+            cur.execute("DELETE FROM pending_airdrops; UPDATE users SET airdrops_today = 0;")
+        seed_conn.commit()
+        main2.windows = windows
+        scenarios[name] = bench.load_curve(main2.send_airdrop_to_users, windows, curve_day, "10:00:00",
+                                           args.reaction_seconds, rng)
+    main2.windows = DeliveryWindows()
+
+    # Детерминированная выдача (ASSIGNMENT_MODE=hashed) на слоте, открытом минуту назад
+    main2.HASHED_ASSIGNMENT = True
+    slot_started = datetime.now() - timedelta(minutes=1)
+    slot = slot_started.strftime("%H:%M:%S")
+    main2.assigner.set_slots([slot])
+    scenarios["hashed_fanout"] = bench.fanout(main2.send_hashed_airdrop_notices, slot)
+    hashed_claimers = [user_id for user_id in range(1, args.users + 1)
+                       if main2.assigner.airdrop_number(user_id, slot_started.date(), slot) is not None]
+    scenarios["hashed_claim_burst"] = bench.drive([(user_id, "/claim") for user_id in hashed_claimers[:args.claims]])
+
+    # Объявление в канале (DELIVERY_MODE=channel) и забор по ссылке с ленивой выдачей
+    main2.HASHED_ASSIGNMENT = False
+    main2.DELIVERY_MODE = "channel"
+    main2.BROADCAST_CHANNEL = "@bench_channel"
+    slot_started = datetime.now() - timedelta(minutes=2)
+    slot = slot_started.strftime("%H:%M:%S")
+    main2.assigner.set_slots([slot])
+    scenarios["channel_broadcast"] = bench.fanout(main2.broadcast_airdrop, slot)
+    with seed_conn.cursor() as cur:
+        # Дневные лимиты уже израсходованы предыдущими сценариями
+        cur.execute("UPDATE users SET airdrops_today = 0, is_suspicious = FALSE;")
+    seed_conn.commit()
+    start = "/start " + main2.slot_payload(slot_started.date(), slot)
+    link_claimers = rng.sample(range(1, args.users + 1), min(args.claims, args.users))
+    scenarios["deep_link_claim_burst"] = bench.drive([(user_id, start) for user_id in link_claimers])
+
+    # Таймеры ожидания ответа больше не нужны: все ответы уже обработаны
+    main2.timers.clear()
+    scenarios["session_recovery"] = bench.session_recovery(args.sessions, rng)
+    # Те же сроки на одном потоке, как до пула обработчиков, и на пуле TIMER_WORKERS
+    for name, workers in (("expiry_burst_single", 1), ("expiry_burst", main2.timers.workers)):
+        scenarios[name] = bench.expiry_burst(min(args.expired_sessions, args.users), workers,
+                                             args.timer_api_latency_ms / 1000, rng)
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "seed_duration_s": round(seed_elapsed, 3),
+        "scenarios": scenarios,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+    api.stop()
+    seed_conn.close()
+
+
+if __name__ == "__main__":
+    main()
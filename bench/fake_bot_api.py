@@ -0,0 +1,111 @@
+# Локальная заглушка Telegram Bot API для бенчмарков.
+# Отвечает на любые методы успешным ответом и считает вызовы по методам;
+# для chat_id из blocked возвращает 403, как для пользователя, заблокировавшего бота.
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, blocked=()):
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.calls: Dict[str, int] = {}
+        self.timestamps: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # Формат для telebot.apihelper.API_URL
+    @property
+    def api_url(self) -> str:
+        return self.url + "/bot{0}/{1}"
+
+    def start(self) -> "FakeBotApi":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.timestamps.clear()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _record(self, method: str) -> int:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.timestamps.setdefault(method, []).append(time.perf_counter())
+            self._message_id += 1
+            return self._message_id
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Без Nagle ответ уходит сразу, иначе keep-alive соединение ждет delayed ACK (~40 мс)
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                # telebot передает параметры в строке запроса, файлы - в multipart-теле
+                url = urlsplit(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                chat_id = parse_qs(url.query).get("chat_id", ["0"])[0]
+                # Каналы адресуются по @username, пользователи - по числовому id
+                chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
+
+                if api.latency:
+                    time.sleep(api.latency)
+                message_id = api._record(method)
+
+                status = 200
+                if chat_id in api.blocked:
+                    status = 403
+                    response = {"ok": False, "error_code": 403,
+                                "description": "Forbidden: bot was blocked by the user"}
+                elif method == "getMe":
+                    response = {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench",
+                                                       "username": "bench_bot"}}
+                else:
+                    response = {"ok": True, "result": {
+                        "message_id": message_id,
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                    }}
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,63 @@
+# Накладные расходы ограничения частоты на одно обновление и память корзин
+# по сравнению со словарем объектов на пользователя.
+# Запуск из корня репозитория: python -m bench.flood_control_bench
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from flood_control import FloodControl
+
+ITERATIONS = 1000000
+USERS = 100000
+ROUTES = ("show_balance", "show_stats", "/claim", "AWAITING_AIRDROP_ANSWER")
+
+
+# Прежний подход для сравнения: словарь user_id -> объект корзины
+class Bucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+def dict_buckets_bytes(users: int) -> int:
+    tracemalloc.start()
+    buckets = {user_id: Bucket(8.0, time.monotonic()) for user_id in range(10 ** 9, 10 ** 9 + users)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del buckets
+    return size
+
+
+def measure(updates) -> dict:
+    flood = FloodControl(costs={"show_stats": 2, "/claim": 2}, reads=("show_balance", "show_stats"),
+                         exempt=("AWAITING_AIRDROP_ANSWER",))
+    check = flood.check
+    started = time.perf_counter()
+    for user_id, route in updates:
+        check(user_id, route)
+    elapsed = time.perf_counter() - started
+    # Пустой проход по тем же данным вычитается: остается стоимость самого check
+    started = time.perf_counter()
+    for user_id, route in updates:
+        pass
+    loop = time.perf_counter() - started
+    return {"ns_per_update": round((elapsed - loop) / len(updates) * 1e9, 1)}
+
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    user_ids = [rng.randrange(10 ** 9, 10 ** 10) for _ in range(USERS)]
+    many_users = [(rng.choice(user_ids), rng.choice(ROUTES)) for _ in range(ITERATIONS)]
+    abusive = [(user_ids[0], "show_balance")] * ITERATIONS
+    results = {
+        "many_users": measure(many_users),
+        "single_abusive_user": measure(abusive),
+        "array_bytes": FloodControl().memory_bytes(),
+        "dict_bytes_for_users": {USERS: dict_buckets_bytes(USERS)},
+        "python": sys.version.split()[0],
+    }
+    print(json.dumps(results, indent=2))
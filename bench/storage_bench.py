@@ -0,0 +1,121 @@
+# Нагрузка на интерфейс хранилища: регистрация, очередь airdrop, ответы (по одному и пачками),
+# чтение баланса и обход получателей рассылки. По умолчанию - встроенная SQLite во временном каталоге,
+# без внешних сервисов; --postgres - те же операции на базе BENCH_DB_NAME (пересоздается).
+# Запуск из корня репозитория: python -m bench.storage_bench --users 5000 [--postgres]
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+from circuit_breaker import CircuitBreaker
+from db_profiler import QueryProfiler
+from sqlite_storage import SqliteStorage
+from storage import NO_PART, PostgresStorage
+
+LEVELS = ["легкий", "средний", "сложный"]
+
+
+def postgres_storage():
+    from bench.e2e_bench import connect, load_schema
+
+    dbname = os.getenv("BENCH_DB_NAME", "airdrop_bench")
+    with connect(dbname) as conn, conn.cursor() as cur:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+        cur.execute(load_schema())
+    conn.close()
+    return PostgresStorage(lambda: connect(dbname), QueryProfiler(), CircuitBreaker())
+
+
+def timed(results: dict, name: str, operations: int, work):
+    started = time.perf_counter()
+    work()
+    elapsed = time.perf_counter() - started
+    results[name] = {"operations": operations, "seconds": round(elapsed, 3),
+                     "ops_per_second": round(operations / elapsed) if elapsed else None}
+
+
+def run(storage, users: int, batch: int, rng: random.Random) -> dict:
+    results = {}
+    user_ids = list(range(1, users + 1))
+
+    def register():
+        for user_id in user_ids:
+            storage.register_user(user_id, f"user{user_id}", f"User{user_id}", None,
+                                  {"language_code": "en" if user_id % 5 == 0 else "ru", "is_bot": False})
+            if user_id % batch == 0:
+                storage.commit()
+        storage.commit()
+
+    def enqueue():
+        for offset in range(0, users, batch):
+            storage.enqueue_airdrops("2026-01-01 10:00", [
+                (user_id, rng.choice(LEVELS), f"Вопрос {user_id}", user_id % 3 == 0)
+                for user_id in user_ids[offset:offset + batch]
+            ])
+            storage.commit()
+
+    def pop():
+        for user_id in user_ids:
+            storage.pop_pending_airdrop(user_id)
+            storage.commit()
+
+    now = time.time()
+    answers = [[f"{user_id}:{i}", user_id, rng.choice(LEVELS), f"Вопрос {i}", "42", i % 2 == 0, 1500,
+                "answer", 10 if i % 2 == 0 else 0, 1 if i % 2 == 0 else 0, now]
+               for i, user_id in enumerate(user_ids)]
+
+    def answers_single():
+        for record in answers:
+            storage.write_answers([record])
+            storage.commit()
+
+    def answers_batched():
+        for offset in range(0, len(answers), batch):
+            storage.write_answers([[f"b{record[0]}"] + record[1:] for record in answers[offset:offset + batch]])
+            storage.commit()
+
+    def balances():
+        for user_id in user_ids:
+            storage.balance(user_id)
+        storage.commit()
+
+    def fanout():
+        after = 0
+        while True:
+            page = storage.fanout_page(after, 30, NO_PART, 1000)
+            storage.commit()
+            if not page:
+                break
+            after = page[-1][0]
+
+    timed(results, "register_user", users, register)
+    timed(results, "enqueue_airdrops", users, enqueue)
+    timed(results, "pop_pending_airdrop", users, pop)
+    timed(results, "write_answers_single", users, answers_single)
+    timed(results, "write_answers_batched", users, answers_batched)
+    timed(results, "balance", users, balances)
+    timed(results, "fanout_page", users, fanout)
+    return results
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    results = {"users": args.users, "batch": args.batch, "python": sys.version.split()[0]}
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite = SqliteStorage(os.path.join(directory, "bench.db"))
+        results["sqlite"] = run(sqlite, args.users, args.batch, random.Random(42))
+        sqlite.close()
+    if args.postgres:
+        results["postgres"] = run(postgres_storage(), args.users, args.batch, random.Random(42))
+    print(json.dumps(results, indent=2))
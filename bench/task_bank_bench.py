@@ -0,0 +1,171 @@
+# Загрузка задач для большого каталога: task_data.json в память процесса против банка задач через mmap.
+# Каждый вариант загружается в отдельном процессе: время загрузки, поиск задачи и проверка ответа,
+# память процесса (RssAnon - собственная, RssFile - страницы файла, общие для процессов).
+# Варианты *_startup - запуск как в main2: задачи, модель навыков, отпечаток каталога и наборы отвеченных,
+# затем первая перестройка таблиц выбора и выдача вопросов по рейтингу.
+# Запуск из корня репозитория: python -m bench.task_bank_bench --tasks 500000
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+LEVELS = ["легкий", "средний", "сложный"]
+LOOKUPS = 20000
+
+
+def synthetic_tasks(count: int, rng: random.Random):
+    tasks = {level: [] for level in LEVELS}
+    for i in range(count):
+        level = LEVELS[i % len(LEVELS)]
+        tasks[level].append({
+            "question": f"Вопрос {i}: сколько будет {i} + {rng.randint(1, 1000)}? " + "текст " * rng.randint(2, 12),
+            "answer": str(rng.randint(1, 100000)),
+            "aliases": [f"ответ {i}"] if i % 10 == 0 else [],
+            "reward": 1 + i % 3,
+        })
+    return tasks
+
+
+def memory() -> dict:
+    fields = {}
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "RssAnon", "RssFile"):
+                fields[name] = int(value.split()[0]) // 1024
+    return {f"{name}_mb": value for name, value in fields.items()}
+
+
+# Вариант в дочернем процессе: загрузка как в main2, затем поиск и проверка ответов
+def child(mode: str, path: str) -> dict:
+    from answer_matching import AnswerMatcher
+    from task_bank import TaskBank
+
+    if mode.endswith("_startup"):
+        return startup(mode, path)
+
+    base = memory()
+    started = time.perf_counter()
+    if mode == "json":
+        with open(path, "r", encoding="utf-8") as f:
+            tasks = json.load(f)
+        index = {(level, task["question"]): task for level, level_tasks in tasks.items() for task in level_tasks}
+        matcher = AnswerMatcher(tasks)
+        find = lambda level, question: index.get((level, question))
+    else:
+        bank = TaskBank(path)
+        tasks = bank.levels
+        matcher = bank
+        find = bank.find
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(7)
+    picks = []
+    for _ in range(LOOKUPS):
+        level = rng.choice(LEVELS)
+        task = rng.choice(tasks[level])
+        picks.append((level, task["question"], task["answer"]))
+    started = time.perf_counter()
+    for level, question, answer in picks:
+        find(level, question)
+    find_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    correct = sum(matcher.matches(level, question, answer) for level, question, answer in picks)
+    match_seconds = time.perf_counter() - started
+    assert correct == LOOKUPS
+
+    result = {"load_seconds": round(load_seconds, 3),
+              "find_us": round(find_seconds / LOOKUPS * 1e6, 2),
+              "match_us": round(match_seconds / LOOKUPS * 1e6, 2)}
+    after = memory()
+    result.update({name: after[name] - base.get(name, 0) for name in after})
+    return result
+
+
+# Запуск как в main2 (SkillModel по словарю задач или по банку), без БД
+def startup(mode: str, path: str) -> dict:
+    from answered_tasks import AnsweredTasks
+    from skill_rating import SkillModel
+    from task_bank import TaskBank
+
+    base = memory()
+    started = time.perf_counter()
+    if mode == "json_startup":
+        with open(path, "r", encoding="utf-8") as f:
+            tasks = json.load(f)
+    else:
+        tasks = TaskBank(path)
+    skills = SkillModel(tasks)
+    answered_tasks = AnsweredTasks(skills.size)
+    level_first_task = {level: task_ids.start for level, task_ids in skills.level_ranges.items() if task_ids}
+    startup_seconds = time.perf_counter() - started
+    loaded = memory()
+
+    started = time.perf_counter()
+    skills.prepare_selection()
+    prepare_seconds = time.perf_counter() - started
+
+    rng = random.Random(7)
+    started = time.perf_counter()
+    for user_id in range(LOOKUPS):
+        level = skills.choose_level(user_id, rng)
+        task = skills.choose_task(user_id, level, answered_tasks.get(user_id), rng)
+        skills.update(user_id, level, task["question"], rng.random() < 0.7)
+        answered_tasks.add(user_id, skills.task_id(level, task["question"]))
+    choose_seconds = time.perf_counter() - started
+    assert len(level_first_task) == len(LEVELS) and skills.catalog
+
+    result = {"startup_seconds": round(startup_seconds, 3),
+              "prepare_selection_seconds": round(prepare_seconds, 3),
+              "choose_us": round(choose_seconds / LOOKUPS * 1e6, 2)}
+    result.update({f"startup_{name}": loaded[name] - base.get(name, 0) for name in loaded})
+    after = memory()
+    result.update({name: after[name] - base.get(name, 0) for name in after})
+    return result
+
+
+def run_child(mode: str, path: str) -> dict:
+    output = subprocess.run([sys.executable, "-m", "bench.task_bank_bench", "--child", mode, path],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=500000)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(*args.child)))
+        sys.exit(0)
+
+    from task_bank import build_task_bank
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "task_data.json")
+        bank_path = os.path.join(directory, "tasks.bank")
+        tasks = synthetic_tasks(args.tasks, random.Random(42))
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(tasks, f, ensure_ascii=False)
+        started = time.perf_counter()
+        build_task_bank(tasks, bank_path)
+        build_seconds = time.perf_counter() - started
+        del tasks
+
+        results = {
+            "tasks": args.tasks,
+            "json_bytes": os.path.getsize(json_path),
+            "bank_bytes": os.path.getsize(bank_path),
+            "build_seconds": round(build_seconds, 2),
+            "json": run_child("json", json_path),
+            "bank": run_child("bank", bank_path),
+            "json_startup": run_child("json_startup", json_path),
+            "bank_startup": run_child("bank_startup", bank_path),
+            "python": sys.version.split()[0],
+        }
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,60 @@
+# Сравнение старого способа сборки ответа (новая клавиатура + f-строка) с кэшированными ресурсами.
+# Запуск из корня репозитория: python -m bench.ui_assets_bench
+import json
+import time
+import tracemalloc
+
+from telebot import types
+
+from ui_assets import main_keyboard, render
+
+ITERATIONS = 20000
+
+
+def legacy_reply(balance: int, correct: int, total: int):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.row("Баланс", "Статистика", "Помощь")
+    markup.row("Claim Airdrop")
+    accuracy = (correct / total * 100) if total > 0 else 0
+    text = (
+        f"💰 Баланс: {balance} баллов\n"
+        f"✅ Правильных ответов: {correct}\n"
+        f"📊 Всего вопросов: {total}\n"
+        f"🎯 Точность: {accuracy:.1f}%"
+    )
+    return text, markup.to_json()
+
+
+def cached_reply(balance: int, correct: int, total: int):
+    accuracy = (correct / total * 100) if total > 0 else 0
+    text = render("balance", "ru", balance=balance, correct=correct, total=total, accuracy=accuracy)
+    return text, main_keyboard("ru")
+
+
+def measure(builder):
+    builder(1, 1, 1)
+    started = time.perf_counter()
+    for i in range(ITERATIONS):
+        builder(i, i // 2, i + 1)
+    elapsed = time.perf_counter() - started
+    return {"us_per_message": elapsed / ITERATIONS * 1e6}
+
+
+# Пиковый объем временных выделений памяти при сборке одного сообщения
+def transient_bytes(builder):
+    tracemalloc.start()
+    builder(1, 1, 1)
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    builder(7, 3, 9)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - baseline
+
+
+if __name__ == "__main__":
+    results = {}
+    for name, builder in (("legacy", legacy_reply), ("cached", cached_reply)):
+        results[name] = measure(builder)
+        results[name]["peak_bytes_per_message"] = transient_bytes(builder)
+    print(json.dumps(results, indent=2))
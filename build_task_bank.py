@@ -0,0 +1,48 @@
+# Сборка банка задач для бота (TASK_BANK) из task_data.json.
+# Запуск: python build_task_bank.py [--input task_data.json] [--output tasks.bank]
+#
+# Файл пишется рядом под временным именем и подменяет старый одной операцией:
+# запущенные процессы продолжают читать прежний банк до перезапуска.
+import argparse
+import json
+import logging
+import os
+import time
+
+from logging_setup import setup_logging, shutdown_logging
+from task_bank import TaskBank, build_task_bank
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка банка задач из task_data.json")
+    parser.add_argument("--input", default="task_data.json", help="задачи в формате task_data.json")
+    parser.add_argument("--output", default="tasks.bank", help="файл банка задач")
+    args = parser.parse_args()
+
+    setup_logging()
+    try:
+        started = time.perf_counter()
+        with open(args.input, "r", encoding="utf-8") as f:
+            tasks = json.load(f)
+        temporary = args.output + ".tmp"
+        count = build_task_bank(tasks, temporary)
+        # Проверка перед подменой: каждый вопрос находится по хеш-таблице
+        bank = TaskBank(temporary)
+        try:
+            for level, level_tasks in tasks.items():
+                for task in level_tasks:
+                    if bank.find(level, task["question"]) is None:
+                        raise ValueError(f"Вопрос не найден в собранном банке: {level} / {task['question']}")
+        finally:
+            bank.close()
+        os.replace(temporary, args.output)
+        logger.info("Банк задач %s: %s задач, %s байт за %.1f с",
+                    args.output, count, os.path.getsize(args.output), time.perf_counter() - started)
+    finally:
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# Офлайн-калибровка вопросов по истории user_answers.
+# Запуск: python calibrate_tasks.py [--min-answers 30] [--chunk 50000]
+#
+# Два прохода серверным курсором в одной транзакции REPEATABLE READ (оба видят один снимок),
+# память ограничена числом пользователей и вопросов, а не ответов:
+# 1) общая точность каждого пользователя (оценка способностей);
+# 2) по каждому вопросу: точность, гистограмма времени ответа (медиана),
+#    точечно-бисериальная корреляция правильности с точностью пользователя без этого ответа
+#    (дискриминация) и трудность 1PL-модели.
+# Результат записывается в task_calibration, бот читает его при запуске.
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from logging_setup import setup_logging, shutdown_logging
+
+logger = logging.getLogger(__name__)
+
+TIME_BIN_MS = 100
+TIME_BINS = 201  # 0..20 секунд с шагом 100 мс, последняя корзина - 20 с и больше
+MIN_REWARD = 1
+MAX_REWARD = 5
+KEY_SEPARATOR = "\x1f"
+
+
+def get_connection():
+    return psycopg2.connect(
+        dbname=os.getenv("DB_NAME", "postgres"),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASSWORD", "123"),
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+    )
+
+
+# Проход 1: (отсортированные user_id, ответов, правильных)
+def load_user_totals(conn, chunk: int):
+    user_ids, totals, corrects = [], [], []
+    with conn.cursor(name="calibration_users") as cur:
+        cur.itersize = chunk
+        cur.execute("""
+            SELECT user_id, COUNT(*), SUM(CASE WHEN is_correct THEN 1 ELSE 0 END)
+            FROM user_answers
+            GROUP BY user_id
+            ORDER BY user_id;
+        """)
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            for user_id, total, correct in rows:
+                user_ids.append(user_id)
+                totals.append(total)
+                corrects.append(correct)
+    return (np.array(user_ids, dtype=np.int64), np.array(totals, dtype=np.float64),
+            np.array(corrects, dtype=np.float64))
+
+
+class QuestionAccumulator:
+    def __init__(self, capacity: int = 1024):
+        self.keys = {}
+        self.names = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self.capacity = capacity
+        self.n = np.zeros(capacity)
+        self.correct = np.zeros(capacity)
+        self.ability = np.zeros(capacity)
+        self.ability_sq = np.zeros(capacity)
+        self.correct_ability = np.zeros(capacity)
+        self.times = np.zeros((capacity, TIME_BINS), dtype=np.int64)
+
+    def _grow(self, needed: int):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        old = (self.n, self.correct, self.ability, self.ability_sq, self.correct_ability, self.times)
+        self._allocate(capacity)
+        for target, source in zip(
+                (self.n, self.correct, self.ability, self.ability_sq, self.correct_ability, self.times), old):
+            target[:len(source)] = source
+
+    def ids(self, level_question_pairs) -> np.ndarray:
+        unique, inverse = np.unique(level_question_pairs, return_inverse=True)
+        mapped = np.empty(len(unique), dtype=np.int64)
+        for position, key in enumerate(unique):
+            question_id = self.keys.get(key)
+            if question_id is None:
+                question_id = self.keys[key] = len(self.names)
+                self.names.append(key)
+            mapped[position] = question_id
+        if len(self.names) > self.capacity:
+            self._grow(len(self.names))
+        return mapped[inverse]
+
+    def add(self, question_ids, is_correct, ability, answer_ms):
+        size = self.capacity
+        self.n += np.bincount(question_ids, minlength=size)
+        self.correct += np.bincount(question_ids, weights=is_correct, minlength=size)
+        self.ability += np.bincount(question_ids, weights=ability, minlength=size)
+        self.ability_sq += np.bincount(question_ids, weights=ability * ability, minlength=size)
+        self.correct_ability += np.bincount(question_ids, weights=is_correct * ability, minlength=size)
+
+        has_time = answer_ms >= 0
+        if has_time.any():
+            bins = np.minimum(answer_ms[has_time] // TIME_BIN_MS, TIME_BINS - 1).astype(np.int64)
+            np.add.at(self.times, (question_ids[has_time], bins), 1)
+
+
+# Проход 2: накопление сумм по вопросам пачками. Ответы пользователей, которых нет в проходе 1,
+# пропускаются: в одном снимке их быть не должно
+def accumulate_questions(conn, chunk: int, user_ids, user_totals, user_corrects) -> QuestionAccumulator:
+    accumulator = QuestionAccumulator()
+    skipped = 0
+    with conn.cursor(name="calibration_answers") as cur:
+        cur.itersize = chunk
+        cur.execute("""
+            SELECT user_id, level, question, is_correct, COALESCE(answer_time_ms, -1)
+            FROM user_answers;
+        """)
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            users, levels, questions, correct, answer_ms = zip(*rows)
+            users = np.array(users, dtype=np.int64)
+            keys = np.array([level + KEY_SEPARATOR + question for level, question in zip(levels, questions)])
+            correct = np.array(correct, dtype=np.float64)
+            answer_ms = np.array(answer_ms, dtype=np.int64)
+
+            positions = np.searchsorted(user_ids, users)
+            found = positions < len(user_ids)
+            found[found] = user_ids[positions[found]] == users[found]
+            if not found.all():
+                skipped += int(len(found) - found.sum())
+                positions, keys, correct, answer_ms = positions[found], keys[found], correct[found], answer_ms[found]
+                if not len(positions):
+                    continue
+
+            question_ids = accumulator.ids(keys)
+            rest_total = user_totals[positions] - 1
+            rest_correct = user_corrects[positions] - correct
+            # Способность = точность пользователя без учета текущего ответа
+            ability = np.divide(rest_correct, rest_total, out=np.full(len(positions), 0.5), where=rest_total > 0)
+
+            accumulator.add(question_ids, correct, ability, answer_ms)
+    if skipped:
+        logger.warning("Пропущено ответов пользователей, которых нет в первом проходе: %s", skipped)
+    return accumulator
+
+
+def median_from_histogram(histogram: np.ndarray) -> np.ndarray:
+    counts = histogram.sum(axis=1)
+    cumulative = histogram.cumsum(axis=1)
+    median_bin = (cumulative >= (counts / 2)[:, None]).argmax(axis=1)
+    result = (median_bin * TIME_BIN_MS + TIME_BIN_MS // 2).astype(np.float64)
+    result[counts == 0] = np.nan
+    return result
+
+
+def compute_calibration(accumulator: QuestionAccumulator):
+    size = len(accumulator.names)
+    n = accumulator.n[:size]
+    valid = n > 0
+    safe_n = np.where(valid, n, 1)
+
+    accuracy = accumulator.correct[:size] / safe_n
+    mean_ability = accumulator.ability[:size] / safe_n
+    var_ability = accumulator.ability_sq[:size] / safe_n - mean_ability ** 2
+    covariance = accumulator.correct_ability[:size] / safe_n - accuracy * mean_ability
+    var_correct = accuracy * (1 - accuracy)
+    denominator = np.sqrt(np.clip(var_ability * var_correct, 0, None))
+    discrimination = np.divide(covariance, denominator, out=np.full(size, np.nan), where=denominator > 1e-12)
+
+    # Трудность 1PL: логит доли неправильных ответов (со сглаживанием)
+    smoothed = (accumulator.correct[:size] + 0.5) / (n + 1.0)
+    difficulty = np.log((1 - smoothed) / smoothed)
+
+    # Награда растет с трудностью: от MIN_REWARD для почти всегда решаемых до MAX_REWARD
+    reward = np.clip(np.rint(MIN_REWARD + (MAX_REWARD - MIN_REWARD) * (1 - accuracy)), MIN_REWARD, MAX_REWARD)
+
+    median_ms = median_from_histogram(accumulator.times[:size])
+
+    rows = []
+    for question_id in range(size):
+        if not valid[question_id]:
+            continue
+        level, question = accumulator.names[question_id].split(KEY_SEPARATOR, 1)
+        rows.append((
+            level, question, int(n[question_id]), float(accuracy[question_id]),
+            None if np.isnan(median_ms[question_id]) else int(median_ms[question_id]),
+            None if np.isnan(discrimination[question_id]) else float(discrimination[question_id]),
+            float(difficulty[question_id]), int(reward[question_id]),
+        ))
+    return rows
+
+
+def write_calibration(conn, rows, min_answers: int):
+    rows = [row for row in rows if row[2] >= min_answers]
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM task_calibration;")
+        execute_values(cur, """
+            INSERT INTO task_calibration
+            (level, question, answers, accuracy, median_answer_ms, discrimination, difficulty, suggested_reward)
+            VALUES %s;
+        """, rows, page_size=1000)
+    conn.commit()
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Калибровка вопросов по истории ответов")
+    parser.add_argument("--min-answers", type=int, default=30, help="минимум ответов для записи вопроса")
+    parser.add_argument("--chunk", type=int, default=50000, help="строк за одну выборку курсора")
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging()
+    conn = get_connection()
+    try:
+        started = time.perf_counter()
+        # Ответ, записанный между проходами, не должен попасть только во второй
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        user_ids, user_totals, user_corrects = load_user_totals(conn, args.chunk)
+        logger.info("Пользователей с ответами: %s", len(user_ids))
+
+        accumulator = accumulate_questions(conn, args.chunk, user_ids, user_totals, user_corrects)
+        conn.commit()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        rows = compute_calibration(accumulator)
+        written = write_calibration(conn, rows, args.min_answers)
+        logger.info("Откалибровано вопросов: %s из %s за %.1f с",
+                    written, len(rows), time.perf_counter() - started)
+    finally:
+        conn.close()
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Запрос не отправлен: предохранитель разомкнут. Наследник OperationalError, чтобы его ловили
+# те же обработчики, что и обрыв соединения
+class CircuitOpenError(psycopg2.OperationalError):
+    pass
+
+
+# Предохранитель перед БД: после failure_threshold ошибок соединения подряд запросы
+# не отправляются reset_seconds, затем один пробный запрос (half_open) решает,
+# замкнуть цепь или ждать еще. Ошибки самих запросов (нарушение ограничений и т.п.)
+# передавать в record_failure не нужно.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 3, reset_seconds: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != CLOSED
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and self._clock() - self._opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        if self.state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Соединение с БД восстановлено")
+            self.state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state == CLOSED:
+                    logger.warning("БД недоступна: запросы приостановлены на %.0f с", self.reset_seconds)
+                self.state = OPEN
+                self._opened_at = self._clock()
@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time as time_module
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+
+from metrics import DB_QUERY_ERRORS, DB_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+# Накопленная статистика по одному именованному запросу
+class StatementStats:
+    __slots__ = ("count", "errors", "total", "max", "slow")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+
+# Профилировщик SQL: замер по имени запроса, журнал медленных запросов с параметрами
+# и (по выборке) план EXPLAIN (ANALYZE, BUFFERS) в кольцевом буфере.
+class QueryProfiler:
+    def __init__(self, slow_threshold_ms: float = 100.0, explain_sample_rate: float = 0.0,
+                 buffer_size: int = 100):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.explain_sample_rate = explain_sample_rate
+        self.slow_queries = deque(maxlen=buffer_size)
+        self._stats: Dict[str, StatementStats] = {}
+        self._lock = threading.Lock()
+
+    def execute(self, cur, name: str, query: str, params=None):
+        started = time_module.perf_counter()
+        failed = False
+        try:
+            cur.execute(query, params)
+        except psycopg2.Error:
+            failed = True
+            DB_QUERY_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time_module.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, name)
+            self._record(name, elapsed, failed)
+
+        if elapsed >= self.slow_threshold:
+            self._on_slow(cur, name, query, params, elapsed)
+
+    # Выборка через именованный (серверный) курсор порциями по itersize строк. Время - сумма
+    # DECLARE и всех FETCH без обработки строк вызывающим кодом; план для таких выборок не снимается
+    def stream(self, conn, name: str, query: str, params=None, itersize: int = 10000):
+        elapsed = 0.0
+        failed = False
+        try:
+            with conn.cursor(name=name) as cur:
+                started = time_module.perf_counter()
+                cur.execute(query, params)
+                while True:
+                    rows = cur.fetchmany(itersize)
+                    elapsed += time_module.perf_counter() - started
+                    if not rows:
+                        break
+                    yield from rows
+                    started = time_module.perf_counter()
+        except psycopg2.Error:
+            failed = True
+            DB_QUERY_ERRORS.inc(name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(elapsed, name)
+            self._record(name, elapsed, failed)
+
+        if elapsed >= self.slow_threshold:
+            self._on_slow(None, name, query, params, elapsed)
+
+    def _record(self, name: str, elapsed: float, failed: bool):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = StatementStats()
+            stats.count += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            if failed:
+                stats.errors += 1
+            if elapsed >= self.slow_threshold:
+                stats.slow += 1
+
+    def _on_slow(self, cur, name: str, query: str, params, elapsed: float):
+        logger.warning("Медленный запрос %s: %.1f мс, параметры: %r", name, elapsed * 1000, params)
+        plan = None
+        if cur is not None and self.explain_sample_rate and random.random() < self.explain_sample_rate:
+            plan = self._explain(cur.connection, query, params)
+        self.slow_queries.append({
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "name": name,
+            "ms": round(elapsed * 1000, 1),
+            "params": params,
+            "plan": plan,
+        })
+
+    # План снимается в точке сохранения и откатывается, чтобы UPDATE/INSERT не применились дважды
+    def _explain(self, conn, query: str, params) -> Optional[str]:
+        try:
+            with conn.cursor() as explain_cur:
+                explain_cur.execute("SAVEPOINT profiler_explain;")
+                try:
+                    explain_cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                    return "\n".join(row[0] for row in explain_cur.fetchall())
+                finally:
+                    explain_cur.execute("ROLLBACK TO SAVEPOINT profiler_explain;")
+        except psycopg2.Error as e:
+            logger.error("Не удалось получить EXPLAIN: %s", e)
+            return None
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                name: {
+                    "count": s.count,
+                    "errors": s.errors,
+                    "slow": s.slow,
+                    "avg_ms": s.total / s.count * 1000 if s.count else 0.0,
+                    "max_ms": s.max * 1000,
+                    "total_ms": s.total * 1000,
+                }
+                for name, s in self._stats.items()
+            }
+
+    # Текстовый отчет для админов: самые затратные запросы и последние медленные
+    def report(self, top: int = 10, recent: int = 5, with_plans: bool = True) -> str:
+        lines: List[str] = ["🐢 Запросы по суммарному времени:"]
+        ranked = sorted(self.stats().items(), key=lambda item: item[1]["total_ms"], reverse=True)[:top]
+        for name, s in ranked:
+            lines.append(
+                f"• {name}: {s['count']} шт, ср. {s['avg_ms']:.1f} мс, "
+                f"макс. {s['max_ms']:.1f} мс, медленных {s['slow']}"
+            )
+        if not ranked:
+            lines.append("нет данных")
+
+        entries = list(self.slow_queries)[-recent:]
+        lines.append(f"\nПоследние медленные запросы (порог {self.slow_threshold * 1000:.0f} мс):")
+        if not entries:
+            lines.append("нет")
+        for entry in reversed(entries):
+            lines.append(f"• {entry['at']} {entry['name']} {entry['ms']} мс {entry['params']!r}")
+            if with_plans and entry["plan"]:
+                lines.append(entry["plan"])
+        return "\n".join(lines)
@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+# Таймеры сроков на одном потоке: куча (срок, номер, функция, аргументы) вместо потока
+# threading.Timer на каждый вопрос. Сроки - время time.time(), поэтому их можно сохранить
+# и взвести заново после перезапуска; просроченные выполняются сразу.
+# Поток таймеров только отдает наступившие сроки небольшому пулу workers потоков: медленный
+# обработчик (запрос к Bot API, запись в БД) не задерживает остальные сроки. Функции с одним
+# первым аргументом (user_id) попадают в один поток и выполняются по порядку.
+class DeadlineTimers:
+    def __init__(self, name: str = "deadline-timers", workers: int = 4):
+        self.name = name
+        self.workers = max(1, workers)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, deadline: float, callback: Callable, *args):
+        self.schedule_many([(deadline, callback, args)])
+
+    # Взвод многих сроков одной операцией: [(срок, функция, аргументы)]
+    def schedule_many(self, entries):
+        with self._condition:
+            for deadline, callback, args in entries:
+                self._heap.append((deadline, next(self._sequence), callback, args))
+            heapq.heapify(self._heap)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                for number, tasks in enumerate(self._queues):
+                    threading.Thread(target=self._work, args=(tasks,), name=f"{self.name}-{number}",
+                                     daemon=True).start()
+            # Новый срок может оказаться ближайшим
+            self._condition.notify()
+
+    # Отмена всех сроков без выполнения
+    def clear(self):
+        with self._condition:
+            self._heap.clear()
+
+    # Сроки, уже отданные пулу, после остановки не выполняются
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        for tasks in self._queues:
+            tasks.put(None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                # Все наступившие сроки за один проход
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, callback, args = heapq.heappop(self._heap)
+                    due.append((callback, args))
+            for callback, args in due:
+                self._queues[hash(args[0]) % self.workers if args else 0].put((callback, args))
+
+    def _work(self, tasks: queue.Queue):
+        while True:
+            entry = tasks.get()
+            if entry is None or self._stopped:
+                return
+            callback, args = entry
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("Ошибка в таймере %s: %s", getattr(callback, "__name__", callback), e)
@@ -0,0 +1,104 @@
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+# Часовой пояс по language_code, если пользователь не задал его сам
+LANGUAGE_TIMEZONES = {
+    "ru": "Europe/Moscow",
+    "uk": "Europe/Kyiv",
+    "be": "Europe/Minsk",
+    "kk": "Asia/Almaty",
+    "uz": "Asia/Tashkent",
+    "az": "Asia/Baku",
+    "hy": "Asia/Yerevan",
+    "ka": "Asia/Tbilisi",
+    "tr": "Europe/Istanbul",
+    "de": "Europe/Berlin",
+    "fa": "Asia/Tehran",
+    "id": "Asia/Jakarta",
+    "pt-br": "America/Sao_Paulo",
+}
+
+# Волна пользователя: ((user_id % WAVE_BUCKETS) * WAVE_MULTIPLIER) % WAVE_BUCKETS равномерно делит
+# пользователей, то же выражение вычисляется в SQL. Остаток берется до умножения: результат тот же
+# (WAVE_BUCKETS - степень двойки), а произведение меньше 2^32 при любых user_id - без переполнения bigint
+WAVE_MULTIPLIER = 40503
+WAVE_BUCKETS = 65536
+
+
+def valid_timezone(name: str) -> bool:
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+# Окна доставки слота: вместо одного момента слот рассылается волнами по wave_seconds
+# в течение window_minutes, каждому пользователю - в свою постоянную волну.
+# При local_time время слота понимается в часовом поясе пользователя: 10:00 для Москвы
+# и для Берлина - два разных момента по часам сервера. Пояса, у которых слот наступает
+# в один момент (одинаковое смещение от UTC), рассылаются одной частью.
+# Часть слота (part) - пара (кортеж часовых поясов или None без local_time, номер волны).
+class DeliveryWindows:
+    def __init__(self, window_minutes: int = 0, wave_seconds: int = 60, local_time: bool = False,
+                 default_timezone: str = "UTC"):
+        self.wave_step = timedelta(seconds=max(1, wave_seconds))
+        self.waves = max(1, window_minutes * 60 // max(1, wave_seconds))
+        self.local_time = local_time
+        self.default_timezone = default_timezone
+        self.timezones: List[Optional[str]] = [None]
+        self._parts: Dict[Tuple[date, str], List[Tuple[datetime, Tuple[Optional[Tuple[str, ...]], int]]]] = {}
+        self.set_timezones(())
+
+    # Без волн и местного времени слот доставляется целиком в свое время
+    @property
+    def enabled(self) -> bool:
+        return self.waves > 1 or self.local_time
+
+    # Часовые пояса, по которым рассылаются слоты: из LANGUAGE_TIMEZONES, по умолчанию и заданные пользователями
+    def set_timezones(self, explicit: Iterable[str]):
+        self._parts.clear()
+        if not self.local_time:
+            self.timezones = [None]
+            return
+        names = set(LANGUAGE_TIMEZONES.values()) | {self.default_timezone} | set(explicit)
+        self.timezones = sorted(name for name in names if valid_timezone(name))
+        for name in sorted(names - set(self.timezones)):
+            logger.warning("Неизвестный часовой пояс %s пропущен", name)
+
+    def timezone(self, explicit: Optional[str], language_code: Optional[str]) -> Optional[str]:
+        if not self.local_time:
+            return None
+        return explicit or LANGUAGE_TIMEZONES.get((language_code or "").lower(), self.default_timezone)
+
+    def wave(self, user_id: int) -> int:
+        return (user_id % WAVE_BUCKETS) * WAVE_MULTIPLIER % WAVE_BUCKETS * self.waves // WAVE_BUCKETS
+
+    # Момент доставки по часам сервера (без tzinfo, как datetime.now())
+    def delivery_at(self, day: date, slot: str, timezone: Optional[str], wave: int) -> datetime:
+        at = datetime.combine(day, time.fromisoformat(slot))
+        if timezone is not None:
+            at = at.replace(tzinfo=ZoneInfo(timezone)).astimezone().replace(tzinfo=None)
+        return at + wave * self.wave_step
+
+    # Все части слота дня с моментами доставки
+    def parts(self, day: date, slot: str) -> List[Tuple[datetime, Tuple[Optional[Tuple[str, ...]], int]]]:
+        key = (day, slot)
+        if key not in self._parts:
+            # Дни старше вчерашнего относительно запрошенного больше не запрашиваются
+            for stale in [cached for cached in self._parts if cached[0] < day - timedelta(days=2)]:
+                del self._parts[stale]
+            groups: Dict[datetime, List[str]] = {}
+            for timezone in self.timezones:
+                groups.setdefault(self.delivery_at(day, slot, timezone, 0), []).append(timezone)
+            self._parts[key] = [(at + wave * self.wave_step, (tuple(zones) if self.local_time else None, wave))
+                                for at, zones in sorted(groups.items()) for wave in range(self.waves)]
+        return self._parts[key]
+
+    def user_delivery(self, user_id: int, timezone: Optional[str]):
+        wave = self.wave(user_id)
+        return lambda day, slot: self.delivery_at(day, slot, timezone, wave)
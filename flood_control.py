@@ -0,0 +1,80 @@
+import time
+from array import array
+from typing import Callable, Dict, Iterable, Optional
+
+COALESCED = "coalesced"
+THROTTLED = "throttled"
+
+
+# Разбор стоимости маршрутов из строки окружения: "show_stats=3,/claim=2"
+def parse_costs(spec: str) -> Dict[str, float]:
+    costs = {}
+    for item in spec.split(","):
+        route, _, cost = item.partition("=")
+        if route.strip() and cost.strip():
+            costs[route.strip()] = float(cost)
+    return costs
+
+
+# Ограничение частоты обновлений от одного пользователя: token bucket на пользователя
+# (burst токенов, пополнение rate в секунду, маршрут стоит costs[route] или default_cost)
+# в форме GCRA: вместо пары (токены, время) хранится одно число - момент, когда корзина снова полна.
+# Корзины лежат в плоских массивах array по ячейке user_id % slots, без объекта на пользователя:
+# память постоянна (26 байт на ячейку). Ячейка помнит своего пользователя: другой пользователь
+# с той же ячейкой начинает с полной корзины, а не с чужими списаниями и повторами.
+# Повтор того же маршрута чтения (reads) раньше чем через coalesce_seconds после принятого
+# отбрасывается без списания токенов: ответ на первое нажатие уже отправлен.
+# Маршруты exempt (ответ на вопрос, капча) пропускаются всегда: их сообщения несут ответ пользователя.
+# Блокировки нет: при гонке обработчиков пользователь может получить лишний токен.
+class FloodControl:
+    def __init__(self, burst: float = 8.0, rate: float = 1.0, costs: Optional[Dict[str, float]] = None,
+                 default_cost: float = 1.0, reads: Iterable[str] = (), coalesce_seconds: float = 2.0,
+                 exempt: Iterable[str] = (), slots: int = 65537, clock: Callable[[], float] = time.monotonic):
+        self.burst = burst
+        self.rate = rate
+        self.coalesce_seconds = coalesce_seconds
+        self.slots = slots
+        self._clock = clock
+        # Запас корзины в секундах пополнения; стоимости маршрутов тоже в секундах (cost / rate)
+        self._tolerance = burst / rate
+        # Маршрут -> (стоимость, номер маршрута чтения или 0): одна выборка из словаря на обновление
+        read_codes = {route: code for code, route in enumerate(sorted(set(reads)), 1)}
+        self._routes = {route: (cost / rate, read_codes.get(route, 0)) for route, cost in (costs or {}).items()}
+        for route, code in read_codes.items():
+            self._routes.setdefault(route, (default_cost / rate, code))
+        self._default = (default_cost / rate, 0)
+        self._exempt = frozenset(exempt)
+        self._owner = array("q", [0]) * slots
+        self._full_at = array("d", [0.0]) * slots
+        self._last_read = array("H", [0]) * slots
+        self._read_until = array("d", [0.0]) * slots
+
+    # None - обновление пропускается, иначе причина отказа (COALESCED или THROTTLED)
+    def check(self, user_id: int, route: str) -> Optional[str]:
+        i = user_id % self.slots
+        if self._owner[i] != user_id:
+            self._owner[i] = user_id
+            self._full_at[i] = 0.0
+            self._last_read[i] = 0
+        if route in self._exempt:
+            self._last_read[i] = 0
+            return None
+        now = self._clock()
+        cost, read = self._routes.get(route, self._default)
+        if read and self._last_read[i] == read and now < self._read_until[i]:
+            return COALESCED
+        full_at = self._full_at[i]
+        if full_at < now:
+            full_at = now
+        full_at += cost
+        if full_at - now > self._tolerance:
+            return THROTTLED
+        self._full_at[i] = full_at
+        # После изменения (ответ, /claim) следующее чтение уже не повтор
+        self._last_read[i] = read
+        if read:
+            self._read_until[i] = now + self.coalesce_seconds
+        return None
+
+    def memory_bytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in (self._owner, self._full_at, self._last_read, self._read_until))
@@ -0,0 +1,115 @@
+import logging
+import threading
+from typing import Callable, Set
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+LEADER_OBJECT = 0
+
+
+# Выбор ведущего экземпляра через сессионные advisory-блокировки Postgres.
+# Блокировка живет, пока живо соединение: при падении процесса сервер снимает ее сам,
+# а обрыв связи обнаруживается по TCP keepalive (на клиенте и на сервере), после чего
+# лидерство забирает следующий экземпляр при очередной проверке ensure().
+# Ключи: (namespace, 0) - лидер, (namespace + 1, shard) - шарды рассылки.
+class LeaderElection:
+    def __init__(self, connect: Callable, namespace: int, keepalive_seconds: int = 10):
+        self._connect = connect
+        self.namespace = namespace
+        self.keepalive_seconds = keepalive_seconds
+        self.is_leader = False
+        self._conn = None
+        self._shards: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+            self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                # Сервер снимет блокировки примерно через keepalive_seconds * 2 после обрыва связи
+                cur.execute("SET tcp_keepalives_idle = %s;", (self.keepalive_seconds,))
+                cur.execute("SET tcp_keepalives_interval = %s;", (max(1, self.keepalive_seconds // 3),))
+                cur.execute("SET tcp_keepalives_count = 3;")
+        return self._conn
+
+    def _drop_connection(self):
+        if self.is_leader:
+            logger.warning("Лидерство потеряно")
+        self.is_leader = False
+        self._shards.clear()
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    # Продление или захват лидерства. Лидер проверяет живость своего соединения
+    # (пока сессия жива, блокировка за ним), остальные пытаются взять блокировку.
+    def ensure(self) -> bool:
+        with self._lock:
+            try:
+                with self._connection().cursor() as cur:
+                    if self.is_leader:
+                        cur.execute("SELECT 1;")
+                    else:
+                        cur.execute("SELECT pg_try_advisory_lock(%s, %s);", (self.namespace, LEADER_OBJECT))
+                        if cur.fetchone()[0]:
+                            self.is_leader = True
+                            logger.info("Экземпляр стал лидером (блокировка %s)", self.namespace)
+            except psycopg2.Error as e:
+                logger.error("Ошибка соединения выбора лидера: %s", e)
+                self._drop_connection()
+            return self.is_leader
+
+    def try_lock_shard(self, shard: int) -> bool:
+        with self._lock:
+            try:
+                with self._connection().cursor() as cur:
+                    cur.execute("SELECT pg_try_advisory_lock(%s, %s);", (self.namespace + 1, shard))
+                    acquired = cur.fetchone()[0]
+            except psycopg2.Error as e:
+                logger.error("Ошибка блокировки шарда %s: %s", shard, e)
+                self._drop_connection()
+                return False
+            if acquired:
+                self._shards.add(shard)
+            return acquired
+
+    def unlock_shard(self, shard: int):
+        with self._lock:
+            if shard not in self._shards:
+                return
+            self._shards.discard(shard)
+            try:
+                with self._connection().cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s, %s);", (self.namespace + 1, shard))
+            except psycopg2.Error as e:
+                logger.error("Ошибка снятия блокировки шарда %s: %s", shard, e)
+                self._drop_connection()
+
+    # Добровольная передача лидерства (остановка экземпляра)
+    def release(self):
+        with self._lock:
+            self._drop_connection()
+
+
+# Один экземпляр на встроенной базе (STORAGE_BACKEND=sqlite): он всегда лидер и берет все шарды
+class SingleInstanceElection:
+    def __init__(self):
+        self.is_leader = True
+
+    def ensure(self) -> bool:
+        return True
+
+    def try_lock_shard(self, shard: int) -> bool:
+        return True
+
+    def unlock_shard(self, shard: int):
+        pass
+
+    def release(self):
+        pass
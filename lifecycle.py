@@ -0,0 +1,71 @@
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Остановка экземпляра по SIGTERM/SIGINT за ограниченное время (deadline_seconds).
+# По сигналу сразу выставляется stopping и вызываются on_stop (прекращение приема обновлений),
+# длинные задачи сами проверяют stopping и останавливаются в точке, с которой их можно продолжить.
+# Затем shutdown() по порядку выполняет шаги; каждый получает время, оставшееся до срока,
+# и не должен ждать дольше него. Ошибка шага не отменяет следующие.
+# Повторный сигнал во время остановки завершает процесс немедленно.
+class Lifecycle:
+    def __init__(self, deadline_seconds: float = 25.0):
+        self.deadline_seconds = deadline_seconds
+        self.stopping = threading.Event()
+        self._on_stop: List[Callable[[], None]] = []
+        self._steps: List[Tuple[str, Callable[[float], None]]] = []
+        self._deadline: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def on_stop(self, callback: Callable[[], None]):
+        self._on_stop.append(callback)
+
+    def add_step(self, name: str, step: Callable[[float], None]):
+        self._steps.append((name, step))
+
+    # Только из главного потока (ограничение signal.signal)
+    def install_signal_handlers(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        for signum in signals:
+            signal.signal(signum, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        if self.stopping.is_set():
+            logger.warning("Повторный сигнал %s: немедленный выход", signal.Signals(signum).name)
+            os._exit(1)
+        self.request_stop(signal.Signals(signum).name)
+
+    def request_stop(self, reason: str):
+        with self._lock:
+            if self.stopping.is_set():
+                return
+            self._deadline = time.monotonic() + self.deadline_seconds
+            self.stopping.set()
+        logger.info("Остановка (%s), срок %.0f с", reason, self.deadline_seconds)
+        for callback in self._on_stop:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Ошибка при остановке (%s): %s", getattr(callback, "__name__", callback), e)
+
+    def remaining(self) -> float:
+        if self._deadline is None:
+            return self.deadline_seconds
+        return max(0.0, self._deadline - time.monotonic())
+
+    def shutdown(self):
+        self.request_stop("завершение работы")
+        for name, step in self._steps:
+            started = time.monotonic()
+            try:
+                step(self.remaining())
+            except Exception as e:
+                logger.error("Ошибка шага остановки «%s»: %s", name, e)
+            logger.info("Остановка: %s (%.2f с)", name, time.monotonic() - started)
+        if self.remaining() <= 0:
+            logger.warning("Остановка не уложилась в %.0f с", self.deadline_seconds)
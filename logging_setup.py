@@ -0,0 +1,198 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time as time_module
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Стандартные атрибуты LogRecord; все остальное считается структурированными полями (extra=...)
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "suppressed"}
+
+
+# Обработчик очереди без форматирования в вызывающем потоке:
+# сообщение собирается только в фоновом потоке записи. При переполнении очереди
+# запись отбрасывается, а не блокирует поток обработчика.
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Ограничение частоты одинаковых сообщений: не больше burst за interval секунд на шаблон.
+# Количество подавленных записей добавляется к первой записи следующего окна, а если шаблон
+# больше не встречается - забирается take_suppressed для отдельной сводки.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst: int = 20, interval: float = 60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows: Dict[Tuple[str, int, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, str(record.msg))
+        now = time_module.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    # Закончившиеся окна (all_windows - все) удаляются; возвращает подавленные в них записи:
+    # [(логгер, уровень, шаблон, подавлено)]
+    def take_suppressed(self, all_windows: bool = False) -> List[Tuple[str, int, str, int]]:
+        now = time_module.monotonic()
+        taken = []
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                if all_windows or now - window[0] >= self.interval:
+                    del self._windows[key]
+                    if window[2]:
+                        taken.append(key + (window[2],))
+        return taken
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" [+{suppressed} похожих сообщений подавлено]"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            payload["suppressed"] = suppressed
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+# Сводка однотипных ошибок вместо строки на каждую: "412 отправок не удалось: Forbidden"
+class ErrorAggregator:
+    def __init__(self, logger: logging.Logger, what: str, samples: int = 3):
+        self.logger = logger
+        self.what = what
+        self.samples = samples
+        self._counts: Dict[str, int] = {}
+        self._examples: Dict[str, list] = {}
+
+    def add(self, error: BaseException, subject=None):
+        kind = getattr(error, "description", None) or f"{type(error).__name__}: {error}"
+        self._counts[kind] = self._counts.get(kind, 0) + 1
+        examples = self._examples.setdefault(kind, [])
+        if subject is not None and len(examples) < self.samples:
+            examples.append(subject)
+
+    @property
+    def total(self) -> int:
+        return sum(self._counts.values())
+
+    def flush(self):
+        for kind, count in sorted(self._counts.items(), key=lambda item: item[1], reverse=True):
+            self.logger.error(
+                "%d %s не удалось: %s (например: %s)",
+                count, self.what, kind, self._examples.get(kind) or "-",
+                extra={"failed": count, "kind": kind},
+            )
+        self._counts.clear()
+        self._examples.clear()
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[LazyQueueHandler] = None
+_rate_filter: Optional[RateLimitFilter] = None
+_flusher: Optional[threading.Thread] = None
+_flusher_stop = threading.Event()
+
+
+# Сводка по шаблонам, подавленным в закончившихся окнах: одна запись на шаблон, мимо фильтра
+def _emit_suppressed(all_windows: bool = False):
+    for name, levelno, template, count in _rate_filter.take_suppressed(all_windows):
+        record = logging.getLogger(name).makeRecord(name, levelno, "", 0, "Повторы сообщения подавлены: %s",
+                                                    (template,), None)
+        record.suppressed = count
+        _queue_handler.emit(record)
+
+
+def _flush_suppressed(interval: float):
+    while not _flusher_stop.wait(interval):
+        _emit_suppressed()
+
+
+# Настройка корневого логгера: очередь в вызывающих потоках, запись в stderr - в фоновом потоке.
+# log_format: "text" или "json".
+def setup_logging(level: int = logging.INFO, log_format: str = "text", burst: int = 20,
+                  interval: float = 60.0, queue_size: int = 10000) -> QueueListener:
+    global _listener, _queue_handler, _rate_filter, _flusher
+    if _listener is not None:
+        return _listener
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    _queue_handler = LazyQueueHandler(log_queue)
+    _rate_filter = RateLimitFilter(burst=burst, interval=interval)
+    _queue_handler.addFilter(_rate_filter)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_queue_handler]
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    _flusher_stop.clear()
+    _flusher = threading.Thread(target=_flush_suppressed, args=(interval,), name="log-suppressed", daemon=True)
+    _flusher.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+# Остановка фонового потока с дозаписью очереди и сводкой по всем подавленным записям
+def shutdown_logging():
+    global _listener, _flusher
+    if _flusher is not None:
+        _flusher_stop.set()
+        _flusher.join()
+        _flusher = None
+        _emit_suppressed(all_windows=True)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
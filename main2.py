@@ -1,11 +1,15 @@
+import functools
+import gc
 import json
 import logging
 import os
 import random
+import socket
 import threading
 import time as time_module
-from datetime import datetime
-from typing import Dict, Any
+from datetime import date, datetime, time as time_of_day
+from typing import Dict, Any, Optional
+from zoneinfo import ZoneInfo
 from PIL import Image, ImageDraw, ImageFont
 import io
 import string
@@ -15,19 +19,51 @@ import schedule
 from dotenv import load_dotenv
 from telebot import TeleBot, types
 
+from airdrop_assignment import HashedAssigner, parse_slot_payload, requires_captcha, slot_key, slot_payload
+from answer_matching import AnswerMatcher
+from answered_tasks import AnsweredTasks
+from airdrop_scheduler import RESUME_PAYLOAD, TIMEZONE_PAYLOAD, SlotScheduler
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from db_profiler import QueryProfiler
+from deadline_timers import DeadlineTimers
+from flood_control import FloodControl, parse_costs
+from delivery_windows import DeliveryWindows, valid_timezone
+from leader_election import LeaderElection, SingleInstanceElection
+from lifecycle import Lifecycle
+from logging_setup import ErrorAggregator, setup_logging, shutdown_logging
+from metrics import (DELIVERY_QUEUE_DEPTH, FANOUT_SECONDS, FANOUT_USERS, MESSAGES_SENT, PENDING_SWEPT,
+                     PENDING_TIMERS, REGISTRY, UPDATES_DROPPED, Gauge, observe_route, start_metrics_server)
+from router import Router, extract_payload
+from session_journal import SessionJournal
+from skill_rating import SkillModel
+from task_bank import TaskBank
+from sqlite_storage import SqliteStorage
+from storage import NO_PART, PostgresStorage
+from ui_assets import (DEFAULT_LOCALE, button_labels, force_reply, level_name, link_keyboard,
+                       main_keyboard, render, resolve_locale)
+from write_spool import WriteSpool
+
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
+# Настройка логирования: запись в фоновом потоке, LOG_FORMAT=json для структурированного вывода
+setup_logging(
+    level=logging.INFO,
+    log_format=os.getenv("LOG_FORMAT", "text"),
+    burst=int(os.getenv("LOG_BURST", "20")),
 )
 logger = logging.getLogger(__name__)
 
 # Инициализация бота
 bot = TeleBot(os.getenv("TELEGRAM_TOKEN"))
 
+ADMIN_IDS = [12345678, 87654321]  # Замените на реальные ID админов
+
+# Остановка по SIGTERM за SHUTDOWN_DEADLINE_SECONDS: прием обновлений прекращается сразу,
+# поэтому POLL_TIMEOUT_SECONDS (long polling) должен быть заметно меньше срока остановки
+lifecycle = Lifecycle(float(os.getenv("SHUTDOWN_DEADLINE_SECONDS", "25")))
+POLL_TIMEOUT_SECONDS = int(os.getenv("POLL_TIMEOUT_SECONDS", "5"))
+
 
 # Подключение к PostgreSQL
 def get_db_connection():
@@ -41,12 +77,53 @@ def get_db_connection():
         )
         return conn
     except psycopg2.Error as e:
-        logger.error(f"Ошибка подключения к базе данных: {e}")
+        logger.error("Ошибка подключения к базе данных: %s", e)
         raise
 
 
-conn = get_db_connection()
-cur = conn.cursor()
+profiler = QueryProfiler(
+    slow_threshold_ms=float(os.getenv("SLOW_QUERY_MS", "100")),
+    explain_sample_rate=float(os.getenv("EXPLAIN_SAMPLE_RATE", "0")),
+)
+
+# Работа без БД: после DB_FAILURE_THRESHOLD ошибок соединения подряд запросы не отправляются
+# DB_RETRY_SECONDS, затем пробный запрос переподключается. Ответы на вопросы за это время
+# пишутся в локальный журнал WRITE_SPOOL (fsync) и отправляются пачками после восстановления.
+breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("DB_FAILURE_THRESHOLD", "3")),
+    reset_seconds=float(os.getenv("DB_RETRY_SECONDS", "5")),
+)
+spool = WriteSpool(os.getenv("WRITE_SPOOL", "writes.spool"))
+SPOOL_REPLAY_SECONDS = int(os.getenv("SPOOL_REPLAY_SECONDS", "5"))
+SPOOL_REPLAY_BATCH = 500
+REGISTRY.register(Gauge(
+    "bot_db_circuit_open", "1, если запросы к БД приостановлены", callback=lambda: 1 if breaker.is_open else 0
+))
+REGISTRY.register(Gauge(
+    "bot_write_spool_records", "Записи, ожидающие отправки в БД", callback=lambda: len(spool)
+))
+
+
+# Все запросы к БД - через интерфейс хранилища (storage.py). STORAGE_BACKEND=postgres (по умолчанию) -
+# PostgreSQL, соединение открывается при первом запросе; sqlite - встроенная база SQLITE_PATH
+# для одного экземпляра (без выбора лидера и NOTIFY между экземплярами)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+if STORAGE_BACKEND == "sqlite":
+    storage = SqliteStorage(os.getenv("SQLITE_PATH", "airdrop.db"))
+elif STORAGE_BACKEND == "postgres":
+    storage = PostgresStorage(get_db_connection, profiler, breaker)
+else:
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+DB_ERRORS = storage.errors
+DB_CONNECTION_ERRORS = storage.connection_errors
+
+
+def commit():
+    storage.commit()
+
+
+def rollback():
+    storage.rollback()
 
 
 # Загрузка задач
@@ -61,7 +138,7 @@ def load_tasks():
                     tasks[level] = []
                 for task in tasks[level]:
                     if "question" not in task or "answer" not in task:
-                        logger.warning(f"Некорректная задача в уровне {level}")
+                        logger.warning("Некорректная задача в уровне %s", level)
 
             return tasks
     except FileNotFoundError:
@@ -72,12 +149,184 @@ def load_tasks():
         return {"легкий": [], "средний": [], "сложный": []}
 
 
-TASKS = load_tasks()
+# Задачи: task_data.json целиком в памяти процесса или банк TASK_BANK (собирается build_task_bank.py),
+# открытый через mmap: процессы делят страницы файла, задача читается при обращении.
+# Ответ засчитывается без учета регистра, пунктуации, ё/е и записи числа словами;
+# "aliases" задачи в task_data.json - другие допустимые ответы
+TASK_BANK = os.getenv("TASK_BANK", "")
+if TASK_BANK:
+    task_bank = TaskBank(TASK_BANK)
+    TASKS = task_bank.levels
+    TASK_INDEX = None
+    matcher = task_bank
+else:
+    task_bank = None
+    TASKS = load_tasks()
+    TASK_INDEX = {(level, task["question"]): task for level, level_tasks in TASKS.items() for task in level_tasks}
+    matcher = AnswerMatcher(TASKS)
+
+
+# Задача по уровню и тексту вопроса или None
+def find_task(level: str, question: str) -> Optional[Dict[str, Any]]:
+    if task_bank is not None:
+        return task_bank.find(level, question)
+    return TASK_INDEX.get((level, question))
+
+LEDGER_ROLLUP_SECONDS = int(os.getenv("LEDGER_ROLLUP_SECONDS", "60"))
+LEDGER_ROLLUP_BATCH = int(os.getenv("LEDGER_ROLLUP_BATCH", "5000"))
+
+# Адаптивная сложность: рейтинги Эло пользователей и вопросов
+ADAPTIVE_DIFFICULTY = os.getenv("ADAPTIVE_DIFFICULTY", "1") == "1"
+SKILL_FLUSH_SECONDS = int(os.getenv("SKILL_FLUSH_SECONDS", "60"))
+# Таблицы выбора вопроса по рейтингу перестраиваются в начале рассылки и раз в SKILL_REFRESH_SECONDS,
+# а не после каждого ответа
+SKILL_REFRESH_SECONDS = int(os.getenv("SKILL_REFRESH_SECONDS", "300"))
+# С банком задач модель работает по индексам задач банка и не декодирует задачи при запуске
+skills = SkillModel(task_bank if task_bank is not None else TASKS,
+                    target_success=float(os.getenv("TARGET_SUCCESS", "0.7")))
+
+# Отвеченные задачи пользователей по индексу задачи (task_id модели навыков):
+# выбор неотвеченного вопроса без запроса к user_answers. Хранятся в user_answered_tasks с отпечатком
+# каталога; после изменения вопросов в task_data.json строятся заново из истории ответов
+answered_tasks = AnsweredTasks(skills.size)
+TASK_CATALOG = skills.catalog
+LEVEL_FIRST_TASK = {level: task_ids.start for level, task_ids in skills.level_ranges.items() if task_ids}
+answered_synced_at = None  # updated_at последнего прочитанного набора
+
+# Награды из task_calibration (заполняется calibrate_tasks.py) вместо заданных вручную
+CALIBRATED_REWARDS = os.getenv("CALIBRATED_REWARDS", "0") == "1"
+task_calibration: Dict[tuple, int] = {}
+
+# Политика рассылки: пользователи без активности DORMANT_DAYS дней (0 - не исключать)
+# и заблокировавшие бота не получают airdrop
+DORMANT_DAYS = int(os.getenv("DORMANT_DAYS", "30"))
+LAST_SEEN_INTERVAL = int(os.getenv("LAST_SEEN_INTERVAL", "300"))
+last_seen_written: Dict[int, float] = {}  # Когда last_seen пользователя последний раз записан в БД
+
+# Невостребованные airdrop сгорают через PENDING_TTL_MINUTES, за REMINDER_BEFORE_MINUTES до этого
+# пользователю отправляется одно напоминание (не больше REMINDER_RATE сообщений в секунду)
+PENDING_TTL_MINUTES = int(os.getenv("PENDING_TTL_MINUTES", "180"))
+REMINDER_BEFORE_MINUTES = int(os.getenv("REMINDER_BEFORE_MINUTES", "30"))
+SWEEP_SECONDS = int(os.getenv("SWEEP_SECONDS", "60"))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "20"))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "1000"))
+reminder_thread: Optional[threading.Thread] = None  # отправка напоминаний последнего прохода очистки
+
+# Сколько выданных airdrop записывается в pending_airdrops одной вставкой
+FANOUT_BATCH = int(os.getenv("FANOUT_BATCH", "500"))
+
+# ASSIGNMENT_MODE=hashed: лимит, уровень и вопрос вычисляются из хеша (user_id, дата, слот),
+# рассылка не пишет выдачу в БД, а /claim пересчитывает ее и отмечает забранный слот в airdrop_claims
+HASHED_ASSIGNMENT = os.getenv("ASSIGNMENT_MODE", "stored") == "hashed"
+HASHED_FANOUT_PAGE = 10000
+assigner = HashedAssigner(os.getenv("ASSIGNMENT_SECRET", "").encode("utf-8"))
+if HASHED_ASSIGNMENT and not assigner.secret:
+    logger.warning("ASSIGNMENT_SECRET не задан: выдачу airdrop можно предсказать по user_id")
+
+# DELIVERY_MODE=channel: вместо личного сообщения каждому пользователю в слот публикуется одно
+# объявление в BROADCAST_CHANNEL со ссылкой t.me/<bot>?start=drop_<слот>, airdrop выдается при заборе
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "dm")
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "")
+BROADCAST_LOCALE = os.getenv("BROADCAST_LOCALE", DEFAULT_LOCALE)
+BOT_USERNAME = os.getenv("BOT_USERNAME", "")
+if DELIVERY_MODE == "channel" and not BROADCAST_CHANNEL:
+    logger.warning("DELIVERY_MODE=channel, но BROADCAST_CHANNEL не задан: объявления публиковаться не будут")
+
+# Несколько экземпляров бота: рассылки и очистку выполняет только лидер (advisory-блокировка в БД).
+# SHARD_COUNT > 1 делит рассылку режима stored между экземплярами по user_id % SHARD_COUNT.
+election = (LeaderElection(get_db_connection, int(os.getenv("LEADER_LOCK_ID", "730501")))
+            if STORAGE_BACKEND == "postgres" else SingleInstanceElection())
+LEADER_CHECK_SECONDS = int(os.getenv("LEADER_CHECK_SECONDS", "10"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# Слоты, пропущенные не больше чем на SLOT_CATCHUP_MINUTES (перезапуск, скачок часов), запускаются с опозданием
+SLOT_CATCHUP_MINUTES = int(os.getenv("SLOT_CATCHUP_MINUTES", "30"))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+WHOLE_SLOT = -1  # shard в airdrop_runs для рассылки без шардирования
+paused_runs = []  # запуски, приостановленные при остановке экземпляра
+
+# Окна доставки: слот рассылается волнами по DELIVERY_WAVE_SECONDS в течение DELIVERY_WINDOW_MINUTES,
+# при LOCAL_TIME_SLOTS=1 время слота - местное для пользователя (users.timezone или по language_code,
+# иначе DEFAULT_TIMEZONE). В режиме channel объявление одно, окна не применяются.
+windows = DeliveryWindows(
+    window_minutes=int(os.getenv("DELIVERY_WINDOW_MINUTES", "0")),
+    wave_seconds=int(os.getenv("DELIVERY_WAVE_SECONDS", "60")),
+    local_time=os.getenv("LOCAL_TIME_SLOTS", "0") == "1",
+    default_timezone=os.getenv("DEFAULT_TIMEZONE", "UTC"),
+)
+
+
+# Фильтр пользователей части слота (часовые пояса, волна) для рассылки.
+# Без части (ручной запуск, окна выключены) фильтр пропускает всех.
+def delivery_filter(part):
+    if part is None:
+        return NO_PART
+    zones, wave = part
+    return zones, windows.default_timezone, wave, windows.waves
+
+
+# Ключ запуска в airdrop_runs: слот и часть - смещение поясов части от UTC (состав поясов с одним
+# смещением может меняться по мере того, как пользователи задают /timezone) и волна
+def run_key(day: date, slot: str, part) -> str:
+    key = slot_key(day, slot)
+    if part is None:
+        return key
+    zones, wave = part
+    if zones is None:
+        return f"{key} - #{wave}"
+    at = datetime.combine(day, time_of_day.fromisoformat(slot)).replace(tzinfo=ZoneInfo(zones[0]))
+    return f"{key} {at.strftime('%z')} #{wave}"
+
+
+REGISTRY.register(Gauge(
+    "bot_is_leader", "1, если экземпляр выполняет рассылки", callback=lambda: 1 if election.is_leader else 0
+))
 
 # Состояния пользователей
 user_states: Dict[int, Dict[str, Any]] = {}
 user_captchas = {}  # Для хранения капч пользователей
-captcha_attempts = {}  # Для хранения попыток ввода капчи
+
+# Вопросы и капчи в процессе дублируются в журнал на диске и восстанавливаются при запуске,
+# сроки ответа и капчи отслеживаются одним потоком таймеров, обработчики сроков - пулом TIMER_WORKERS потоков
+journal = SessionJournal(os.getenv("SESSION_JOURNAL", "sessions.journal"),
+                         fsync=os.getenv("SESSION_FSYNC", "0") == "1")
+timers = DeadlineTimers(workers=int(os.getenv("TIMER_WORKERS", "4")))
+ANSWER_SECONDS = 20
+CAPTCHA_TTL_SECONDS = int(os.getenv("CAPTCHA_TTL_SECONDS", "600"))
+
+# Маршрутизация сообщений по команде, тексту кнопки и состоянию пользователя
+router = Router(lambda user_id: user_states.get(user_id, {}).get("state"))
+router.add_observer(observe_route)
+
+# Ограничение частоты по пользователю до вызова обработчика: FLOOD_BURST сообщений подряд,
+# затем FLOOD_RATE в секунду; FLOOD_COSTS - стоимость маршрутов ("show_stats=2,/claim=2").
+# Повторные нажатия "Баланс", "Статистика" и "Помощь" в течение FLOOD_COALESCE_SECONDS отбрасываются.
+# Ответы на вопрос airdrop и на капчу не ограничиваются.
+flood = FloodControl(
+    burst=float(os.getenv("FLOOD_BURST", "8")),
+    rate=float(os.getenv("FLOOD_RATE", "1")),
+    costs=parse_costs(os.getenv("FLOOD_COSTS", "show_stats=2,/claim=2,claim_airdrop=2")),
+    reads=("show_balance", "show_stats", "show_help"),
+    coalesce_seconds=float(os.getenv("FLOOD_COALESCE_SECONDS", "2")),
+    exempt=("AWAITING_AIRDROP_ANSWER", "AWAITING_CAPTCHA"),
+)
+
+
+# Отброшенные сообщения остаются без ответа, чтобы не тратить на них отправку
+def admit_update(user_id: int, route: str) -> bool:
+    reason = flood.check(user_id, route)
+    if reason is None:
+        return True
+    UPDATES_DROPPED.inc(route, reason)
+    return False
+
+
+if os.getenv("FLOOD_CONTROL", "1") == "1":
+    router.set_admission(admit_update)
+
+REGISTRY.register(Gauge(
+    "bot_active_sessions", "Пользователи в состоянии ожидания капчи или ответа",
+    callback=lambda: sum(1 for state in list(user_states.values()) if state.get("state") != "MAIN_MENU")
+))
 
 
 # Функция для генерации капчи
@@ -116,18 +365,11 @@ def generate_captcha():
     return captcha_text, img_byte_arr
 
 
-# Клавиатуры
-def create_main_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.row("Баланс", "Статистика", "Помощь")
-    markup.row("Claim Airdrop")
-    return markup
-
-
 # Команда /start с проверкой на мультиаккаунты
-@bot.message_handler(commands=['start'])
+@router.command("start")
 def start(message: types.Message):
     user = message.from_user
+    locale = resolve_locale(user.language_code)
     try:
         # Получаем информацию об устройстве
         device_info = {
@@ -136,75 +378,50 @@ def start(message: types.Message):
             'client_type': 'mobile' if message.via_bot else 'desktop'
         }
 
-        # Проверяем на мультиаккаунты перед регистрацией
-        cur.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE device_fingerprint::json->>'language_code' = %s 
-            AND is_suspicious = FALSE
-            LIMIT 5;
-        """, (device_info.get('language_code'),))
-        similar_users_count = cur.fetchone()[0]
-
-        is_suspicious = similar_users_count >= 3  # Если 3+ аккаунта с одинаковым language_code
-
-        cur.execute("SELECT * FROM users WHERE user_id = %s;", (user.id,))
-        if cur.fetchone() is None:
-            cur.execute(
-                """INSERT INTO users 
-                (user_id, username, first_name, last_name, balance, require_captcha, 
-                 device_fingerprint, is_suspicious) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""",
-                (user.id, user.username, user.first_name, user.last_name, 0, False,
-                 json.dumps(device_info), is_suspicious),
-            )
-            conn.commit()
+        # Регистрация с проверкой на мультиаккаунты (3+ аккаунта с одинаковым language_code)
+        is_suspicious = storage.register_user(user.id, user.username, user.first_name, user.last_name, device_info)
+        if is_suspicious is not None:
+            commit()
 
             if is_suspicious:
                 bot.send_message(
                     message.chat.id,
-                    "⚠️ Ваш аккаунт помечен как подозрительный. "
-                    "Доступ к некоторым функциям может быть ограничен.",
-                    reply_markup=create_main_keyboard(),
+                    render("suspicious", locale),
+                    reply_markup=main_keyboard(locale),
                 )
             else:
                 bot.send_message(
                     message.chat.id,
-                    f"Привет, {user.first_name}! Вы успешно зарегистрированы. "
-                    f"Теперь вы будете получать ежедневные airdrop с вопросами разной сложности. "
-                    f"Используйте команду /claim чтобы получить вопрос, когда придет уведомление.",
-                    reply_markup=create_main_keyboard(),
+                    render("welcome", locale, first_name=user.first_name),
+                    reply_markup=main_keyboard(locale),
                 )
         else:
             bot.send_message(
                 message.chat.id,
-                f"С возвращением, {user.first_name}!",
-                reply_markup=create_main_keyboard(),
+                render("welcome_back", locale, first_name=user.first_name),
+                reply_markup=main_keyboard(locale),
             )
-        user_states[user.id] = {"state": "MAIN_MENU"}
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
-        bot.send_message(message.chat.id, "Произошла ошибка. Попробуйте позже.")
+        end_session(user.id)
+
+        # Переход по ссылке из объявления: t.me/<bot>?start=drop_<слот>
+        payload = extract_payload(message.text)
+        if payload and payload.startswith("drop_"):
+            start_claim(user.id, message.chat.id, locale, payload)
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД: %s", e)
+        bot.send_message(message.chat.id, render("generic_error", locale))
 
 
 # Команда для админов для проверки подозрительных аккаунтов
-@bot.message_handler(commands=['check_multis'])
+@router.command("check_multis")
 def check_multis(message: types.Message):
     # Проверяем, является ли пользователь админом
-    if message.from_user.id not in [12345678, 87654321]:  # Замените на реальные ID админов
+    if message.from_user.id not in ADMIN_IDS:
         bot.send_message(message.chat.id, "У вас нет прав на эту команду.")
         return
 
     try:
-        cur.execute("""
-            SELECT user_id, username, first_name, last_name, 
-                   device_fingerprint::json->>'language_code' as lang,
-                   registered_at
-            FROM users
-            WHERE is_suspicious = TRUE
-            ORDER BY registered_at DESC
-            LIMIT 20;
-        """)
-        suspicious_users = cur.fetchall()
+        suspicious_users = storage.suspicious_users(20)
 
         if not suspicious_users:
             bot.send_message(message.chat.id, "Нет подозрительных аккаунтов.")
@@ -221,42 +438,81 @@ def check_multis(message: types.Message):
 
         bot.send_message(message.chat.id, response)
 
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД: %s", e)
         bot.send_message(message.chat.id, "Ошибка при получении данных.")
 
 
+# Команда для админов: статистика и планы медленных SQL-запросов
+@router.command("slow_queries")
+def slow_queries(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        bot.send_message(message.chat.id, "У вас нет прав на эту команду.")
+        return
+
+    report = profiler.report()
+    # Ограничение Telegram - 4096 символов на сообщение
+    for offset in range(0, len(report), 4000):
+        bot.send_message(message.chat.id, report[offset:offset + 4000])
+
+
+# Команда /timezone [Europe/Moscow]: часовой пояс, по местному времени которого приходят airdrop
+@router.command("timezone")
+def set_timezone(message: types.Message):
+    user = message.from_user
+    locale = resolve_locale(user.language_code)
+    timezone = extract_payload(message.text)
+    try:
+        if timezone is None:
+            current = windows.timezone(storage.user_timezone(user.id), user.language_code) or windows.default_timezone
+            bot.send_message(message.chat.id, render("timezone_current", locale, timezone=current))
+            return
+        if not valid_timezone(timezone):
+            bot.send_message(message.chat.id, render("timezone_invalid", locale, timezone=timezone))
+            return
+        storage.set_user_timezone(user.id, timezone)
+        # Новый часовой пояс добавляется в расписание при перечитывании (NOTIFY планировщикам всех экземпляров)
+        notify = windows.local_time and timezone not in windows.timezones
+        if notify:
+            storage.notify_scheduler(TIMEZONE_PAYLOAD)
+        commit()
+        if notify:
+            slot_scheduler.notify(TIMEZONE_PAYLOAD)
+        bot.send_message(message.chat.id, render("timezone_set", locale, timezone=timezone))
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД: %s", e)
+        rollback()
+        bot.send_message(message.chat.id, render("generic_error", locale))
+
+
 # Команда /claim для получения airdrop с проверкой на подозрительные аккаунты
-@bot.message_handler(commands=['claim'])
-@bot.message_handler(func=lambda message: message.text.lower() == "claim airdrop")
+@router.command("claim")
+@router.text(*button_labels("claim"))
 def claim_airdrop(message: types.Message):
-    user_id = message.from_user.id
+    locale = resolve_locale(message.from_user.language_code)
+    start_claim(message.from_user.id, message.chat.id, locale, extract_payload(message.text))
+
+
+# Забор airdrop: из очереди, по хешу или лениво по объявлению в канале.
+# payload - параметр deep link "drop_<слот>", ограничивает забор этим слотом.
+def start_claim(user_id: int, chat_id: int, locale: str, payload: Optional[str] = None):
+    only_slot = parse_slot_payload(payload)
     try:
-        # Проверяем, не помечен ли аккаунт как подозрительный
-        cur.execute("SELECT is_suspicious FROM users WHERE user_id = %s;", (user_id,))
-        is_suspicious = cur.fetchone()[0]
-
-        if is_suspicious:
-            # Для подозрительных аккаунтов всегда требуем капчу
-            cur.execute("""
-                UPDATE users 
-                SET require_captcha = TRUE
-                WHERE user_id = %s;
-            """, (user_id,))
-            conn.commit()
-
-        cur.execute("""
-            SELECT pending_airdrop_level, pending_airdrop_question, require_captcha 
-            FROM users 
-            WHERE user_id = %s;
-        """, (user_id,))
-        result = cur.fetchone()
-
-        if not result or not result[0]:
+        if HASHED_ASSIGNMENT:
+            result = claim_hashed_airdrop(user_id, only_slot)
+        else:
+            # Забираем самый старый airdrop из очереди пользователя одной операцией.
+            # Для подозрительных аккаунтов капча требуется всегда.
+            result = storage.pop_pending_airdrop(user_id)
+            if result is None and DELIVERY_MODE == "channel":
+                result = claim_broadcast_airdrop(user_id, only_slot)
+        commit()
+
+        if not result:
             bot.send_message(
-                message.chat.id,
-                "У вас нет доступных airdrop. Ожидайте следующего уведомления.",
-                reply_markup=create_main_keyboard()
+                chat_id,
+                render("no_airdrop", locale),
+                reply_markup=main_keyboard(locale)
             )
             return
 
@@ -269,79 +525,230 @@ def claim_airdrop(message: types.Message):
             user_captchas[user_id] = {
                 "text": captcha_text,
                 "level": level,
-                "question": question_text
+                "question": question_text,
+                "locale": locale,
+                "expire_time": time_module.time() + CAPTCHA_TTL_SECONDS
             }
+            user_states[user_id] = {"state": "AWAITING_CAPTCHA"}
+            save_session(user_id)
 
             bot.send_photo(
-                message.chat.id,
+                chat_id,
                 captcha_image,
-                caption="Пожалуйста, введите текст с изображения для подтверждения:"
+                caption=render("captcha_prompt", locale)
             )
             return
 
         # Если капча не требуется или уже пройдена
-        process_airdrop_question(user_id, level, question_text)
+        process_airdrop_question(user_id, level, question_text, locale)
 
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД: %s", e)
+        rollback()
         bot.send_message(
-            message.chat.id,
-            "Произошла ошибка при обработке запроса.",
-            reply_markup=create_main_keyboard()
+            chat_id,
+            render("claim_error", locale),
+            reply_markup=main_keyboard(locale)
         )
 
 
-# Остальные функции остаются без изменений
-def process_airdrop_question(user_id: int, level: str, question_text: str):
-    tasks = TASKS.get(level, [])
-    task = None
+# Открытые для забора слоты (от старых к новым), при only_slot - только он.
+# delivery - момент доставки слота пользователю (окна доставки), по умолчанию - время слота.
+def open_claim_slots(only_slot=None, delivery=None):
+    slots = assigner.open_slots(datetime.now(), PENDING_TTL_MINUTES, delivery)
+    if only_slot is not None:
+        slots = [slot for slot in slots if slot == only_slot]
+    return slots
+
+
+# Отметка о заборе первого еще не забранного слота из keys (атомарно, повторный /claim его не получит).
+# Возвращает ключ слота или None.
+def record_airdrop_claim(user_id: int, keys) -> Optional[str]:
+    return storage.record_claim(user_id, list(keys))
+
+
+# Забор airdrop в режиме hashed: открытые слоты пользователя пересчитываются по хешу,
+# самый старый незабранный отмечается в airdrop_claims.
+# Возвращает (уровень, вопрос, нужна ли капча) или None.
+def claim_hashed_airdrop(user_id: int, only_slot=None):
+    row = storage.claim_profile(user_id)
+    if row is None:
+        return None
+    is_suspicious, timezone, language_code = row
+    # Слот открывается пользователю не раньше, чем ему приходит уведомление
+    delivery = windows.user_delivery(user_id, windows.timezone(timezone, language_code))
+
+    candidates = {}
+    for day, slot in open_claim_slots(only_slot, delivery):
+        number = assigner.airdrop_number(user_id, day, slot, is_suspicious)
+        if number is not None:
+            candidates[slot_key(day, slot)] = (day, slot, number)
+    if not candidates:
+        return None
+
+    claimed = record_airdrop_claim(user_id, candidates)
+    if claimed is None:
+        return None
+    day, slot, number = candidates[claimed]
+
+    level = assigner.level(user_id, day, slot)
+    task = assigner.task(user_id, day, slot, TASKS.get(level, []), answered_tasks.get(user_id),
+                         LEVEL_FIRST_TASK.get(level, 0))
+    if task is None:
+        return None
+    return level, task["question"], requires_captcha(number, is_suspicious)
+
+
+# Ленивая выдача в режиме channel: airdrop выбирается в момент забора, а не при рассылке.
+# Возвращает (уровень, вопрос, нужна ли капча) или None.
+def claim_broadcast_airdrop(user_id: int, only_slot=None):
+    slots = open_claim_slots(only_slot)
+    if not slots:
+        return None
+    picked = pick_airdrop(user_id)
+    if picked is None:
+        return None
+    level, task, require_captcha = picked[:3]
+    if record_airdrop_claim(user_id, [slot_key(day, slot) for day, slot in slots]) is None:
+        return None
+    storage.count_claim(user_id)
+    return level, task["question"], require_captcha
 
-    for t in tasks:
-        if t["question"] == question_text:
-            task = t
-            break
+
+# Остальные функции остаются без изменений
+def process_airdrop_question(user_id: int, level: str, question_text: str, locale: str = DEFAULT_LOCALE):
+    task = find_task(level, question_text)
 
     if not task:
+        end_session(user_id)
         bot.send_message(
             user_id,
-            "Произошла ошибка при получении вопроса. Ожидайте следующего airdrop.",
-            reply_markup=create_main_keyboard()
+            render("question_error", locale),
+            reply_markup=main_keyboard(locale)
         )
         return
 
+    asked_at = time_module.time()
     user_states[user_id] = {
         "state": "AWAITING_AIRDROP_ANSWER",
         "level": level,
         "current_task": task,
         "attempts": 0,
-        "expire_time": time_module.time() + 20  # 20 секунд на ответ
+        "locale": locale,
+        "asked_at": asked_at,
+        "expire_time": asked_at + ANSWER_SECONDS
     }
-
-    cur.execute("""
-        UPDATE users 
-        SET pending_airdrop_level = NULL, 
-            pending_airdrop_question = NULL,
-            require_captcha = FALSE
-        WHERE user_id = %s;
-    """, (user_id,))
-    conn.commit()
+    save_session(user_id)
 
     bot.send_message(
         user_id,
-        f"🎁 Airdrop вопрос ({level} уровень):\n{task['question']}\n\n"
-        f"У вас есть 20 секунд чтобы ответить!",
-        reply_markup=types.ForceReply(selective=False)
+        render("question", locale, level=level_name(level, locale), question=task["question"],
+               seconds=ANSWER_SECONDS),
+        reply_markup=force_reply()
     )
 
-    threading.Timer(20.0, check_answer_timeout, args=[user_id]).start()
+    PENDING_TIMERS.inc()
+    timers.schedule(user_states[user_id]["expire_time"], run_answer_timer, user_id)
+
+
+def run_answer_timer(user_id: int):
+    try:
+        check_answer_timeout(user_id)
+    finally:
+        PENDING_TIMERS.dec()
+
+
+# Запись сессии пользователя в журнал компактным списком, время - в миллисекундах:
+# капча - ["C", уровень, вопрос, локаль, срок, текст капчи],
+# вопрос - ["A", уровень, вопрос, локаль, срок, время вопроса, попытки]
+def save_session(user_id: int):
+    state = user_states[user_id]
+    if state["state"] == "AWAITING_CAPTCHA":
+        captcha_data = user_captchas[user_id]
+        session = ["C", captcha_data["level"], captcha_data["question"], captcha_data["locale"],
+                   int(captcha_data["expire_time"] * 1000), captcha_data["text"]]
+        timers.schedule(captcha_data["expire_time"], expire_captcha, user_id, captcha_data["expire_time"])
+    else:
+        session = ["A", state["level"], state["current_task"]["question"], state["locale"],
+                   int(state["expire_time"] * 1000), int(state["asked_at"] * 1000), state["attempts"]]
+    journal.put(user_id, session)
+
+
+# Возврат в главное меню с удалением сессии из журнала
+def end_session(user_id: int):
+    user_states[user_id] = {"state": "MAIN_MENU"}
+    user_captchas.pop(user_id, None)
+    journal.drop(user_id)
 
 
+# Срок капчи истек: airdrop, забранный при /claim, сгорает вместе с ней.
+# expire_time отличает эту капчу от новой, выданной тому же пользователю позже.
+def expire_captcha(user_id: int, expire_time: float):
+    captcha_data = user_captchas.get(user_id)
+    if captcha_data is None or captcha_data["expire_time"] != expire_time:
+        return
+    end_session(user_id)
+    try:
+        bot.send_message(user_id, render("captcha_expired", captcha_data.get("locale", DEFAULT_LOCALE)))
+    except Exception as e:
+        logger.error("Не удалось сообщить об истечении капчи %s: %s", user_id, e)
+
+
+# Восстановление сессий из журнала при запуске: сроки взводятся заново на оставшееся время,
+# ответы, срок которых истек, пока бот не работал, записываются как таймаут.
+# Сборщик мусора на время восстановления отключается: его проходы по сотням тысяч новых объектов
+# занимают больше времени, чем само чтение журнала.
+def restore_sessions():
+    started = time_module.perf_counter()
+    gc.disable()
+    try:
+        deadlines = restore_journal_sessions()
+        timers.schedule_many(deadlines)
+    finally:
+        gc.enable()
+    PENDING_TIMERS.inc(amount=sum(1 for entry in deadlines if entry[1] is run_answer_timer))
+    logger.info("Восстановлено сессий: %s за %.2f с", len(deadlines), time_module.perf_counter() - started)
+    return len(deadlines)
+
+
+# Сессии из журнала в user_states и user_captchas; возвращает сроки для таймеров
+def restore_journal_sessions():
+    deadlines = []
+    for user_id, session in journal.load().items():
+        kind, level, question, locale, expire_ms = session[:5]
+        task = find_task(level, question)
+        if task is None:
+            journal.drop(user_id)
+            continue
+        expire_time = expire_ms / 1000
+        if kind == "C":
+            user_captchas[user_id] = {"text": session[5], "level": level, "question": question,
+                                      "locale": locale, "expire_time": expire_time}
+            user_states[user_id] = {"state": "AWAITING_CAPTCHA"}
+            deadlines.append((expire_time, expire_captcha, (user_id, expire_time)))
+        else:
+            user_states[user_id] = {
+                "state": "AWAITING_AIRDROP_ANSWER",
+                "level": level,
+                "current_task": task,
+                "attempts": session[6],
+                "locale": locale,
+                "asked_at": session[5] / 1000,
+                "expire_time": expire_time
+            }
+            deadlines.append((expire_time, run_answer_timer, (user_id,)))
+    return deadlines
+
+
+@router.state("AWAITING_CAPTCHA")
 def process_captcha(message: types.Message):
     user_id = message.from_user.id
+    locale = resolve_locale(message.from_user.language_code)
     user_answer = message.text.strip().upper()
 
-    if user_id not in user_captchas:
-        bot.send_message(message.chat.id, "Сессия капчи истекла. Попробуйте снова.")
+    if user_id not in user_captchas or time_module.time() > user_captchas[user_id]["expire_time"]:
+        bot.send_message(message.chat.id, render("captcha_expired", locale))
+        end_session(user_id)
         return
 
     captcha_data = user_captchas[user_id]
@@ -351,406 +758,975 @@ def process_captcha(message: types.Message):
         del user_captchas[user_id]
         bot.send_message(
             message.chat.id,
-            "✅ Капча пройдена успешно!",
-            reply_markup=create_main_keyboard()
+            render("captcha_ok", locale),
+            reply_markup=main_keyboard(locale)
         )
-        process_airdrop_question(user_id, captcha_data["level"], captcha_data["question"])
+        process_airdrop_question(user_id, captcha_data["level"], captcha_data["question"], locale)
     else:
-        del user_captchas[user_id]
-        try:
-            cur.execute("""
-                UPDATE users 
-                SET pending_airdrop_level = NULL,
-                    pending_airdrop_question = NULL,
-                    require_captcha = FALSE
-                WHERE user_id = %s;
-            """, (user_id,))
-            conn.commit()
-        except psycopg2.Error as e:
-            logger.error(f"Ошибка БД при сбросе капчи: {e}")
-            conn.rollback()
-
+        # Airdrop уже забран из очереди при /claim и сгорает вместе с капчей
+        end_session(user_id)
         bot.send_message(
             message.chat.id,
-            "❌ Неверный код. Доступ к этому airdrop'у закрыт. Ожидайте следующего уведомления.",
-            reply_markup=create_main_keyboard()
+            render("captcha_failed", locale),
+            reply_markup=main_keyboard(locale)
         )
 
 
+# Ответы (и таймауты) пачкой: строка user_answers и запись в журнал начислений вместо UPDATE
+# широкой строки users, одним запросом. op_id - "user_id:момент вопроса в мс", на вопрос один ответ,
+# поэтому повтор той же записи (отправка журнала WRITE_SPOOL, неизвестный исход коммита) ничего не добавит.
+# answers: [op_id, user_id, level, question, answer, is_correct, answer_time_ms, reason, delta,
+#           correct_delta, answered_at (time.time())]
+def write_answers(answers):
+    storage.write_answers(answers)
+    commit()
+
+
+# Ответ пишется в БД, а если она недоступна - в локальный журнал WRITE_SPOOL;
+# пользователь в обоих случаях получает обычный ответ. Вопрос сразу отмечается в наборе отвеченных
+def record_answer(user_id: int, user_state, answer: str, is_correct: bool, answer_time_ms: int, reason: str,
+                  delta: int = 0, correct_delta: int = 0):
+    level, question = user_state["level"], user_state["current_task"]["question"]
+    record = [f"{user_id}:{int(user_state['asked_at'] * 1000)}", user_id, level, question, answer, is_correct,
+              answer_time_ms, reason, delta, correct_delta, time_module.time()]
+    task_id = skills.task_id(level, question)
+    if task_id is not None:
+        answered_tasks.add(user_id, task_id)
+    try:
+        write_answers([record])
+    except DB_CONNECTION_ERRORS as e:
+        rollback()
+        spool.append(record)
+        logger.warning("БД недоступна, ответ %s отложен в журнал записей: %s", record[0], e)
+    update_cached_profile(user_id, level, is_correct, delta)
+
+
+# Отправка журнала WRITE_SPOOL пачками после восстановления БД; при новой ошибке остаток ждет следующего раза
+def replay_write_spool():
+    replayed = 0
+    try:
+        while True:
+            batch = spool.take(SPOOL_REPLAY_BATCH)
+            if not batch:
+                break
+            write_answers(batch)
+            spool.ack(len(batch))
+            replayed += len(batch)
+    except DB_ERRORS as e:
+        rollback()
+        if not isinstance(e, CircuitOpenError):
+            logger.warning("Отправка журнала записей прервана: %s", e)
+    if replayed:
+        logger.info("Из журнала записей отправлено в БД: %s, осталось %s", replayed, len(spool))
+
+
+# Баланс и статистика, прочитанные из БД, для ответа при ее недоступности.
+# Ответы, записанные после чтения, учитываются в копии сразу.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "100000"))
+cached_balances: Dict[int, list] = {}
+cached_stats: Dict[int, Dict[str, list]] = {}
+profile_lock = threading.Lock()
+
+
+def cache_profile(cache, user_id: int, value):
+    with profile_lock:
+        cache.pop(user_id, None)
+        cache[user_id] = value
+        if len(cache) > PROFILE_CACHE_SIZE:
+            del cache[next(iter(cache))]
+
+
+def update_cached_profile(user_id: int, level: str, is_correct: bool, delta: int):
+    with profile_lock:
+        balance = cached_balances.get(user_id)
+        if balance is not None:
+            balance[0] += delta
+            balance[1] += is_correct
+            balance[2] += 1
+        stats = cached_stats.get(user_id)
+        if stats is not None:
+            row = stats.setdefault(level, [0, 0])
+            row[0] += 1
+            row[1] += is_correct
+
+
+# Перенос накопленных записей журнала в users пачками; строки журнала остаются для аудита
+def rollup_balance_ledger(batch_size: int = LEDGER_ROLLUP_BATCH):
+    total_rows = 0
+    try:
+        while True:
+            rows = storage.rollup_ledger(batch_size)
+            commit()
+            total_rows += rows
+            if rows < batch_size:
+                break
+        if total_rows:
+            logger.info("Журнал баланса: перенесено записей %s", total_rows)
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при переносе журнала баланса: %s", e)
+        rollback()
+    return total_rows
+
+
+def load_task_calibration():
+    global task_calibration
+    try:
+        task_calibration = storage.task_calibration()
+        commit()
+        logger.info("Загружена калибровка вопросов: %s", len(task_calibration))
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при загрузке калибровки: %s", e)
+        rollback()
+
+
+def task_reward(level: str, task: Dict[str, Any]) -> int:
+    if CALIBRATED_REWARDS:
+        reward = task_calibration.get((level, task["question"]))
+        if reward is not None:
+            return reward
+    return task.get("reward", 1)
+
+
+# Загрузка рейтингов; при первом запуске они восстанавливаются из истории user_answers
+def load_skill_ratings():
+    try:
+        skills.load_users(storage.user_skills())
+        skills.load_tasks(storage.task_skills())
+
+        if not skills.user_slots:
+            for user_id, level, question, is_correct in storage.answer_history():
+                skills.update(user_id, level, question, is_correct)
+            commit()
+            flush_skill_ratings()
+        logger.info("Загружены рейтинги: пользователей %s", len(skills.user_slots))
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при загрузке рейтингов: %s", e)
+        rollback()
+
+
+# Наборы отвеченных задач, сохраненные после прошлого чтения (в том числе другими экземплярами),
+# объединяются с памятью. Окно с запасом в минуту: набор из долгой транзакции не пропускается,
+# повторное объединение ничего не меняет
+def sync_answered_tasks() -> int:
+    global answered_synced_at
+    rows = storage.answered_tasks(TASK_CATALOG, answered_synced_at)
+    answered_tasks.merge((user_id, tasks) for user_id, tasks, _ in rows)
+    if rows:
+        answered_synced_at = max(updated_at for _, _, updated_at in rows)
+    return len(rows)
+
+
+# Загрузка отвеченных задач; при первом запуске и после изменения каталога - из истории user_answers
+def load_answered_tasks():
+    try:
+        loaded = sync_answered_tasks()
+        commit()
+        if not loaded:
+            for user_id, level, question, _ in storage.answer_history():
+                task_id = skills.task_id(level, question)
+                if task_id is not None:
+                    answered_tasks.add(user_id, task_id)
+            commit()
+            flush_answered_tasks()
+        logger.info("Загружены отвеченные задачи: пользователей %s, %s байт",
+                    len(answered_tasks), answered_tasks.memory_bytes())
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при загрузке отвеченных задач: %s", e)
+        rollback()
+
+
+# Сохранение измененных наборов одной вставкой. Наборы этих пользователей блокируются до commit и
+# объединяются с памятью: ответы, сохраненные другим экземпляром, не перезаписываются. Если сохранение
+# не дошло до commit (любая ошибка, в том числе самого commit), наборы сохраняются при следующей попытке
+def flush_answered_tasks():
+    rows = []
+    saved = False
+    try:
+        sync_answered_tasks()
+        user_ids = answered_tasks.dirty_users()
+        if user_ids:
+            answered_tasks.merge(storage.lock_answered_tasks(TASK_CATALOG, user_ids))
+            rows = answered_tasks.take_dirty(user_ids)
+            if rows:
+                storage.save_answered_tasks(TASK_CATALOG, rows)
+        commit()
+        saved = True
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при сохранении отвеченных задач: %s", e)
+        rollback()
+    finally:
+        if not saved:
+            answered_tasks.requeue(user_id for user_id, _ in rows)
+
+
+# Сохранение измененных рейтингов одной вставкой на таблицу. Если сохранение не дошло до commit
+# (любая ошибка, в том числе самого commit), рейтинги сохраняются при следующей попытке
+def flush_skill_ratings():
+    users, tasks = skills.take_dirty()
+    if not users and not tasks:
+        return
+    saved = False
+    try:
+        if users:
+            storage.save_user_skills(users)
+        if tasks:
+            storage.save_task_skills(tasks)
+        commit()
+        saved = True
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при сохранении рейтингов: %s", e)
+        rollback()
+    finally:
+        if not saved:
+            skills.requeue(users, tasks)
+
+
 def check_answer_timeout(user_id: int):
     if user_id in user_states and user_states[user_id].get("state") == "AWAITING_AIRDROP_ANSWER":
         if time_module.time() > user_states[user_id]["expire_time"]:
             try:
                 current_task = user_states[user_id]["current_task"]
-                cur.execute("""
-                    INSERT INTO user_answers 
-                    (user_id, question, answer, is_correct, level)
-                    VALUES (%s, %s, %s, %s, %s);
-                """, (user_id, current_task["question"], "TIMEOUT", False, user_states[user_id]["level"]))
-
-                cur.execute("""
-                    UPDATE users SET total_questions = total_questions + 1
-                    WHERE user_id = %s;
-                """, (user_id,))
-                conn.commit()
+                record_answer(user_id, user_states[user_id], "TIMEOUT", False, ANSWER_SECONDS * 1000, "timeout")
+                skills.update(user_id, user_states[user_id]["level"], current_task["question"], False)
 
+                locale = user_states[user_id].get("locale", DEFAULT_LOCALE)
                 bot.send_message(
                     user_id,
-                    "⏳ Время на ответ истекло. Попробуйте получить новый airdrop позже.",
-                    reply_markup=create_main_keyboard()
+                    render("timeout", locale),
+                    reply_markup=main_keyboard(locale)
                 )
 
-                user_states[user_id] = {"state": "MAIN_MENU"}
-            except psycopg2.Error as e:
-                logger.error(f"Ошибка БД при обработке таймаута: {e}")
-                conn.rollback()
+                end_session(user_id)
+            except DB_ERRORS as e:
+                logger.error("Ошибка БД при обработке таймаута: %s", e)
+                rollback()
 
 
-def process_airdrop_answer(message: types.Message, user_state: Dict[str, Any]):
+@router.state("AWAITING_AIRDROP_ANSWER")
+def process_airdrop_answer(message: types.Message):
     user_id = message.from_user.id
+    user_state = user_states[user_id]
+    locale = user_state.get("locale", DEFAULT_LOCALE)
 
     if time_module.time() > user_state["expire_time"]:
         bot.send_message(
             message.chat.id,
-            "⏳ Время на ответ истекло. Попробуйте получить новый airdrop позже.",
-            reply_markup=create_main_keyboard()
+            render("timeout", locale),
+            reply_markup=main_keyboard(locale)
         )
-        user_states[user_id] = {"state": "MAIN_MENU"}
+        end_session(user_id)
         return
 
     current_task = user_state["current_task"]
     user_answer = message.text.strip().lower()
-    correct_answer = current_task["answer"].lower()
     level = user_state["level"]
-    reward = current_task.get("reward", 1)
+    reward = task_reward(level, current_task)
+    answer_time_ms = int((time_module.time() - user_state["asked_at"]) * 1000)
 
     try:
-        if user_answer == correct_answer:
-            cur.execute("""
-                UPDATE users 
-                SET balance = balance + %s,
-                    correct_answers = correct_answers + 1,
-                    total_questions = total_questions + 1
-                WHERE user_id = %s;
-            """, (reward, user_id))
-
-            cur.execute("""
-                INSERT INTO user_answers 
-                (user_id, question, answer, is_correct, level)
-                VALUES (%s, %s, %s, %s, %s);
-            """, (user_id, current_task["question"], user_answer, True, level))
-
-            conn.commit()
+        if matcher.matches(level, current_task["question"], message.text):
+            record_answer(user_id, user_state, user_answer, True, answer_time_ms, "correct_answer",
+                          delta=reward, correct_delta=1)
+            skills.update(user_id, level, current_task["question"], True)
 
             bot.send_message(
                 message.chat.id,
-                f"✅ Правильно! Вы получили {reward} баллов за airdrop.",
-                reply_markup=create_main_keyboard()
+                render("correct", locale, reward=reward),
+                reply_markup=main_keyboard(locale)
             )
         else:
             user_state["attempts"] += 1
-
-            cur.execute("""
-                INSERT INTO user_answers 
-                (user_id, question, answer, is_correct, level)
-                VALUES (%s, %s, %s, %s, %s);
-            """, (user_id, current_task["question"], user_answer, False, level))
-
-            cur.execute("""
-                UPDATE users SET total_questions = total_questions + 1
-                WHERE user_id = %s;
-            """, (user_id,))
-
-            conn.commit()
+            record_answer(user_id, user_state, user_answer, False, answer_time_ms, "wrong_answer")
+            skills.update(user_id, level, current_task["question"], False)
 
             bot.send_message(
                 message.chat.id,
-                f"❌ Неверно. Попробуйте получить новый airdrop позже.",
-                reply_markup=create_main_keyboard()
+                render("wrong", locale),
+                reply_markup=main_keyboard(locale)
             )
 
-        user_states[user_id] = {"state": "MAIN_MENU"}
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
-        conn.rollback()
+        end_session(user_id)
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД: %s", e)
+        rollback()
         bot.send_message(
             message.chat.id,
-            "Произошла ошибка при обработке ответа.",
-            reply_markup=create_main_keyboard()
+            render("answer_error", locale),
+            reply_markup=main_keyboard(locale)
         )
-        user_states[user_id] = {"state": "MAIN_MENU"}
+        end_session(user_id)
 
 
-# Обработка сообщений
+# Обработка сообщений: единственный обработчик telebot, дальше работает router
 @bot.message_handler(func=lambda message: True)
 def handle_message(message: types.Message):
-    user_id = message.from_user.id
-    user_state = user_states.get(user_id, {})
+    touch_user(message.from_user.id)
+    router.dispatch(message)
 
-    if user_id in captcha_attempts:
-        process_captcha(message)
-        return
 
-    if message.text == "Баланс":
-        show_balance(message)
+# Отметка активности: last_seen пишется не чаще раза в LAST_SEEN_INTERVAL секунд,
+# сообщение от пользователя снимает отметку о блокировке
+def touch_user(user_id: int):
+    if breaker.is_open:
         return
-
-    if message.text == "Статистика":
-        show_stats(message)
+    now = time_module.time()
+    if now - last_seen_written.get(user_id, 0.0) < LAST_SEEN_INTERVAL:
         return
+    last_seen_written[user_id] = now
+    try:
+        storage.touch_user(user_id)
+        commit()
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при обновлении last_seen: %s", e)
+        rollback()
 
-    if message.text == "Помощь":
-        show_help(message)
-        return
 
-    if user_state.get("state") == "AWAITING_AIRDROP_ANSWER":
-        process_airdrop_answer(message, user_state)
-    else:
-        bot.send_message(
-            message.chat.id,
-            "Выберите действие из меню.",
-            reply_markup=create_main_keyboard()
-        )
+@router.default
+def handle_unknown(message: types.Message):
+    locale = resolve_locale(message.from_user.language_code)
+    bot.send_message(
+        message.chat.id,
+        render("choose_action", locale),
+        reply_markup=main_keyboard(locale)
+    )
 
 
+@router.text(*button_labels("balance"))
 def show_balance(message: types.Message):
     user_id = message.from_user.id
+    locale = resolve_locale(message.from_user.language_code)
     try:
-        cur.execute("""
-            SELECT balance, correct_answers, total_questions 
-            FROM users WHERE user_id = %s;
-        """, (user_id,))
-        result = cur.fetchone()
-
+        # Снимок из users плюс еще не перенесенные записи журнала
+        result = storage.balance(user_id)
+        notice = ""
         if result:
-            balance, correct, total = result
-            accuracy = (correct / total * 100) if total > 0 else 0
-
-            bot.send_message(
-                message.chat.id,
-                f"💰 Баланс: {balance} баллов\n"
-                f"✅ Правильных ответов: {correct}\n"
-                f"📊 Всего вопросов: {total}\n"
-                f"🎯 Точность: {accuracy:.1f}%",
-                reply_markup=create_main_keyboard()
-            )
-        else:
+            cache_profile(cached_balances, user_id, list(result))
+    except DB_ERRORS as e:
+        rollback()
+        result = cached_balances.get(user_id) if isinstance(e, DB_CONNECTION_ERRORS) else None
+        if result is None:
+            logger.error("Ошибка БД: %s", e)
             bot.send_message(
                 message.chat.id,
-                "Пользователь не найден. Нажмите /start",
-                reply_markup=create_main_keyboard()
+                render("balance_error", locale),
+                reply_markup=main_keyboard(locale)
             )
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
+            return
+        notice = render("cached_notice", locale)
+
+    if result:
+        balance, correct, total = result
+        accuracy = (correct / total * 100) if total > 0 else 0
+
         bot.send_message(
             message.chat.id,
-            "Не удалось получить информацию о балансе.",
-            reply_markup=create_main_keyboard()
+            render("balance", locale, balance=balance, correct=correct, total=total, accuracy=accuracy) + notice,
+            reply_markup=main_keyboard(locale)
+        )
+    else:
+        bot.send_message(
+            message.chat.id,
+            render("user_not_found", locale),
+            reply_markup=main_keyboard(locale)
         )
 
 
+@router.text(*button_labels("stats"))
 def show_stats(message: types.Message):
     user_id = message.from_user.id
+    locale = resolve_locale(message.from_user.language_code)
     try:
-        cur.execute("""
-            SELECT 
-                COUNT(*) as total_answers,
-                SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) as correct_answers,
-                level
-            FROM user_answers
-            WHERE user_id = %s
-            GROUP BY level;
-        """, (user_id,))
-
-        stats = cur.fetchall()
-
-        if not stats:
+        stats = storage.answer_stats(user_id)
+        cache_profile(cached_stats, user_id, stats)
+        notice = ""
+    except DB_ERRORS as e:
+        rollback()
+        stats = cached_stats.get(user_id) if isinstance(e, DB_CONNECTION_ERRORS) else None
+        if stats is None:
+            logger.error("Ошибка БД: %s", e)
             bot.send_message(
                 message.chat.id,
-                "У вас пока нет статистики. Ответьте на несколько вопросов!",
-                reply_markup=create_main_keyboard()
+                render("stats_error", locale),
+                reply_markup=main_keyboard(locale)
             )
             return
+        notice = render("cached_notice", locale)
 
-        message_text = "📊 Ваша статистика:\n\n"
-        for row in stats:
-            total, correct, level = row
-            accuracy = (correct / total * 100) if total > 0 else 0
-            message_text += (
-                f"🏆 {level.capitalize()} уровень:\n"
-                f"✅ {correct} из {total}\n"
-                f"🎯 Точность: {accuracy:.1f}%\n\n"
-            )
-
+    if not stats:
         bot.send_message(
             message.chat.id,
-            message_text,
-            reply_markup=create_main_keyboard()
-        )
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД: {e}")
-        bot.send_message(
-            message.chat.id,
-            "Не удалось получить статистику.",
-            reply_markup=create_main_keyboard()
+            render("stats_empty", locale) + notice,
+            reply_markup=main_keyboard(locale)
         )
+        return
 
+    parts = [render("stats_header", locale)]
+    for level, (total, correct) in list(stats.items()):
+        accuracy = (correct / total * 100) if total > 0 else 0
+        parts.append(render(
+            "stats_row", locale,
+            level=level_name(level, locale).capitalize(), correct=correct, total=total, accuracy=accuracy
+        ))
 
-def show_help(message: types.Message):
-    help_text = (
-        "ℹ️ Помощь по боту:\n\n"
-        "Команды:\n"
-        "• Баланс - показать ваш текущий баланс\n"
-        "• Статистика - показать вашу статистику\n"
-        "• /check_multis - (для админов) проверить подозрительные аккаунты\n"
-        "Для начала работы нажмите /start"
+    bot.send_message(
+        message.chat.id,
+        "".join(parts) + notice,
+        reply_markup=main_keyboard(locale)
     )
 
+
+@router.text(*button_labels("help"))
+def show_help(message: types.Message):
+    locale = resolve_locale(message.from_user.language_code)
     bot.send_message(
         message.chat.id,
-        help_text,
-        reply_markup=create_main_keyboard()
+        render("help", locale),
+        reply_markup=main_keyboard(locale)
     )
 
 
-# Система airdrop с проверкой на подозрительные аккаунты
-def send_airdrop_to_users():
-    try:
-        # Получаем всех активных пользователей, исключая большинство подозрительных
-        cur.execute("""
-            SELECT user_id FROM users 
-            WHERE is_suspicious = FALSE 
-            OR (is_suspicious = TRUE AND random() < 0.3);  # 30% шанс для подозрительных
-        """)
-        users = cur.fetchall()
+# Выбор airdrop для пользователя с учетом дневного лимита: уровень, вопрос и капча.
+# Возвращает (уровень, задача, нужна ли капча, локаль, номер airdrop за день, дневной лимит) или None.
+# Счетчик airdrops_today не увеличивает - это делает тот, кто выдает airdrop.
+def pick_airdrop(user_id: int):
+    # Проверяем, нужно ли сбросить счетчик airdrop за день
+    row = storage.airdrop_limits(user_id)
+    if row is None:
+        return None
+    reset_date, airdrops_today, daily_limit, language_code, is_suspicious = row
+    locale = resolve_locale(language_code)
+
+    if reset_date != datetime.now().date() or daily_limit == 0:
+        new_limit = random.randint(1, 5)
+        storage.reset_daily_limit(user_id, new_limit)
+        airdrops_today = 0
+        daily_limit = new_limit
+
+    if airdrops_today >= daily_limit:
+        return None
+
+    if is_suspicious:
+        # Для подозрительных аккаунтов всегда требуем капчу
+        require_captcha = True
+    else:
+        # Оригинальная логика для обычных пользователей
+        require_captcha = (airdrops_today + 1) % 3 == 0
 
-        if not users:
-            return
+    if ADAPTIVE_DIFFICULTY:
+        level = skills.choose_level(user_id)
+    else:
+        level = random.choice(["легкий", "средний", "сложный"])
+    tasks = TASKS.get(level, [])
 
-        for user in users:
-            user_id = user[0]
-
-            # Проверяем, нужно ли сбросить счетчик airdrop за день
-            cur.execute("""
-                SELECT airdrop_reset_date, airdrops_today, daily_airdrop_limit 
-                FROM users 
-                WHERE user_id = %s;
-            """, (user_id,))
-            reset_date, airdrops_today, daily_limit = cur.fetchone()
-
-            if reset_date != datetime.now().date() or daily_limit == 0:
-                new_limit = random.randint(1, 5)
-                cur.execute("""
-                    UPDATE users 
-                    SET airdrops_today = 0,
-                        airdrop_reset_date = CURRENT_DATE,
-                        daily_airdrop_limit = %s
-                    WHERE user_id = %s;
-                """, (new_limit, user_id))
-                airdrops_today = 0
-                daily_limit = new_limit
-
-            if airdrops_today >= daily_limit:
-                continue
+    if not tasks:
+        return None
 
-            # Проверяем, является ли аккаунт подозрительным
-            cur.execute("SELECT is_suspicious FROM users WHERE user_id = %s;", (user_id,))
-            is_suspicious = cur.fetchone()[0]
+    answered = answered_tasks.get(user_id)
 
-            if is_suspicious:
-                # Для подозрительных аккаунтов всегда требуем капчу
-                require_captcha = True
-            else:
-                # Оригинальная логика для обычных пользователей
-                require_captcha = (airdrops_today + 1) % 3 == 0
+    if ADAPTIVE_DIFFICULTY:
+        task = skills.choose_task(user_id, level, answered)
+    else:
+        position = answered.pick(LEVEL_FIRST_TASK[level], len(tasks))
 
-            level = random.choice(["легкий", "средний", "сложный"])
-            tasks = TASKS.get(level, [])
+        # Все вопросы уровня отвечены - любой из них
+        if position is None:
+            position = random.randrange(len(tasks))
 
-            if not tasks:
-                continue
+        task = tasks[position]
 
-            cur.execute("""
-                SELECT question FROM user_answers 
-                WHERE user_id = %s AND level = %s;
-            """, (user_id, level))
-            answered_questions = {row[0] for row in cur.fetchall()}
+    return level, task, require_captcha, locale, airdrops_today + 1, daily_limit
 
-            available_tasks = [t for t in tasks if t["question"] not in answered_questions]
 
-            if not available_tasks:
-                available_tasks = tasks
+# Пачка выданных airdrop: одна вставка в очередь и одно обновление счетчиков, затем уведомления.
+# Коммит до отправки, чтобы /claim сразу после уведомления уже видел airdrop.
+# batch: (user_id, level, question, require_captcha, locale, номер airdrop за день, дневной лимит)
+# Возвращает (выдано, отправлено уведомлений)
+def deliver_airdrop_batch(queue_slot: str, batch, send_errors: ErrorAggregator, blocked_users):
+    inserted = storage.enqueue_airdrops(queue_slot, [item[:4] for item in batch])
+    commit()
 
-            task = random.choice(available_tasks)
+    sent = 0
+    for user_id, level, _, require_captcha, locale, number, daily_limit in batch:
+        if user_id not in inserted:
+            continue
+        try:
+            bot.send_message(
+                user_id,
+                render(
+                    "airdrop_notice_captcha" if require_captcha else "airdrop_notice", locale,
+                    level=level_name(level, locale), number=number, limit=daily_limit
+                )
+            )
+            MESSAGES_SENT.inc("ok")
+            sent += 1
+        except Exception as e:
+            MESSAGES_SENT.inc("error")
+            send_errors.add(e, user_id)
+            # 403: пользователь заблокировал бота
+            if getattr(e, "error_code", None) == 403:
+                blocked_users.append(user_id)
+    return len(inserted), sent
+
+
+# Система airdrop с проверкой на подозрительные аккаунты.
+# Пользователи обходятся по возрастанию user_id начиная после resume_after; при остановке экземпляра
+# рассылка доставляет собранную пачку и прерывается.
+# Возвращает (выдано airdrop, отправлено уведомлений, последний обработанный user_id или None,
+# если рассылка завершена) для истории запусков airdrop_runs
+def send_airdrop_to_users(slot: str = "manual", shard: Optional[int] = None, day: Optional[date] = None,
+                          part=None, resume_after: int = 0):
+    started = time_module.perf_counter()
+    assigned = sent = 0
+    paused_after = None
+    send_errors = ErrorAggregator(logger, "отправок airdrop")
+    blocked_users = []
+    # Ключ слота в очереди включает дату: один и тот же слот разных дней - разные airdrop,
+    # повторный запуск того же слота в тот же день ничего не добавит
+    queue_slot = slot_key(day or datetime.now().date(), slot)
+    try:
+        # Получаем активных пользователей (не заблокировавших бота и не спящих),
+        # исключая большинство подозрительных (для них шанс 30%)
+        # shard - только пользователи с user_id % SHARD_COUNT = shard,
+        # part - только пользователи этого часового пояса и этой волны окна доставки
+        users = storage.fanout_users(resume_after, DORMANT_DAYS, shard, SHARD_COUNT, delivery_filter(part))
 
-            cur.execute("""
-                UPDATE users 
-                SET pending_airdrop_level = %s,
-                    pending_airdrop_question = %s,
-                    last_airdrop = CURRENT_TIMESTAMP,
-                    airdrops_today = airdrops_today + 1,
-                    require_captcha = %s
-                WHERE user_id = %s;
-            """, (level, task["question"], require_captcha, user_id))
+        if not users:
+            return assigned, sent, paused_after
+
+        DELIVERY_QUEUE_DEPTH.set(len(users))
+        skills.prepare_selection()
+        batch = []
+        last_user_id = resume_after
+        for user_id in users:
+            if lifecycle.stopping.is_set():
+                paused_after = last_user_id
+                logger.info("Рассылка %s приостановлена после user_id %s", slot, paused_after)
+                break
+            last_user_id = user_id
+            DELIVERY_QUEUE_DEPTH.dec()
+
+            picked = pick_airdrop(user_id)
+            if picked is None:
+                continue
+            level, task, require_captcha, locale, number, daily_limit = picked
+
+            batch.append((user_id, level, task["question"], require_captcha, locale, number, daily_limit))
+            if len(batch) >= FANOUT_BATCH:
+                batch_assigned, batch_sent = deliver_airdrop_batch(queue_slot, batch, send_errors, blocked_users)
+                assigned += batch_assigned
+                sent += batch_sent
+                batch = []
+
+        if batch:
+            batch_assigned, batch_sent = deliver_airdrop_batch(queue_slot, batch, send_errors, blocked_users)
+            assigned += batch_assigned
+            sent += batch_sent
+
+        # Заблокировавшим бота возвращаем выданный airdrop и исключаем их из следующих рассылок
+        if blocked_users:
+            storage.mark_blocked(blocked_users, refund_today=True)
+            for user_id in blocked_users:
+                last_seen_written.pop(user_id, None)
+            assigned -= len(blocked_users)
+
+        commit()
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при отправке airdrop: %s", e)
+        rollback()
+    except Exception as e:
+        logger.error("Ошибка при отправке airdrop: %s", e)
+    finally:
+        send_errors.flush()
+        DELIVERY_QUEUE_DEPTH.set(0)
+        FANOUT_USERS.inc(slot, amount=assigned)
+        FANOUT_SECONDS.observe(time_module.perf_counter() - started, slot)
+    return assigned, sent, paused_after
+
+
+# Очистка невостребованных airdrop: два запроса по индексу created_at очереди вместо обхода пользователей.
+# Сначала сгорают просроченные, затем помечаются и получают напоминание те, кому осталось
+# меньше REMINDER_BEFORE_MINUTES (не больше REMINDER_BATCH за проход, остальные - в следующий).
+# Пользователь с несколькими сгорающими airdrop получает одно напоминание - о самом старом.
+# Напоминания отправляются в отдельном потоке, чтобы ограничение частоты не задерживало слоты
+# планировщика; пока он занят, новые напоминания не помечаются.
+def sweep_pending_airdrops():
+    global reminder_thread
+    sending = reminder_thread is not None and reminder_thread.is_alive()
+    try:
+        expired = storage.expire_pending(PENDING_TTL_MINUTES)
+
+        if HASHED_ASSIGNMENT or DELIVERY_MODE == "channel":
+            # Отметка нужна, пока слот открыт: слот закрывается не позже чем через TTL после забора
+            storage.expire_claims(PENDING_TTL_MINUTES)
+
+        reminders = [] if sending else storage.mark_reminders(PENDING_TTL_MINUTES - REMINDER_BEFORE_MINUTES,
+                                                              REMINDER_BATCH)
+        commit()
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при очистке airdrop: %s", e)
+        rollback()
+        return
 
-            try:
-                if require_captcha:
-                    bot.send_message(
-                        user_id,
-                        f"🎉 Вам пришел airdrop ({level} уровень)! "
-                        f"Но сначала подтвердите, что вы не бот - вам нужно будет ввести капчу.\n"
-                        f"Используйте команду /claim чтобы начать.\n"
-                        f"Сегодня вы получите {airdrops_today + 1}/{daily_limit} airdrop."
-                    )
-                else:
+    PENDING_SWEPT.inc("expired", amount=expired)
+    PENDING_SWEPT.inc("reminded", amount=len(reminders))
+    if expired or reminders:
+        logger.info("Очистка airdrop: сгорело %s, напоминаний %s", expired, len(reminders))
+
+    if reminders:
+        reminder_thread = threading.Thread(target=send_reminders, args=(reminders,), name="airdrop-reminders",
+                                           daemon=True)
+        reminder_thread.start()
+
+
+# Напоминания не чаще REMINDER_RATE в секунду; при остановке экземпляра неотправленные пропадают
+def send_reminders(reminders):
+    send_errors = ErrorAggregator(logger, "напоминаний об airdrop")
+    blocked_users = []
+    interval = 1.0 / REMINDER_RATE if REMINDER_RATE > 0 else 0.0
+    now = datetime.now()
+    for user_id, level, assigned_at, language_code in reminders:
+        locale = resolve_locale(language_code)
+        minutes = max(1, PENDING_TTL_MINUTES - int((now - assigned_at).total_seconds() // 60))
+        try:
+            bot.send_message(
+                user_id,
+                render("airdrop_reminder", locale, level=level_name(level, locale), minutes=minutes)
+            )
+        except Exception as e:
+            send_errors.add(e, user_id)
+            if getattr(e, "error_code", None) == 403:
+                blocked_users.append(user_id)
+        if lifecycle.stopping.wait(interval):
+            break
+    send_errors.flush()
+
+    if blocked_users:
+        try:
+            storage.mark_blocked(blocked_users)
+            commit()
+        except DB_ERRORS as e:
+            logger.error("Ошибка БД при отметке заблокировавших бота: %s", e)
+            rollback()
+        for user_id in blocked_users:
+            last_seen_written.pop(user_id, None)
+
+
+# Рассылка в режиме hashed: пользователи читаются страницами по первичному ключу,
+# выдача вычисляется в памяти, в БД пишутся только отметки о блокировке бота.
+# При остановке экземпляра прерывается перед очередным пользователем.
+# Возвращает (получили airdrop в слоте, отправлено уведомлений, последний обработанный user_id или None)
+def send_hashed_airdrop_notices(slot: str, day: Optional[date] = None, part=None, resume_after: int = 0):
+    started = time_module.perf_counter()
+    eligible = notified = 0
+    send_errors = ErrorAggregator(logger, "отправок airdrop")
+    blocked_users = []
+    day = day or datetime.now().date()
+    last_user_id = resume_after
+    paused_after = None
+    try:
+        while paused_after is None:
+            page = storage.fanout_page(last_user_id, DORMANT_DAYS, delivery_filter(part), HASHED_FANOUT_PAGE)
+            commit()
+            if not page:
+                break
+
+            for user_id, is_suspicious, language_code in page:
+                if lifecycle.stopping.is_set():
+                    paused_after = last_user_id
+                    logger.info("Рассылка %s приостановлена после user_id %s", slot, paused_after)
+                    break
+                last_user_id = user_id
+                number = assigner.airdrop_number(user_id, day, slot, is_suspicious)
+                if number is None:
+                    continue
+                eligible += 1
+                locale = resolve_locale(language_code)
+                level = assigner.level(user_id, day, slot)
+                try:
                     bot.send_message(
                         user_id,
-                        f"🎉 Вам пришел airdrop ({level} уровень)! "
-                        f"Используйте команду /claim чтобы получить вопрос и заработать баллы.\n"
-                        f"Сегодня вы получите {airdrops_today + 1}/{daily_limit} airdrop."
+                        render(
+                            "airdrop_notice_captcha" if requires_captcha(number, is_suspicious) else "airdrop_notice",
+                            locale, level=level_name(level, locale), number=number,
+                            limit=assigner.daily_limit(user_id, day)
+                        )
                     )
-            except Exception as e:
-                logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                    MESSAGES_SENT.inc("ok")
+                    notified += 1
+                except Exception as e:
+                    MESSAGES_SENT.inc("error")
+                    send_errors.add(e, user_id)
+                    if getattr(e, "error_code", None) == 403:
+                        blocked_users.append(user_id)
+
+        if blocked_users:
+            storage.mark_blocked(blocked_users, drop_pending=False)
+            commit()
+            for user_id in blocked_users:
+                last_seen_written.pop(user_id, None)
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при отправке airdrop: %s", e)
+        rollback()
+    finally:
+        send_errors.flush()
+        FANOUT_USERS.inc(slot, amount=notified)
+        FANOUT_SECONDS.observe(time_module.perf_counter() - started, slot)
+    return eligible, notified, paused_after
 
-        conn.commit()
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД при отправке airdrop: {e}")
-        conn.rollback()
+
+def bot_username() -> str:
+    global BOT_USERNAME
+    if not BOT_USERNAME:
+        BOT_USERNAME = bot.get_me().username
+    return BOT_USERNAME
+
+
+# Рассылка в режиме channel: одно объявление в канал со ссылкой на слот.
+# Выдача происходит при заборе, поэтому в истории запусков выдано 0 и отправлено 1 сообщение;
+# объявление одно, приостанавливать нечего
+def broadcast_airdrop(slot: str, day: Optional[date] = None, resume_after: int = 0):
+    started = time_module.perf_counter()
+    link = f"https://t.me/{bot_username()}?start={slot_payload(day or datetime.now().date(), slot)}"
+    try:
+        bot.send_message(
+            BROADCAST_CHANNEL,
+            render("airdrop_broadcast", BROADCAST_LOCALE, minutes=PENDING_TTL_MINUTES),
+            reply_markup=link_keyboard(BROADCAST_LOCALE, link)
+        )
+        MESSAGES_SENT.inc("ok")
+        logger.info("Airdrop %s опубликован в %s", slot, BROADCAST_CHANNEL)
+        return 0, 1, None
     except Exception as e:
-        logger.error(f"Ошибка при отправке airdrop: {e}")
+        MESSAGES_SENT.inc("error")
+        logger.error("Не удалось опубликовать airdrop в %s: %s", BROADCAST_CHANNEL, e)
+        return 0, 0, None
+    finally:
+        FANOUT_SECONDS.observe(time_module.perf_counter() - started, slot)
+
+
+# Задачи, которые должен выполнять один экземпляр: при срабатывании проверяется (или захватывается)
+# лидерство, поэтому после падения лидера слот выполнит первый экземпляр, взявший блокировку
+def leader_only(job):
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        if not election.ensure():
+            logger.info("%s пропущено: экземпляр не лидер", job.__name__)
+            return None
+        return job(*args, **kwargs)
+    return wrapper
+
+
+# Запуск слота не больше одного раза на всех экземплярах и после перезапусков: строка (слот, шард)
+# в airdrop_runs вставляется до рассылки, и повторная вставка того же слота ничего не вернет.
+# Упавший посреди рассылки запуск остается в статусе running и автоматически не повторяется.
+# Рассылка, прерванная остановкой экземпляра, сохраняет статус paused и последний обработанный
+# user_id (resume_after); следующий запуск того же слота забирает ее и продолжает с этого места.
+# job(resume_after=...) возвращает (выдано, отправлено, user_id остановки или None).
+def run_slot_once(key: str, shard: int, job):
+    try:
+        started = storage.start_run(key, shard, INSTANCE_ID)
+        commit()
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при запуске слота %s: %s", key, e)
+        rollback()
+        return
+    if started is None:
+        logger.info("Слот %s (шард %s) уже запускался, пропуск", key, shard)
+        return
+    resume_after = started[0]
+    if resume_after is not None:
+        logger.info("Слот %s (шард %s) продолжается после user_id %s", key, shard, resume_after)
 
+    assigned, sent, status, paused_after = 0, 0, "failed", None
+    try:
+        assigned, sent, paused_after = job(resume_after=resume_after or 0)
+        status = "done" if paused_after is None else "paused"
+    finally:
+        try:
+            storage.finish_run(key, shard, assigned, sent, status, paused_after)
+            commit()
+        except DB_ERRORS as e:
+            logger.error("Ошибка БД при записи истории слота %s: %s", key, e)
+            rollback()
+        if status == "paused":
+            paused_runs.append((key, shard))
+        logger.info("Слот %s (шард %s): выдано %s, отправлено %s", key, shard, assigned, sent)
+
+
+# Рассылка, разделенная между экземплярами. Экземпляр берет свободные шарды, начиная со случайного,
+# и держит их блокировки до конца, чтобы другой экземпляр не обработал тот же шард одновременно.
+# Шард, уже записанный в airdrop_runs, повторно не рассылается.
+def run_sharded_fanout(slot: str, day: date, part=None):
+    offset = random.randrange(SHARD_COUNT)
+    taken = []
+    try:
+        for step in range(SHARD_COUNT):
+            if lifecycle.stopping.is_set():
+                break
+            shard = (offset + step) % SHARD_COUNT
+            if election.try_lock_shard(shard):
+                taken.append(shard)
+                run_slot_once(run_key(day, slot, part), shard,
+                              functools.partial(send_airdrop_to_users, slot, shard=shard, day=day, part=part))
+    finally:
+        for shard in taken:
+            election.unlock_shard(shard)
+    logger.info("Рассылка %s: обработаны шарды %s из %s", slot, taken, SHARD_COUNT)
 
-def schedule_airdrop_jobs():
+
+# Время слотов из airdrop_schedule и часовые пояса, заданные пользователями;
+# при ошибке остается прежнее расписание
+def load_schedule_slots():
     try:
-        cur.execute("SELECT scheduled_time FROM airdrop_schedule;")
-        times = cur.fetchall()
+        slot_times = storage.schedule_slots()
+        windows.set_timezones(storage.user_timezones())
+        commit()
+    except DB_ERRORS as e:
+        logger.error("Ошибка БД при чтении расписания airdrop: %s", e)
+        rollback()
+        return assigner.slot_times
+    assigner.set_slots(slot_times)
+    return slot_times
+
+
+# part - (часовой пояс, волна) окна доставки или None, если слот не делится.
+# Во время остановки новые слоты не начинаются: их запустит следующий экземпляр (окно догоняния)
+def fire_slot(day: date, slot: str, part=None):
+    if lifecycle.stopping.is_set():
+        logger.info("Слот %s %s отложен: экземпляр останавливается", day, slot)
+        return
+    if SHARD_COUNT > 1 and DELIVERY_MODE != "channel" and not HASHED_ASSIGNMENT:
+        run_sharded_fanout(slot, day, part)
+        return
+    if DELIVERY_MODE == "channel":
+        job = broadcast_airdrop
+    elif HASHED_ASSIGNMENT:
+        job = send_hashed_airdrop_notices
+    else:
+        job = send_airdrop_to_users
+    if not election.ensure():
+        logger.info("Слот %s %s пропущен: экземпляр не лидер", day, slot)
+        return
+    if part is not None:
+        job = functools.partial(job, part=part)
+    run_slot_once(run_key(day, slot, part), WHOLE_SLOT, functools.partial(job, slot, day=day))
 
-        for t in times:
-            scheduled_time = t[0]
-            schedule.every().day.at(str(scheduled_time)).do(send_airdrop_to_users)
-            logger.info(f"Airdrop запланирован на {scheduled_time} каждый день")
-    except psycopg2.Error as e:
-        logger.error(f"Ошибка БД при планировании airdrop: {e}")
+
+# Одно объявление в канал на слот; личные рассылки делятся на части окна доставки
+slot_scheduler = SlotScheduler(get_db_connection if STORAGE_BACKEND == "postgres" else None,
+                               load_schedule_slots, fire_slot,
+                               catchup_minutes=SLOT_CATCHUP_MINUTES,
+                               expand=windows.parts if windows.enabled and DELIVERY_MODE != "channel" else None)
 
 
 def run_scheduler():
-    schedule_airdrop_jobs()
-    while True:
-        schedule.run_pending()
-        time_module.sleep(60)
+    schedule.every(LEDGER_ROLLUP_SECONDS).seconds.do(rollup_balance_ledger)
+    schedule.every(SKILL_FLUSH_SECONDS).seconds.do(flush_skill_ratings)
+    schedule.every(SKILL_REFRESH_SECONDS).seconds.do(skills.prepare_selection)
+    schedule.every(SKILL_FLUSH_SECONDS).seconds.do(flush_answered_tasks)
+    schedule.every(SWEEP_SECONDS).seconds.do(leader_only(sweep_pending_airdrops))
+    schedule.every(LEADER_CHECK_SECONDS).seconds.do(election.ensure)
+    schedule.every(SPOOL_REPLAY_SECONDS).seconds.do(replay_write_spool)
+    if CALIBRATED_REWARDS:
+        schedule.every().hour.do(load_task_calibration)
+    slot_scheduler.run_forever()
+
+
+scheduler_thread = threading.Thread(target=run_scheduler, name="scheduler", daemon=True)
+
+
+# Шаги остановки (lifecycle) по порядку; remaining - секунд до срока остановки.
+# Обработчики уже принятых обновлений дорабатывают, после чего Telegram получает подтверждение
+# последнего обновления, иначе следующий экземпляр получил бы их повторно.
+# Если срок истек раньше, подтверждения нет: повтор лучше потери.
+def drain_handlers(remaining: float):
+    deadline = time_module.monotonic() + remaining
+    pool = bot.worker_pool
+    while not pool.tasks.empty() and time_module.monotonic() < deadline:
+        time_module.sleep(0.05)
+    for worker in pool.workers:
+        worker.stop()
+    for worker in pool.workers:
+        worker.join(max(0.0, deadline - time_module.monotonic()))
+    if not pool.tasks.empty() or any(worker.is_alive() for worker in pool.workers):
+        logger.warning("Не все обработчики завершились до срока остановки")
+        return
+    if bot.last_update_id:
+        bot.get_updates(offset=bot.last_update_id + 1, timeout=max(1, int(deadline - time_module.monotonic())),
+                        long_polling_timeout=0)
+
+
+# Рассылка замечает остановку сама и сохраняет место продолжения в airdrop_runs
+def stop_scheduler(remaining: float):
+    slot_scheduler.stop()
+    if scheduler_thread.is_alive():
+        scheduler_thread.join(remaining)
+        if scheduler_thread.is_alive():
+            logger.warning("Планировщик не остановился до срока")
+
+
+def flush_buffers(remaining: float):
+    flush_skill_ratings()
+    flush_answered_tasks()
+    replay_write_spool()
+    spool.close()
+    if len(spool):
+        logger.warning("В журнале записей остается до следующего запуска: %s", len(spool))
+
+
+# Сессии остаются в журнале и восстанавливаются следующим экземпляром; таймеры останавливаются
+# до снимка, чтобы истечение сроков не меняло сессии во время записи
+def checkpoint_sessions(remaining: float):
+    timers.stop()
+    journal.checkpoint()
+    journal.close()
+    logger.info("Сессий сохранено: %s", len(journal))
+
+
+# Открытая транзакция откатывается, лидерство освобождается. Приостановленные рассылки
+# подхватывают другие экземпляры по NOTIFY (после снятия блокировки лидера, иначе они пропустят слот)
+def release_connections(remaining: float):
+    rollback()
+    election.release()
+    if paused_runs:
+        try:
+            storage.notify_scheduler(RESUME_PAYLOAD)
+            commit()
+            logger.info("Приостановлены рассылки: %s", ", ".join(f"{key} ({shard})" for key, shard in paused_runs))
+        except DB_ERRORS as e:
+            logger.error("Ошибка БД при уведомлении о приостановленных рассылках: %s", e)
+            rollback()
+    storage.close()
+
+
+lifecycle.on_stop(bot.stop_polling)
+lifecycle.on_stop(slot_scheduler.stop)
+lifecycle.add_step("обработчики сообщений", drain_handlers)
+lifecycle.add_step("рассылка и планировщик", stop_scheduler)
+lifecycle.add_step("буферы БД", flush_buffers)
+lifecycle.add_step("сессии", checkpoint_sessions)
+lifecycle.add_step("соединения", release_connections)
 
 
 if __name__ == "__main__":
+    lifecycle.install_signal_handlers()
     try:
-        scheduler_thread = threading.Thread(target=run_scheduler)
-        scheduler_thread.daemon = True
+        start_metrics_server(int(os.getenv("METRICS_PORT", "9108")))
+        load_skill_ratings()
+        load_answered_tasks()
+        if CALIBRATED_REWARDS:
+            load_task_calibration()
+        restore_sessions()
+        if spool.load():
+            logger.info("Журнал записей с прошлого запуска: %s, будут отправлены в БД", len(spool))
+
         scheduler_thread.start()
 
         logger.info("Бот запущен")
-        bot.infinity_polling()
+        bot.infinity_polling(long_polling_timeout=POLL_TIMEOUT_SECONDS)
     except Exception as e:
-        logger.error(f"Ошибка в работе бота: {e}")
+        logger.error("Ошибка в работе бота: %s", e)
     finally:
-        cur.close()
-        conn.close()
+        lifecycle.shutdown()
         logger.info("Бот остановлен")
+        shutdown_logging()
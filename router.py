@@ -0,0 +1,153 @@
+import threading
+import time as time_module
+from typing import Any, Callable, Dict, Optional
+
+
+# Нормализация текста сообщения для поиска маршрута
+def normalize_text(text: Optional[str]) -> str:
+    if not text:
+        return ""
+    return " ".join(text.split()).casefold()
+
+
+# Извлечение команды из текста: "/claim@MyBot drop_1" -> "claim"
+def extract_command(text: Optional[str]) -> Optional[str]:
+    if not text or not text.startswith("/"):
+        return None
+    command = text[1:].split(maxsplit=1)[0] if len(text) > 1 else ""
+    return command.split("@", 1)[0].casefold() or None
+
+
+# Аргумент команды: "/start drop_1" -> "drop_1" (параметр deep link t.me/<bot>?start=...)
+def extract_payload(text: Optional[str]) -> Optional[str]:
+    if not text or not text.startswith("/"):
+        return None
+    parts = text.split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else None
+
+
+# Статистика задержек по маршруту
+class RouteStats:
+    __slots__ = ("count", "errors", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, elapsed: float, failed: bool):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if failed:
+            self.errors += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": (self.total / self.count * 1000) if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+# Маршрутизатор сообщений: словари команд, кнопок и таблица состояний.
+# Порядок: команда -> текст кнопки -> состояние пользователя -> обработчик по умолчанию.
+# admission(user_id, route) вызывается до обработчика; False - сообщение отбрасывается.
+class Router:
+    def __init__(self, get_state: Callable[[int], Optional[str]]):
+        self._get_state = get_state
+        self._commands: Dict[str, Callable] = {}
+        self._texts: Dict[str, Callable] = {}
+        self._states: Dict[str, Callable] = {}
+        self._default: Optional[Callable] = None
+        self._stats: Dict[str, RouteStats] = {}
+        self._stats_lock = threading.Lock()
+        self._observers = []
+        self._admission: Optional[Callable[[int, str], bool]] = None
+
+    def command(self, *names: str):
+        def decorator(handler):
+            for name in names:
+                self._commands[name.casefold()] = handler
+            return handler
+        return decorator
+
+    def text(self, *texts: str):
+        def decorator(handler):
+            for text in texts:
+                self._texts[normalize_text(text)] = handler
+            return handler
+        return decorator
+
+    def state(self, *states: str):
+        def decorator(handler):
+            for state in states:
+                self._states[state] = handler
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self._default = handler
+        return handler
+
+    # Подписка на замеры задержки: observer(route, elapsed_seconds, failed)
+    def add_observer(self, observer: Callable[[str, float, bool], None]):
+        self._observers.append(observer)
+
+    def set_admission(self, admission: Optional[Callable[[int, str], bool]]):
+        self._admission = admission
+
+    def resolve(self, user_id: int, text: Optional[str]):
+        command = extract_command(text)
+        if command is not None:
+            handler = self._commands.get(command)
+            if handler is not None:
+                return "/" + command, handler
+
+        handler = self._texts.get(normalize_text(text))
+        if handler is not None:
+            return handler.__name__, handler
+
+        state = self._get_state(user_id)
+        if state is not None:
+            handler = self._states.get(state)
+            if handler is not None:
+                return state, handler
+
+        if self._default is not None:
+            return "default", self._default
+        return None, None
+
+    def dispatch(self, message) -> Optional[str]:
+        route, handler = self.resolve(message.from_user.id, message.text)
+        if handler is None:
+            return None
+        if self._admission is not None and not self._admission(message.from_user.id, route):
+            return None
+
+        started = time_module.perf_counter()
+        failed = False
+        try:
+            handler(message)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._observe(route, time_module.perf_counter() - started, failed)
+        return route
+
+    def _observe(self, route: str, elapsed: float, failed: bool):
+        with self._stats_lock:
+            stats = self._stats.get(route)
+            if stats is None:
+                stats = self._stats[route] = RouteStats()
+            stats.observe(elapsed, failed)
+        for observer in self._observers:
+            observer(route, elapsed, failed)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._stats_lock:
+            return {route: s.as_dict() for route, s in self._stats.items()}
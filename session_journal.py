@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+# Журнал активных сессий (вопрос или капча в процессе) на локальном диске.
+# Каждое изменение дописывается строкой JSON: [user_id, сессия] или [user_id] при завершении;
+# сессия - компактный список полей (его формат задает вызывающий код). Строка записывается в ОС сразу,
+# поэтому падение процесса ее не теряет; при fsync=True журнал переживает и падение машины
+# ценой fsync на каждую запись.
+# Когда записей становится в compact_ratio раз больше живых сессий, журнал переписывается снимком
+# (временный файл + os.replace), так что его размер ограничен числом активных сессий.
+class SessionJournal:
+    def __init__(self, path: str, fsync: bool = False, compact_ratio: int = 4, min_records: int = 10000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.min_records = min_records
+        self._sessions: Dict[int, List[Any]] = {}
+        self._records = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # Воспроизведение журнала: последняя запись по пользователю побеждает.
+    # Оборванная при падении последняя строка пропускается, и тогда журнал сразу переписывается,
+    # чтобы следующая запись не склеилась с обрывком; иначе сжатие - по обычному порогу.
+    def load(self) -> Dict[int, List[Any]]:
+        with self._lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except FileNotFoundError:
+                text = ""
+            lines = text.splitlines()
+            records, skipped = self._parse(lines)
+            self._sessions = {}
+            for record in records:
+                if len(record) > 1:
+                    self._sessions[record[0]] = record[1]
+                else:
+                    self._sessions.pop(record[0], None)
+            self._records = len(lines)
+            if skipped:
+                logger.warning("Журнал сессий %s: пропущено поврежденных строк: %s", self.path, skipped)
+            if skipped or (text and not text.endswith("\n")) or self._records > self._compact_threshold():
+                self._compact()
+            return dict(self._sessions)
+
+    # Весь журнал разбирается одним вызовом json.loads; построчно - только если есть поврежденные строки
+    @staticmethod
+    def _parse(lines):
+        try:
+            records = json.loads("[" + ",".join(lines) + "]")
+            if all(isinstance(record, list) and record for record in records):
+                return records, 0
+        except ValueError:
+            pass
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, list) and record:
+                records.append(record)
+        return records, len(lines) - len(records)
+
+    def put(self, user_id: int, session: List[Any]):
+        with self._lock:
+            self._sessions[user_id] = session
+            self._append([user_id, session])
+
+    # Завершение сессии; для пользователя без сессии ничего не пишется
+    def drop(self, user_id: int):
+        with self._lock:
+            if self._sessions.pop(user_id, None) is not None:
+                self._append([user_id])
+
+    # Снимок живых сессий на диск с fsync (остановка): следующий экземпляр читает короткий журнал,
+    # и записи, сделанные без fsync, не теряются при падении машины после остановки
+    def checkpoint(self):
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _append(self, record: List[Any]):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._records += 1
+        if self._records > self._compact_threshold():
+            self._compact()
+
+    def _compact_threshold(self) -> int:
+        return max(self.min_records, self.compact_ratio * len(self._sessions))
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for user_id, session in self._sessions.items():
+                f.write(json.dumps([user_id, session], ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self._records = len(self._sessions)
@@ -0,0 +1,255 @@
+import math
+import random
+import threading
+from array import array
+from typing import Any, Container, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from answered_tasks import catalog_fingerprint
+from task_bank import TaskBank
+
+LEVELS = ["легкий", "средний", "сложный"]
+
+DEFAULT_USER_RATING = 1500.0
+# Стартовые рейтинги вопросов по уровню до накопления статистики
+LEVEL_BASE_RATINGS = {"легкий": 1300.0, "средний": 1500.0, "сложный": 1700.0}
+
+BUCKET_WIDTH = 10.0  # Шаг таблицы быстрого поиска по рейтингу
+
+
+# Вероятность правильного ответа по Эло
+def expected_success(user_rating: float, task_rating: float) -> float:
+    return 1.0 / (1.0 + 10 ** ((task_rating - user_rating) / 400.0))
+
+
+# Рейтинг вопроса, на который пользователь отвечает с вероятностью target
+def target_task_rating(user_rating: float, target: float) -> float:
+    return user_rating - 400.0 * math.log10(target / (1.0 - target))
+
+
+def _k_factor(answers: int, base: float) -> float:
+    return base * 2 if answers < 30 else base
+
+
+# Таблица поиска по одному уровню: вопросы, отсортированные по рейтингу, и индекс корзин
+class _LevelIndex:
+    __slots__ = ("order", "ratings", "low", "buckets", "mean")
+
+    def __init__(self, task_ids: Iterable[int], ratings: array):
+        self.order = array("I", sorted(task_ids, key=ratings.__getitem__))
+        self.ratings = array("d", (ratings[task_id] for task_id in self.order))
+        self.mean = sum(self.ratings) / len(self.ratings) if self.ratings else 0.0
+        self.low = self.ratings[0] if self.ratings else 0.0
+        # buckets[i] - позиция первого вопроса с рейтингом >= low + i * BUCKET_WIDTH
+        self.buckets = array("i")
+        if self.ratings:
+            count = int((self.ratings[-1] - self.low) // BUCKET_WIDTH) + 2
+            position = 0
+            for bucket in range(count):
+                bound = self.low + bucket * BUCKET_WIDTH
+                while position < len(self.ratings) and self.ratings[position] < bound:
+                    position += 1
+                self.buckets.append(position)
+
+    def position(self, rating: float) -> int:
+        bucket = int((rating - self.low) // BUCKET_WIDTH)
+        if bucket <= 0:
+            return 0
+        if bucket >= len(self.buckets):
+            return len(self.order) - 1
+        return min(self.buckets[bucket], len(self.order) - 1)
+
+
+# Модель навыков: рейтинги Эло пользователей и вопросов в компактных массивах.
+# Обновляется на каждом ответе, выбирает уровень и вопрос под целевую вероятность успеха.
+# Таблицы выбора перестраиваются только в prepare_selection (начало рассылки, таймер):
+# между перестройками выбор идет по немного устаревшим рейтингам вопросов.
+#
+# task_id - индекс задачи в каталоге: для словаря из task_data.json - по порядку LEVELS,
+# для банка задач - индекс задачи в файле. Банк при запуске не перебирается: уровни - диапазоны
+# индексов (level_ranges), вопрос ищется по хеш-таблице банка, задача декодируется только при выдаче.
+# catalog - отпечаток каталога, по которому сохраняются наборы отвеченных задач
+class SkillModel:
+    def __init__(self, tasks: Union[Dict[str, List[Dict[str, Any]]], TaskBank], target_success: float = 0.7,
+                 exploration: float = 0.1, neighbours: int = 3):
+        self.target_success = target_success
+        self.exploration = exploration
+        self.neighbours = neighbours
+
+        self.level_ranges: Dict[str, range] = {}
+        if isinstance(tasks, TaskBank):
+            self._bank = tasks
+            self._tasks: List[Tuple[str, Dict[str, Any]]] = []
+            self._task_index: Dict[Tuple[str, str], int] = {}
+            for level in LEVELS:
+                level_tasks = tasks.levels.get(level)
+                if level_tasks is not None:
+                    self.level_ranges[level] = range(level_tasks.first, level_tasks.first + len(level_tasks))
+            self.size = len(tasks)
+            self.catalog = tasks.catalog
+        else:
+            self._bank = None
+            self._tasks = [(level, task) for level in LEVELS for task in tasks.get(level, [])]
+            self._task_index = {(level, task["question"]): task_id
+                                for task_id, (level, task) in enumerate(self._tasks)}
+            first = 0
+            for level in LEVELS:
+                count = len(tasks.get(level, []))
+                self.level_ranges[level] = range(first, first + count)
+                first += count
+            self.size = len(self._tasks)
+            self.catalog = catalog_fingerprint((level, task["question"]) for level, task in self._tasks)
+        self.task_ratings = array("d", [DEFAULT_USER_RATING]) * self.size
+        self.task_answers = array("i", [0]) * self.size
+        for level, task_ids in self.level_ranges.items():
+            self.task_ratings[task_ids.start:task_ids.stop] = (
+                array("d", [LEVEL_BASE_RATINGS.get(level, DEFAULT_USER_RATING)]) * len(task_ids))
+
+        self.user_slots: Dict[int, int] = {}
+        self.user_ratings = array("d")
+        self.user_answers = array("i")
+
+        self._dirty_users: Set[int] = set()
+        self._dirty_tasks: Set[int] = set()
+        self._levels: Dict[str, _LevelIndex] = {}
+        self._stale = True
+        self._lock = threading.Lock()
+
+    # Индекс задачи по уровню и тексту вопроса или None
+    def task_id(self, level: str, question: str) -> Optional[int]:
+        if level not in self.level_ranges:
+            return None
+        if self._bank is not None:
+            return self._bank.index(level, question)
+        return self._task_index.get((level, question))
+
+    def task(self, task_id: int) -> Dict[str, Any]:
+        if self._bank is not None:
+            return self._bank.task(task_id)
+        return self._tasks[task_id][1]
+
+    def _task_level(self, task_id: int) -> Optional[str]:
+        for level, task_ids in self.level_ranges.items():
+            if task_id in task_ids:
+                return level
+        return None
+
+    def _user_slot(self, user_id: int) -> int:
+        slot = self.user_slots.get(user_id)
+        if slot is None:
+            slot = self.user_slots[user_id] = len(self.user_ratings)
+            self.user_ratings.append(DEFAULT_USER_RATING)
+            self.user_answers.append(0)
+        return slot
+
+    def user_rating(self, user_id: int) -> float:
+        slot = self.user_slots.get(user_id)
+        return self.user_ratings[slot] if slot is not None else DEFAULT_USER_RATING
+
+    # Загрузка сохраненных рейтингов
+    def load_users(self, rows: Iterable[Tuple[int, float, int]]):
+        with self._lock:
+            for user_id, rating, answers in rows:
+                slot = self._user_slot(user_id)
+                self.user_ratings[slot] = rating
+                self.user_answers[slot] = answers
+
+    def load_tasks(self, rows: Iterable[Tuple[str, str, float, int]]):
+        with self._lock:
+            for level, question, rating, answers in rows:
+                task_id = self.task_id(level, question)
+                if task_id is not None:
+                    self.task_ratings[task_id] = rating
+                    self.task_answers[task_id] = answers
+            self._stale = True
+
+    # Инкрементальное обновление Эло после ответа
+    def update(self, user_id: int, level: str, question: str, correct: bool):
+        task_id = self.task_id(level, question)
+        if task_id is None:
+            return
+        with self._lock:
+            slot = self._user_slot(user_id)
+            user_rating = self.user_ratings[slot]
+            task_rating = self.task_ratings[task_id]
+            surprise = (1.0 if correct else 0.0) - expected_success(user_rating, task_rating)
+            self.user_ratings[slot] = user_rating + _k_factor(self.user_answers[slot], 16.0) * surprise
+            self.task_ratings[task_id] = task_rating - _k_factor(self.task_answers[task_id], 8.0) * surprise
+            self.user_answers[slot] += 1
+            self.task_answers[task_id] += 1
+            self._dirty_users.add(user_id)
+            self._dirty_tasks.add(task_id)
+            self._stale = True
+
+    # Перестройка таблиц поиска по снимку рейтингов, если они менялись. Сортировка идет вне блокировки:
+    # ответы продолжают обновлять рейтинги, выбор до замены таблиц идет по прежним
+    def prepare_selection(self):
+        with self._lock:
+            if not self._stale:
+                return
+            ratings = array("d", self.task_ratings)
+            self._stale = False
+        self._levels = {
+            level: _LevelIndex(task_ids, ratings)
+            for level, task_ids in self.level_ranges.items() if task_ids
+        }
+
+    # Таблицы выбора; строятся при первом обращении, дальше - только в prepare_selection
+    def _selection(self) -> Dict[str, _LevelIndex]:
+        if not self._levels and self._stale:
+            self.prepare_selection()
+        return self._levels
+
+    def choose_level(self, user_id: int, rng=random) -> Optional[str]:
+        index = self._selection()
+        levels = list(index)
+        if not levels:
+            return None
+        if rng.random() < self.exploration:
+            return rng.choice(levels)
+        wanted = target_task_rating(self.user_rating(user_id), self.target_success)
+        return min(levels, key=lambda level: abs(index[level].mean - wanted))
+
+    # Вопрос уровня с рейтингом около целевого; answered - уже отвеченные вопросы (task_id)
+    def choose_task(self, user_id: int, level: str, answered: Container[int] = frozenset(),
+                    rng=random) -> Optional[Dict[str, Any]]:
+        index = self._selection().get(level)
+        if index is None:
+            return None
+        wanted = target_task_rating(self.user_rating(user_id), self.target_success)
+        center = index.position(wanted)
+
+        candidates = []
+        low, high = center - 1, center
+        size = len(index.order)
+        # Расходимся от целевой позиции, пропуская отвеченные вопросы
+        while len(candidates) < self.neighbours and (low >= 0 or high < size):
+            for position in (high, low):
+                if 0 <= position < size:
+                    task_id = index.order[position]
+                    if task_id not in answered:
+                        candidates.append(task_id)
+            low -= 1
+            high += 1
+        if not candidates:
+            return self.task(index.order[center])
+        return self.task(rng.choice(candidates[:self.neighbours]))
+
+    # Рейтинги, которые не удалось сохранить (строки из take_dirty), сохраняются при следующей попытке
+    # с текущими значениями
+    def requeue(self, users: Iterable[Tuple[int, float, int]], tasks: Iterable[Tuple[str, str, float, int]]):
+        task_ids = [self.task_id(level, question) for level, question, _, _ in tasks]
+        with self._lock:
+            self._dirty_users.update(user_id for user_id, _, _ in users)
+            self._dirty_tasks.update(task_id for task_id in task_ids if task_id is not None)
+
+    # Измененные с прошлого сохранения рейтинги: (пользователи, вопросы)
+    def take_dirty(self):
+        with self._lock:
+            users = [(user_id, self.user_ratings[self.user_slots[user_id]],
+                      self.user_answers[self.user_slots[user_id]]) for user_id in self._dirty_users]
+            tasks = [(task_id, self.task_ratings[task_id], self.task_answers[task_id]) for task_id in self._dirty_tasks]
+            self._dirty_users.clear()
+            self._dirty_tasks.clear()
+        # Уровень и вопрос декодируются только для измененных вопросов и вне блокировки
+        return users, [(self._task_level(task_id), self.task(task_id)["question"], rating, answers)
+                       for task_id, rating, answers in tasks]
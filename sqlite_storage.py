@@ -0,0 +1,599 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Dict
+
+from answered_tasks import EMPTY
+from delivery_windows import WAVE_BUCKETS, WAVE_MULTIPLIER
+from storage import LANGUAGE_CODES, NO_PART, Storage, part_bounds
+
+# Схема для встроенной базы: те же таблицы и столбцы, что в PostgreSQL, в типах SQLite.
+# Время - местное время сервера ('YYYY-MM-DD HH:MM:SS', как CURRENT_TIMESTAMP в PostgreSQL).
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    balance INTEGER DEFAULT 0,
+    correct_answers INTEGER DEFAULT 0,
+    total_questions INTEGER DEFAULT 0,
+    registered_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    last_airdrop TIMESTAMP,
+    airdrops_today INTEGER DEFAULT 0,
+    airdrop_reset_date DATE DEFAULT (date('now', 'localtime')),
+    daily_airdrop_limit INTEGER DEFAULT 0,
+    require_captcha BOOLEAN DEFAULT 0,
+    device_fingerprint TEXT,
+    is_suspicious BOOLEAN DEFAULT 0,
+    last_seen TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    blocked_at TIMESTAMP,
+    timezone TEXT
+);
+DROP INDEX IF EXISTS users_delivery_timezone_idx;
+DROP INDEX IF EXISTS users_delivery_language_idx;
+CREATE INDEX IF NOT EXISTS users_delivery_timezone_wave_idx
+    ON users (timezone, (((user_id % 65536) * 40503) % 65536)) WHERE blocked_at IS NULL;
+CREATE INDEX IF NOT EXISTS users_delivery_language_wave_idx
+    ON users (lower(json_extract(device_fingerprint, '$.language_code')), (((user_id % 65536) * 40503) % 65536))
+    WHERE blocked_at IS NULL AND timezone IS NULL;
+
+CREATE TABLE IF NOT EXISTS user_answers (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER REFERENCES users(user_id),
+    question TEXT,
+    answer TEXT,
+    is_correct BOOLEAN,
+    level TEXT,
+    answered_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    answer_time_ms INTEGER,
+    op_id TEXT
+);
+CREATE INDEX IF NOT EXISTS user_answers_user_level_idx ON user_answers (user_id, level);
+CREATE UNIQUE INDEX IF NOT EXISTS user_answers_op_id_idx ON user_answers (op_id) WHERE op_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    delta INTEGER NOT NULL DEFAULT 0,
+    correct_delta INTEGER NOT NULL DEFAULT 0,
+    questions_delta INTEGER NOT NULL DEFAULT 0,
+    reason TEXT NOT NULL,
+    question TEXT,
+    created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    rolled_up BOOLEAN NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS balance_ledger_pending_idx ON balance_ledger (user_id) WHERE NOT rolled_up;
+
+CREATE TABLE IF NOT EXISTS airdrop_schedule (
+    id INTEGER PRIMARY KEY,
+    scheduled_time TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pending_airdrops (
+    user_id INTEGER NOT NULL,
+    slot TEXT NOT NULL,
+    level TEXT NOT NULL,
+    question TEXT NOT NULL,
+    require_captcha BOOLEAN NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    reminded BOOLEAN NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, slot)
+);
+CREATE INDEX IF NOT EXISTS pending_airdrops_claim_idx ON pending_airdrops (user_id, created_at);
+CREATE INDEX IF NOT EXISTS pending_airdrops_created_idx ON pending_airdrops (created_at);
+
+CREATE TABLE IF NOT EXISTS airdrop_claims (
+    user_id INTEGER NOT NULL,
+    slot TEXT NOT NULL,
+    claimed_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    PRIMARY KEY (user_id, slot)
+);
+CREATE INDEX IF NOT EXISTS airdrop_claims_claimed_at_idx ON airdrop_claims (claimed_at);
+
+CREATE TABLE IF NOT EXISTS airdrop_runs (
+    slot TEXT NOT NULL,
+    shard INTEGER NOT NULL DEFAULT -1,
+    instance TEXT,
+    status TEXT NOT NULL DEFAULT 'running',
+    started_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    finished_at TIMESTAMP,
+    users_assigned INTEGER,
+    notifications_sent INTEGER,
+    resume_after INTEGER,
+    PRIMARY KEY (slot, shard)
+);
+
+CREATE TABLE IF NOT EXISTS user_skill (
+    user_id INTEGER PRIMARY KEY,
+    rating REAL NOT NULL,
+    answers INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS task_skill (
+    level TEXT NOT NULL,
+    question TEXT NOT NULL,
+    rating REAL NOT NULL,
+    answers INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (level, question)
+);
+
+CREATE TABLE IF NOT EXISTS task_calibration (
+    level TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answers INTEGER NOT NULL,
+    accuracy REAL NOT NULL,
+    median_answer_ms INTEGER,
+    discrimination REAL,
+    difficulty REAL NOT NULL,
+    suggested_reward INTEGER NOT NULL,
+    calibrated_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    PRIMARY KEY (level, question)
+);
+
+CREATE TABLE IF NOT EXISTS user_answered_tasks (
+    user_id INTEGER PRIMARY KEY,
+    catalog INTEGER NOT NULL,
+    tasks BLOB NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS user_answered_tasks_updated_idx ON user_answered_tasks (updated_at);
+"""
+
+LANGUAGE_CODES_JSON = json.dumps(LANGUAGE_CODES)
+
+# Часть слота - те же ветки, что в PostgresStorage; списки поясов и language_code - JSON (json_each)
+FANOUT_FILTER = """
+    FROM users u
+    WHERE u.user_id > ?
+    AND u.blocked_at IS NULL
+    AND (? <= 0 OR u.last_seen >= datetime('now', 'localtime', (-?) || ' days'))
+    AND (? IS NULL
+         OR u.timezone IN (SELECT value FROM json_each(?))
+         OR (u.timezone IS NULL
+             AND lower(json_extract(u.device_fingerprint, '$.language_code')) IN (SELECT value FROM json_each(?)))
+         OR (? AND u.timezone IS NULL
+             AND COALESCE(lower(json_extract(u.device_fingerprint, '$.language_code')), '')
+                 NOT IN (SELECT value FROM json_each(?))))
+    AND ((u.user_id % ?) * ?) % ? >= ? AND ((u.user_id % ?) * ?) % ? < ?
+"""
+
+
+def _timestamp(value: bytes) -> datetime:
+    return datetime.fromisoformat(value.decode())
+
+
+def _date(value: bytes) -> date:
+    return date.fromisoformat(value.decode())
+
+
+sqlite3.register_converter("TIMESTAMP", _timestamp)
+sqlite3.register_converter("DATE", _date)
+sqlite3.register_converter("BOOLEAN", lambda value: value not in (b"0", b""))
+
+# Первичные коды SQLite, при которых база занята или недоступна, а сам запрос верен:
+# SQLITE_BUSY, SQLITE_LOCKED, SQLITE_IOERR, SQLITE_FULL, SQLITE_CANTOPEN
+UNAVAILABLE_CODES = (5, 6, 10, 13, 14)
+# Те же ошибки по тексту, если sqlite_errorcode нет (Python до 3.11)
+UNAVAILABLE_MESSAGES = ("database is locked", "database table is locked", "disk i/o error",
+                        "database or disk is full", "unable to open database file")
+
+
+# Занятая или недоступная база. Остальные OperationalError (нет столбца, синтаксис запроса) -
+# ошибки самого запроса: их бессмысленно откладывать в журнал записей и повторять
+class DatabaseUnavailableError(sqlite3.OperationalError):
+    pass
+
+
+def _unavailable(error: sqlite3.OperationalError) -> bool:
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in UNAVAILABLE_CODES
+    return str(error).lower().startswith(UNAVAILABLE_MESSAGES)
+
+
+@contextmanager
+def _classified():
+    try:
+        yield
+    except DatabaseUnavailableError:
+        raise
+    except sqlite3.OperationalError as e:
+        if _unavailable(e):
+            raise DatabaseUnavailableError(*e.args) from e
+        raise
+
+
+# Соединение, у которого занятость и недоступность базы выделены в DatabaseUnavailableError
+class _Connection(sqlite3.Connection):
+    def execute(self, *args):
+        with _classified():
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with _classified():
+            return super().executemany(*args)
+
+    def executescript(self, *args):
+        with _classified():
+            return super().executescript(*args)
+
+    def commit(self):
+        with _classified():
+            super().commit()
+
+    def rollback(self):
+        with _classified():
+            super().rollback()
+
+
+# Встроенная база SQLite для одного узла и для бенчмарков без внешних сервисов.
+# WAL: чтение не ждет записи; synchronous=NORMAL - fsync на контрольной точке, а не на каждом коммите,
+# поэтому записи стоит группировать в одну транзакцию (методы пачками, commit после группы).
+# Как и в PostgresStorage, у каждого потока свое соединение и своя транзакция: commit/rollback одного
+# обработчика не затрагивают незавершенную работу другого. Транзакция начинается с первой записи и держит
+# блокировку записи базы до commit, остальные пишущие потоки ждут ее до timeout соединения.
+# База одного узла: уведомлять другие экземпляры некому.
+class SqliteStorage(Storage):
+    errors = (sqlite3.Error,)
+    # Занятая или недоступная база (database is locked, disk I/O error)
+    connection_errors = (DatabaseUnavailableError,)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    # Соединение текущего потока; открывается при первом запросе потока, соединения завершившихся потоков
+    # закрываются при открытии следующего
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with _classified():
+                conn = sqlite3.connect(self.path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES,
+                                       isolation_level="DEFERRED", factory=_Connection)
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            conn.execute("PRAGMA foreign_keys = ON;")
+            self._local.conn = conn
+            with self._lock:
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    # Все соединения при остановке, в том числе других потоков
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+            self._local = threading.local()
+
+    def commit(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.commit()
+
+    def rollback(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.rollback()
+
+    def _execute(self, query: str, params=()):
+        return self._conn.execute(query, params)
+
+    def _fetchone(self, query: str, params=()):
+        return self._conn.execute(query, params).fetchone()
+
+    def _fetchall(self, query: str, params=()):
+        return self._conn.execute(query, params).fetchall()
+
+    def register_user(self, user_id, username, first_name, last_name, device_info):
+        similar_users_count = self._fetchone("""
+            SELECT COUNT(*) FROM users
+            WHERE json_extract(device_fingerprint, '$.language_code') = ? AND NOT is_suspicious;
+        """, (device_info.get("language_code"),))[0]
+        is_suspicious = similar_users_count >= 3
+        if self._fetchone("SELECT 1 FROM users WHERE user_id = ?;", (user_id,)) is not None:
+            return None
+        self._execute("""
+            INSERT INTO users (user_id, username, first_name, last_name, balance, require_captcha,
+                               device_fingerprint, is_suspicious)
+            VALUES (?, ?, ?, ?, 0, 0, ?, ?);
+        """, (user_id, username, first_name, last_name, json.dumps(device_info), is_suspicious))
+        return is_suspicious
+
+    def touch_user(self, user_id):
+        self._execute("""
+            UPDATE users SET last_seen = datetime('now', 'localtime'), blocked_at = NULL WHERE user_id = ?;
+        """, (user_id,))
+
+    def balance(self, user_id):
+        return self._fetchone("""
+            SELECT u.balance + COALESCE(SUM(l.delta), 0),
+                   u.correct_answers + COALESCE(SUM(l.correct_delta), 0),
+                   u.total_questions + COALESCE(SUM(l.questions_delta), 0)
+            FROM users u
+            LEFT JOIN balance_ledger l ON l.user_id = u.user_id AND NOT l.rolled_up
+            WHERE u.user_id = ?
+            GROUP BY u.user_id;
+        """, (user_id,))
+
+    def airdrop_limits(self, user_id):
+        return self._fetchone("""
+            SELECT airdrop_reset_date, airdrops_today, daily_airdrop_limit,
+                   json_extract(device_fingerprint, '$.language_code'), is_suspicious
+            FROM users WHERE user_id = ?;
+        """, (user_id,))
+
+    def reset_daily_limit(self, user_id, daily_limit):
+        self._execute("""
+            UPDATE users
+            SET airdrops_today = 0, airdrop_reset_date = date('now', 'localtime'), daily_airdrop_limit = ?
+            WHERE user_id = ?;
+        """, (daily_limit, user_id))
+
+    def claim_profile(self, user_id):
+        return self._fetchone("""
+            SELECT is_suspicious, timezone, json_extract(device_fingerprint, '$.language_code')
+            FROM users WHERE user_id = ?;
+        """, (user_id,))
+
+    def user_timezone(self, user_id):
+        row = self._fetchone("SELECT timezone FROM users WHERE user_id = ?;", (user_id,))
+        return row[0] if row else None
+
+    def set_user_timezone(self, user_id, timezone):
+        self._execute("UPDATE users SET timezone = ? WHERE user_id = ?;", (timezone, user_id))
+
+    def suspicious_users(self, limit):
+        return self._fetchall("""
+            SELECT user_id, username, first_name, last_name,
+                   json_extract(device_fingerprint, '$.language_code'), registered_at
+            FROM users WHERE is_suspicious ORDER BY registered_at DESC LIMIT ?;
+        """, (limit,))
+
+    def mark_blocked(self, user_ids, drop_pending=True, refund_today=False):
+        rows = [(user_id,) for user_id in user_ids]
+        self._conn.executemany(f"""
+            UPDATE users
+            SET blocked_at = datetime('now', 'localtime')
+                {", airdrops_today = MAX(airdrops_today - 1, 0)" if refund_today else ""}
+            WHERE user_id = ?;
+        """, rows)
+        if drop_pending:
+            self._conn.executemany("DELETE FROM pending_airdrops WHERE user_id = ?;", rows)
+
+    @staticmethod
+    def _part_params(after, dormant_days, part):
+        zones, codes, with_default, low, high = part_bounds(part)
+        zones_json = json.dumps(zones) if zones is not None else None
+        return (after, dormant_days, dormant_days, zones_json, zones_json or "[]", json.dumps(codes), with_default,
+                LANGUAGE_CODES_JSON, WAVE_BUCKETS, WAVE_MULTIPLIER, WAVE_BUCKETS, low,
+                WAVE_BUCKETS, WAVE_MULTIPLIER, WAVE_BUCKETS, high)
+
+    def fanout_users(self, after, dormant_days, shard, shard_count, part=NO_PART):
+        rows = self._fetchall(f"""
+            SELECT u.user_id {FANOUT_FILTER}
+            AND (? IS NULL OR u.user_id % ? = ?)
+            AND (NOT u.is_suspicious OR abs(random()) % 10 < 3)
+            ORDER BY u.user_id;
+        """, self._part_params(after, dormant_days, part) + (shard, shard_count, shard))
+        return [row[0] for row in rows]
+
+    def fanout_page(self, after, dormant_days, part, limit):
+        return self._fetchall(f"""
+            SELECT u.user_id, u.is_suspicious, json_extract(u.device_fingerprint, '$.language_code')
+            {FANOUT_FILTER}
+            ORDER BY u.user_id
+            LIMIT ?;
+        """, self._part_params(after, dormant_days, part) + (limit,))
+
+    # Пачка в одной транзакции: executemany по строкам, начисление - только для новых op_id
+    def write_answers(self, answers):
+        for op_id, user_id, level, question, answer, is_correct, answer_time_ms, reason, delta, \
+                correct_delta, answered_at in answers:
+            answered = datetime.fromtimestamp(answered_at).isoformat(" ", "seconds")
+            inserted = self._conn.execute("""
+                INSERT INTO user_answers
+                (user_id, question, answer, is_correct, level, answer_time_ms, answered_at, op_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (op_id) WHERE op_id IS NOT NULL DO NOTHING;
+            """, (user_id, question, answer, is_correct, level, answer_time_ms, answered, op_id)).rowcount
+            if inserted:
+                self._conn.execute("""
+                    INSERT INTO balance_ledger
+                    (user_id, delta, correct_delta, questions_delta, reason, question, created_at)
+                    VALUES (?, ?, ?, 1, ?, ?, ?);
+                """, (user_id, delta, correct_delta, reason, question, answered))
+
+    def answer_stats(self, user_id):
+        rows = self._fetchall("""
+            SELECT COUNT(*), SUM(is_correct), level FROM user_answers WHERE user_id = ? GROUP BY level;
+        """, (user_id,))
+        return {level: [total, correct] for total, correct, level in rows}
+
+    def schedule_slots(self):
+        return [row[0] for row in self._fetchall("SELECT DISTINCT scheduled_time FROM airdrop_schedule;")]
+
+    def user_timezones(self):
+        return [row[0] for row in self._fetchall("SELECT DISTINCT timezone FROM users WHERE timezone IS NOT NULL;")]
+
+    def enqueue_airdrops(self, slot, rows):
+        inserted = set()
+        for user_id, level, question, require_captcha in rows:
+            if self._conn.execute("""
+                INSERT INTO pending_airdrops (user_id, slot, level, question, require_captcha)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, slot) DO NOTHING;
+            """, (user_id, slot, level, question, require_captcha)).rowcount:
+                inserted.add(user_id)
+        self._conn.executemany("""
+            UPDATE users
+            SET last_airdrop = datetime('now', 'localtime'), airdrops_today = airdrops_today + 1
+            WHERE user_id = ?;
+        """, [(user_id,) for user_id in inserted])
+        return inserted
+
+    def pop_pending_airdrop(self, user_id):
+        row = self._fetchone("""
+            DELETE FROM pending_airdrops
+            WHERE rowid = (SELECT rowid FROM pending_airdrops WHERE user_id = ? ORDER BY created_at LIMIT 1)
+            RETURNING level, question,
+                      require_captcha OR COALESCE(
+                          (SELECT is_suspicious FROM users u WHERE u.user_id = pending_airdrops.user_id), 0);
+        """, (user_id,))
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def expire_pending(self, ttl_minutes):
+        return self._execute("""
+            DELETE FROM pending_airdrops WHERE created_at < datetime('now', 'localtime', (-?) || ' minutes');
+        """, (ttl_minutes,)).rowcount
+
+    def mark_reminders(self, older_than_minutes, limit):
+        marked = self._conn.execute("""
+            UPDATE pending_airdrops SET reminded = 1
+            WHERE rowid IN (
+                SELECT rowid FROM pending_airdrops
+                WHERE NOT reminded AND created_at < datetime('now', 'localtime', (-?) || ' minutes')
+                LIMIT ?
+            )
+            RETURNING user_id, level, created_at;
+        """, (older_than_minutes, limit)).fetchall()
+        oldest = {}
+        for user_id, level, created_at in marked:
+            if user_id not in oldest or created_at < oldest[user_id][1]:
+                oldest[user_id] = (level, created_at)
+        languages = dict(self._conn.execute(f"""
+            SELECT user_id, json_extract(device_fingerprint, '$.language_code')
+            FROM users WHERE user_id IN ({",".join("?" * len(oldest))});
+        """, list(oldest)).fetchall()) if oldest else {}
+        return [(user_id, level, created_at, languages.get(user_id))
+                for user_id, (level, created_at) in sorted(oldest.items()) if user_id in languages]
+
+    def record_claim(self, user_id, slots):
+        for slot in slots:
+            if self._conn.execute("""
+                INSERT INTO airdrop_claims (user_id, slot) VALUES (?, ?) ON CONFLICT DO NOTHING;
+            """, (user_id, slot)).rowcount:
+                return slot
+        return None
+
+    def count_claim(self, user_id):
+        self._execute("""
+            UPDATE users
+            SET last_airdrop = datetime('now', 'localtime'), airdrops_today = airdrops_today + 1
+            WHERE user_id = ?;
+        """, (user_id,))
+
+    def expire_claims(self, ttl_minutes):
+        self._execute("""
+            DELETE FROM airdrop_claims WHERE claimed_at < datetime('now', 'localtime', (-?) || ' minutes');
+        """, (ttl_minutes,))
+
+    def start_run(self, slot, shard, instance):
+        return self._fetchone("""
+            INSERT INTO airdrop_runs (slot, shard, instance) VALUES (?, ?, ?)
+            ON CONFLICT (slot, shard) DO UPDATE
+            SET status = 'running', instance = excluded.instance, finished_at = NULL
+            WHERE airdrop_runs.status = 'paused'
+            RETURNING resume_after;
+        """, (slot, shard, instance))
+
+    def finish_run(self, slot, shard, assigned, sent, status, resume_after):
+        self._execute("""
+            UPDATE airdrop_runs
+            SET finished_at = datetime('now', 'localtime'),
+                users_assigned = COALESCE(users_assigned, 0) + ?,
+                notifications_sent = COALESCE(notifications_sent, 0) + ?,
+                status = ?,
+                resume_after = ?
+            WHERE slot = ? AND shard = ?;
+        """, (assigned, sent, status, resume_after, slot, shard))
+
+    def notify_scheduler(self, payload):
+        pass
+
+    def rollup_ledger(self, batch_size):
+        marked = self._conn.execute("""
+            UPDATE balance_ledger SET rolled_up = 1
+            WHERE id IN (SELECT id FROM balance_ledger WHERE NOT rolled_up ORDER BY id LIMIT ?)
+            RETURNING user_id, delta, correct_delta, questions_delta;
+        """, (batch_size,)).fetchall()
+        sums = {}
+        for user_id, delta, correct_delta, questions_delta in marked:
+            total = sums.setdefault(user_id, [0, 0, 0])
+            total[0] += delta
+            total[1] += correct_delta
+            total[2] += questions_delta
+        self._conn.executemany("""
+            UPDATE users
+            SET balance = balance + ?, correct_answers = correct_answers + ?,
+                total_questions = total_questions + ?
+            WHERE user_id = ?;
+        """, [(delta, correct_delta, questions_delta, user_id)
+              for user_id, (delta, correct_delta, questions_delta) in sums.items()])
+        return len(marked)
+
+    def task_calibration(self):
+        rows = self._fetchall("SELECT level, question, suggested_reward FROM task_calibration;")
+        return {(level, question): reward for level, question, reward in rows}
+
+    def user_skills(self):
+        return self._fetchall("SELECT user_id, rating, answers FROM user_skill;")
+
+    def task_skills(self):
+        return self._fetchall("SELECT level, question, rating, answers FROM task_skill;")
+
+    def save_user_skills(self, rows):
+        self._conn.executemany("""
+            INSERT INTO user_skill (user_id, rating, answers) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET rating = excluded.rating, answers = excluded.answers;
+        """, rows)
+
+    def save_task_skills(self, rows):
+        self._conn.executemany("""
+            INSERT INTO task_skill (level, question, rating, answers) VALUES (?, ?, ?, ?)
+            ON CONFLICT (level, question) DO UPDATE SET rating = excluded.rating, answers = excluded.answers;
+        """, rows)
+
+    def answer_history(self):
+        cursor = self._conn.execute("SELECT user_id, level, question, is_correct FROM user_answers ORDER BY id;")
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                return
+            yield from rows
+
+    def answered_tasks(self, catalog, since):
+        since = since.isoformat(" ", "seconds") if since is not None else None
+        return [(user_id, bytes(tasks), updated_at) for user_id, tasks, updated_at in self._fetchall("""
+            SELECT user_id, tasks, updated_at FROM user_answered_tasks
+            WHERE catalog = ? AND (? IS NULL OR updated_at > datetime(?, '-1 minute'));
+        """, (catalog, since, since))]
+
+    # Вставка начинает транзакцию записи: база заблокирована для других соединений до commit
+    def lock_answered_tasks(self, catalog, user_ids):
+        self._conn.executemany("""
+            INSERT INTO user_answered_tasks (user_id, catalog, tasks) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO NOTHING;
+        """, [(user_id, catalog, EMPTY.encode()) for user_id in user_ids])
+        rows = self._conn.execute("""
+            SELECT user_id, catalog, tasks FROM user_answered_tasks
+            WHERE user_id IN (SELECT value FROM json_each(?))
+            ORDER BY user_id;
+        """, (json.dumps(list(user_ids)),)).fetchall()
+        return [(user_id, bytes(tasks)) for user_id, row_catalog, tasks in rows if row_catalog == catalog]
+
+    def save_answered_tasks(self, catalog, rows):
+        self._conn.executemany("""
+            INSERT INTO user_answered_tasks (user_id, catalog, tasks) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE
+            SET catalog = excluded.catalog, tasks = excluded.tasks, updated_at = datetime('now', 'localtime');
+        """, [(user_id, catalog, tasks) for user_id, tasks in rows])
@@ -0,0 +1,749 @@
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import psycopg2
+
+from airdrop_scheduler import SCHEDULE_CHANNEL
+from answered_tasks import EMPTY
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from db_profiler import QueryProfiler
+from delivery_windows import LANGUAGE_TIMEZONES, WAVE_BUCKETS, WAVE_MULTIPLIER
+
+logger = logging.getLogger(__name__)
+
+LANGUAGE_CODES = list(LANGUAGE_TIMEZONES)
+
+# Фильтр части слота рассылки: (часовые пояса или None - любые, пояс по умолчанию, волна, число волн)
+PartFilter = Tuple[Optional[Sequence[str]], str, int, int]
+NO_PART: PartFilter = (None, "UTC", 0, 1)
+
+
+# Условия части слота, по которым ее пользователи читаются по индексам, а не обходом всех users:
+# (пояса или None, language_code этих поясов, входит ли пояс по умолчанию,
+#  диапазон [low, high) значения волны ((user_id % WAVE_BUCKETS) * WAVE_MULTIPLIER) % WAVE_BUCKETS)
+def part_bounds(part: PartFilter) -> Tuple[Optional[List[str]], List[str], bool, int, int]:
+    zones, default_timezone, wave, waves = part
+    low = -(-wave * WAVE_BUCKETS // waves)
+    high = -(-(wave + 1) * WAVE_BUCKETS // waves)
+    if zones is None:
+        return None, [], False, low, high
+    codes = [code for code in LANGUAGE_CODES if LANGUAGE_TIMEZONES[code] in zones]
+    return list(zones), codes, default_timezone in zones, low, high
+
+
+# Хранилище пользователей, ответов, расписания, очереди airdrop, запусков слотов и рейтингов.
+# Транзакцией управляет вызывающий код: методы не коммитят, commit()/rollback() - после группы вызовов.
+# errors - исключения хранилища, connection_errors - из них те, при которых БД недоступна
+# (ответы откладываются в журнал записей). Записи в answers: [op_id, user_id, level, question, answer,
+# is_correct, answer_time_ms, reason, delta, correct_delta, answered_at (time.time())]
+class Storage(ABC):
+    errors: Tuple[type, ...] = ()
+    connection_errors: Tuple[type, ...] = ()
+
+    @abstractmethod
+    def commit(self):
+        ...
+
+    @abstractmethod
+    def rollback(self):
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    # Пользователи
+
+    # Регистрация с проверкой на мультиаккаунты: 3+ неподозрительных пользователя с тем же language_code.
+    # None - пользователь уже был, иначе is_suspicious нового пользователя
+    @abstractmethod
+    def register_user(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                      last_name: Optional[str], device_info: Dict[str, Any]) -> Optional[bool]:
+        ...
+
+    @abstractmethod
+    def touch_user(self, user_id: int):
+        ...
+
+    # (баланс, правильных ответов, всего вопросов) с учетом еще не перенесенного журнала начислений
+    @abstractmethod
+    def balance(self, user_id: int) -> Optional[Tuple[int, int, int]]:
+        ...
+
+    # (дата сброса лимита, выдано сегодня, дневной лимит, language_code, is_suspicious)
+    @abstractmethod
+    def airdrop_limits(self, user_id: int) -> Optional[Tuple[date, int, int, Optional[str], bool]]:
+        ...
+
+    @abstractmethod
+    def reset_daily_limit(self, user_id: int, daily_limit: int):
+        ...
+
+    # (is_suspicious, timezone, language_code) для забора в режиме hashed
+    @abstractmethod
+    def claim_profile(self, user_id: int) -> Optional[Tuple[bool, Optional[str], Optional[str]]]:
+        ...
+
+    @abstractmethod
+    def user_timezone(self, user_id: int) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set_user_timezone(self, user_id: int, timezone: str):
+        ...
+
+    # [(user_id, username, first_name, last_name, language_code, registered_at)], новые первыми
+    @abstractmethod
+    def suspicious_users(self, limit: int) -> List[Tuple]:
+        ...
+
+    # Пользователи, заблокировавшие бота: исключаются из рассылок; drop_pending - их очередь удаляется,
+    # refund_today - выданный сегодня airdrop не считается в дневном лимите
+    @abstractmethod
+    def mark_blocked(self, user_ids: Sequence[int], drop_pending: bool = True, refund_today: bool = False):
+        ...
+
+    # Получатели рассылки stored по возрастанию user_id после after: не заблокировавшие бота, не спящие,
+    # подозрительные - с вероятностью 30%; shard - только user_id % shard_count = shard
+    @abstractmethod
+    def fanout_users(self, after: int, dormant_days: int, shard: Optional[int], shard_count: int,
+                     part: PartFilter = NO_PART) -> List[int]:
+        ...
+
+    # Страница получателей рассылки hashed: [(user_id, is_suspicious, language_code)]
+    @abstractmethod
+    def fanout_page(self, after: int, dormant_days: int, part: PartFilter, limit: int) -> List[Tuple]:
+        ...
+
+    # Ответы
+
+    # Ответы и начисления пачкой; повтор записи с тем же op_id ничего не добавляет
+    @abstractmethod
+    def write_answers(self, answers: Sequence[Sequence[Any]]):
+        ...
+
+    # {уровень: [ответов, правильных]}
+    @abstractmethod
+    def answer_stats(self, user_id: int) -> Dict[str, List[int]]:
+        ...
+
+    # Расписание
+
+    @abstractmethod
+    def schedule_slots(self) -> List[str]:
+        ...
+
+    # Часовые пояса, заданные пользователями командой /timezone
+    @abstractmethod
+    def user_timezones(self) -> List[str]:
+        ...
+
+    # Очередь airdrop
+
+    # Постановка пачки в очередь слота и учет в дневных счетчиках.
+    # rows: [(user_id, level, question, require_captcha)]; возвращает user_id поставленных (без повторов)
+    @abstractmethod
+    def enqueue_airdrops(self, slot: str, rows: Sequence[Tuple[int, str, str, bool]]) -> Set[int]:
+        ...
+
+    # Самый старый airdrop пользователя: (уровень, вопрос, нужна ли капча) или None
+    @abstractmethod
+    def pop_pending_airdrop(self, user_id: int) -> Optional[Tuple[str, str, bool]]:
+        ...
+
+    # Удаление airdrop старше ttl_minutes; возвращает число удаленных
+    @abstractmethod
+    def expire_pending(self, ttl_minutes: int) -> int:
+        ...
+
+    # Отметка airdrop старше older_than_minutes как напомненных (не больше limit);
+    # [(user_id, уровень, момент выдачи, language_code)] - по одному, самому старому, на пользователя
+    @abstractmethod
+    def mark_reminders(self, older_than_minutes: int, limit: int) -> List[Tuple[int, str, datetime, Optional[str]]]:
+        ...
+
+    # Забор в режимах hashed и channel
+
+    # Отметка о заборе первого еще не забранного слота из slots (по порядку); ключ слота или None
+    @abstractmethod
+    def record_claim(self, user_id: int, slots: Sequence[str]) -> Optional[str]:
+        ...
+
+    # Учет забранного по объявлению airdrop в дневных счетчиках
+    @abstractmethod
+    def count_claim(self, user_id: int):
+        ...
+
+    # Удаление отметок о заборе старше ttl_minutes: слот к этому времени уже закрыт
+    @abstractmethod
+    def expire_claims(self, ttl_minutes: int):
+        ...
+
+    # Запуски слотов
+
+    # Запись о запуске (ключ слота, шард) от instance: None - слот уже запускался,
+    # иначе (resume_after,) - user_id продолжения приостановленной рассылки или None
+    @abstractmethod
+    def start_run(self, slot: str, shard: int, instance: str) -> Optional[Tuple[Optional[int]]]:
+        ...
+
+    @abstractmethod
+    def finish_run(self, slot: str, shard: int, assigned: int, sent: int, status: str,
+                   resume_after: Optional[int]):
+        ...
+
+    # Уведомление планировщиков остальных экземпляров (после commit)
+    @abstractmethod
+    def notify_scheduler(self, payload: str):
+        ...
+
+    # Журнал начислений и калибровка
+
+    # Перенос до batch_size записей журнала начислений в users; возвращает число перенесенных
+    @abstractmethod
+    def rollup_ledger(self, batch_size: int) -> int:
+        ...
+
+    # {(уровень, вопрос): рекомендованная награда}
+    @abstractmethod
+    def task_calibration(self) -> Dict[Tuple[str, str], int]:
+        ...
+
+    # Рейтинги и отвеченные задачи
+
+    # [(user_id, рейтинг, ответов)]
+    @abstractmethod
+    def user_skills(self) -> List[Tuple[int, float, int]]:
+        ...
+
+    # [(уровень, вопрос, рейтинг, ответов)]
+    @abstractmethod
+    def task_skills(self) -> List[Tuple[str, str, float, int]]:
+        ...
+
+    @abstractmethod
+    def save_user_skills(self, rows: Sequence[Tuple[int, float, int]]):
+        ...
+
+    @abstractmethod
+    def save_task_skills(self, rows: Sequence[Tuple[str, str, float, int]]):
+        ...
+
+    # Вся история ответов по порядку записи, частями: (user_id, уровень, вопрос, is_correct)
+    @abstractmethod
+    def answer_history(self) -> Iterator[Tuple[int, str, str, bool]]:
+        ...
+
+    # Наборы отвеченных задач каталога catalog, сохраненные позже since (с запасом в минуту, since=None - все):
+    # [(user_id, TaskSet.encode(), updated_at)]
+    @abstractmethod
+    def answered_tasks(self, catalog: int, since: Optional[datetime]) -> List[Tuple[int, bytes, datetime]]:
+        ...
+
+    # Блокировка наборов user_ids (по возрастанию) до конца транзакции: новым пользователям вставляются
+    # пустые наборы, чтобы другой экземпляр ждал и их. Возвращает [(user_id, TaskSet.encode())] каталога catalog
+    @abstractmethod
+    def lock_answered_tasks(self, catalog: int, user_ids: Sequence[int]) -> List[Tuple[int, bytes]]:
+        ...
+
+    # rows: [(user_id, TaskSet.encode())]
+    @abstractmethod
+    def save_answered_tasks(self, catalog: int, rows: Sequence[Tuple[int, bytes]]):
+        ...
+
+
+# PostgreSQL: у каждого потока (обработчики сообщений, планировщик, таймеры, напоминания) свое соединение
+# и своя транзакция - запросы и commit/rollback разных потоков не перемешиваются на одном курсоре.
+# Соединение открывается при первом запросе потока (connect) и заново после разрыва; соединения
+# завершившихся потоков закрываются при открытии следующего. Запросы идут через профилировщик
+# (имя запроса - ключ статистики); пока предохранитель разомкнут, запрос не отправляется (CircuitOpenError)
+class PostgresStorage(Storage):
+    errors = (psycopg2.Error,)
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def __init__(self, connect: Callable[[], Any], profiler: QueryProfiler, breaker: CircuitBreaker):
+        self._connect = connect
+        self._profiler = profiler
+        self._breaker = breaker
+        self._local = threading.local()
+        self._connections: Dict[threading.Thread, Any] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _conn(self):
+        return getattr(self._local, "conn", None)
+
+    @property
+    def _cur(self):
+        return self._local.cur
+
+    def _connection(self):
+        conn = self._conn
+        if conn is None or conn.closed:
+            if conn is not None:
+                logger.info("Соединение с БД переустановлено")
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.cur = conn.cursor()
+            with self._lock:
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    def _execute(self, name: str, query: str, params=None):
+        if not self._breaker.allow():
+            raise CircuitOpenError("БД недоступна")
+        try:
+            self._connection()
+            self._profiler.execute(self._cur, name, query, params)
+        except self.connection_errors:
+            self._breaker.record_failure()
+            raise
+        except Exception:
+            # Ошибка самого запроса: БД на связи, пробный запрос тоже считается успешным
+            self._breaker.record_success()
+            raise
+        self._breaker.record_success()
+
+    # Чтение большой выборки частями через именованный курсор (время - в профилировщике)
+    def _stream(self, name: str, query: str, params=None):
+        if not self._breaker.allow():
+            raise CircuitOpenError("БД недоступна")
+        try:
+            yield from self._profiler.stream(self._connection(), name, query, params)
+        except self.connection_errors:
+            self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+
+    def _fetchone(self, name: str, query: str, params=None):
+        self._execute(name, query, params)
+        return self._cur.fetchone()
+
+    def _fetchall(self, name: str, query: str, params=None):
+        self._execute(name, query, params)
+        return self._cur.fetchall()
+
+    def commit(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.commit()
+        except self.connection_errors:
+            self._breaker.record_failure()
+            raise
+
+    # Откат после ошибки; на разорванном соединении откатывать нечего
+    def rollback(self):
+        if self._conn is None or self._conn.closed:
+            return
+        try:
+            self._conn.rollback()
+        except self.connection_errors as e:
+            self._breaker.record_failure()
+            logger.warning("Откат не выполнен: %s", e)
+
+    # Все соединения при остановке, в том числе других потоков
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                if not conn.closed:
+                    conn.close()
+            self._connections.clear()
+
+    def register_user(self, user_id, username, first_name, last_name, device_info):
+        similar_users_count = self._fetchone("count_similar_fingerprints", """
+            SELECT COUNT(*) FROM users
+            WHERE device_fingerprint::json->>'language_code' = %s
+            AND is_suspicious = FALSE
+            LIMIT 5;
+        """, (device_info.get("language_code"),))[0]
+        is_suspicious = similar_users_count >= 3
+
+        if self._fetchone("select_user", "SELECT 1 FROM users WHERE user_id = %s;", (user_id,)) is not None:
+            return None
+        self._execute("insert_user", """
+            INSERT INTO users
+            (user_id, username, first_name, last_name, balance, require_captcha,
+             device_fingerprint, is_suspicious)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+        """, (user_id, username, first_name, last_name, 0, False, json.dumps(device_info), is_suspicious))
+        return is_suspicious
+
+    def touch_user(self, user_id):
+        self._execute("touch_user", """
+            UPDATE users SET last_seen = CURRENT_TIMESTAMP, blocked_at = NULL
+            WHERE user_id = %s;
+        """, (user_id,))
+
+    def balance(self, user_id):
+        return self._fetchone("select_balance", """
+            SELECT u.balance + COALESCE(SUM(l.delta), 0),
+                   u.correct_answers + COALESCE(SUM(l.correct_delta), 0),
+                   u.total_questions + COALESCE(SUM(l.questions_delta), 0)
+            FROM users u
+            LEFT JOIN balance_ledger l ON l.user_id = u.user_id AND NOT l.rolled_up
+            WHERE u.user_id = %s
+            GROUP BY u.user_id;
+        """, (user_id,))
+
+    def airdrop_limits(self, user_id):
+        return self._fetchone("select_airdrop_limits", """
+            SELECT airdrop_reset_date, airdrops_today, daily_airdrop_limit,
+                   device_fingerprint->>'language_code', is_suspicious
+            FROM users
+            WHERE user_id = %s;
+        """, (user_id,))
+
+    def reset_daily_limit(self, user_id, daily_limit):
+        self._execute("reset_daily_limit", """
+            UPDATE users
+            SET airdrops_today = 0,
+                airdrop_reset_date = CURRENT_DATE,
+                daily_airdrop_limit = %s
+            WHERE user_id = %s;
+        """, (daily_limit, user_id))
+
+    def claim_profile(self, user_id):
+        return self._fetchone("select_claim_profile", """
+            SELECT is_suspicious, timezone, device_fingerprint->>'language_code'
+            FROM users WHERE user_id = %s;
+        """, (user_id,))
+
+    def user_timezone(self, user_id):
+        row = self._fetchone("select_user_timezone", "SELECT timezone FROM users WHERE user_id = %s;", (user_id,))
+        return row[0] if row else None
+
+    def set_user_timezone(self, user_id, timezone):
+        self._execute("update_user_timezone", "UPDATE users SET timezone = %s WHERE user_id = %s;", (timezone, user_id))
+
+    def suspicious_users(self, limit):
+        return self._fetchall("select_suspicious_users", """
+            SELECT user_id, username, first_name, last_name,
+                   device_fingerprint::json->>'language_code' as lang,
+                   registered_at
+            FROM users
+            WHERE is_suspicious = TRUE
+            ORDER BY registered_at DESC
+            LIMIT %s;
+        """, (limit,))
+
+    def mark_blocked(self, user_ids, drop_pending=True, refund_today=False):
+        self._execute("mark_blocked_users", """
+            WITH blocked AS (
+                UPDATE users
+                SET blocked_at = CURRENT_TIMESTAMP,
+                    airdrops_today = CASE WHEN %s THEN GREATEST(airdrops_today - 1, 0) ELSE airdrops_today END
+                WHERE user_id = ANY(%s)
+            )
+            DELETE FROM pending_airdrops WHERE %s AND user_id = ANY(%s);
+        """, (refund_today, list(user_ids), drop_pending, list(user_ids)))
+
+    # Часть слота: явный часовой пояс, пояс по language_code, пояс по умолчанию для остальных;
+    # каждая ветка и диапазон волны - по индексам users_delivery_timezone_wave_idx и users_delivery_language_wave_idx
+    PART_FILTER = """
+            AND (%s::text[] IS NULL
+                 OR u.timezone = ANY(%s::text[])
+                 OR (u.timezone IS NULL AND lower(u.device_fingerprint->>'language_code') = ANY(%s::text[]))
+                 OR (%s AND u.timezone IS NULL
+                     AND NOT COALESCE(lower(u.device_fingerprint->>'language_code'), '') = ANY(%s::text[])))
+            AND ((u.user_id %% %s) * %s) %% %s >= %s AND ((u.user_id %% %s) * %s) %% %s < %s
+    """
+
+    @staticmethod
+    def _part_params(part: PartFilter):
+        zones, codes, with_default, low, high = part_bounds(part)
+        return (zones, zones, codes, with_default, LANGUAGE_CODES,
+                WAVE_BUCKETS, WAVE_MULTIPLIER, WAVE_BUCKETS, low, WAVE_BUCKETS, WAVE_MULTIPLIER, WAVE_BUCKETS, high)
+
+    def fanout_users(self, after, dormant_days, shard, shard_count, part=NO_PART):
+        rows = self._fetchall("select_fanout_users", f"""
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > %s
+            AND u.blocked_at IS NULL
+            AND (%s <= 0 OR u.last_seen >= CURRENT_TIMESTAMP - make_interval(days => %s))
+            AND (%s::integer IS NULL OR u.user_id %% %s = %s)
+            AND (u.is_suspicious = FALSE
+                 OR (u.is_suspicious = TRUE AND random() < 0.3))
+            {self.PART_FILTER}
+            ORDER BY u.user_id;
+        """, (after, dormant_days, dormant_days, shard, shard_count, shard) + self._part_params(part))
+        return [row[0] for row in rows]
+
+    def fanout_page(self, after, dormant_days, part, limit):
+        return self._fetchall("select_fanout_page", f"""
+            SELECT u.user_id, u.is_suspicious, u.device_fingerprint->>'language_code'
+            FROM users u
+            WHERE u.user_id > %s
+            AND u.blocked_at IS NULL
+            AND (%s <= 0 OR u.last_seen >= CURRENT_TIMESTAMP - make_interval(days => %s))
+            {self.PART_FILTER}
+            ORDER BY u.user_id
+            LIMIT %s;
+        """, (after, dormant_days, dormant_days) + self._part_params(part) + (limit,))
+
+    # Строка user_answers и запись в журнал начислений одним запросом; op_id защищает от повторов
+    def write_answers(self, answers):
+        self._execute("insert_answers", """
+            WITH op AS (
+                SELECT DISTINCT ON (op_id) *
+                FROM unnest(%s::text[], %s::bigint[], %s::text[], %s::text[], %s::text[], %s::boolean[],
+                            %s::integer[], %s::text[], %s::integer[], %s::integer[], %s::double precision[])
+                     AS op(op_id, user_id, level, question, answer, is_correct, answer_time_ms, reason,
+                           delta, correct_delta, answered_at)
+            ), answer AS (
+                INSERT INTO user_answers
+                (user_id, question, answer, is_correct, level, answer_time_ms, answered_at, op_id)
+                SELECT user_id, question, answer, is_correct, level, answer_time_ms,
+                       to_timestamp(answered_at)::timestamp, op_id
+                FROM op
+                ON CONFLICT (op_id) WHERE op_id IS NOT NULL DO NOTHING
+                RETURNING op_id
+            )
+            INSERT INTO balance_ledger
+            (user_id, delta, correct_delta, questions_delta, reason, question, created_at)
+            SELECT op.user_id, op.delta, op.correct_delta, 1, op.reason, op.question,
+                   to_timestamp(op.answered_at)::timestamp
+            FROM op JOIN answer USING (op_id);
+        """, [list(column) for column in zip(*answers)])
+
+    def answer_stats(self, user_id):
+        rows = self._fetchall("select_stats", """
+            SELECT
+                COUNT(*) as total_answers,
+                SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) as correct_answers,
+                level
+            FROM user_answers
+            WHERE user_id = %s
+            GROUP BY level;
+        """, (user_id,))
+        return {level: [total, correct] for total, correct, level in rows}
+
+    def schedule_slots(self):
+        rows = self._fetchall("select_schedule", "SELECT DISTINCT scheduled_time FROM airdrop_schedule;")
+        return [str(row[0]) for row in rows]
+
+    def user_timezones(self):
+        rows = self._fetchall("select_user_timezones",
+                              "SELECT DISTINCT timezone FROM users WHERE timezone IS NOT NULL;")
+        return [row[0] for row in rows]
+
+    def enqueue_airdrops(self, slot, rows):
+        user_ids, levels, questions, captchas = (list(column) for column in zip(*rows))
+        inserted = {row[0] for row in self._fetchall("insert_pending_airdrops", """
+            INSERT INTO pending_airdrops (user_id, slot, level, question, require_captcha)
+            SELECT item.user_id, %s, item.level, item.question, item.require_captcha
+            FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::boolean[])
+                 AS item(user_id, level, question, require_captcha)
+            ON CONFLICT (user_id, slot) DO NOTHING
+            RETURNING user_id;
+        """, (slot, user_ids, levels, questions, captchas))}
+        if inserted:
+            self._execute("count_delivered_airdrops", """
+                UPDATE users
+                SET last_airdrop = CURRENT_TIMESTAMP,
+                    airdrops_today = airdrops_today + 1
+                WHERE user_id = ANY(%s);
+            """, (list(inserted),))
+        return inserted
+
+    # Одной операцией; для подозрительных аккаунтов капча требуется всегда
+    def pop_pending_airdrop(self, user_id):
+        return self._fetchone("pop_pending_airdrop", """
+            DELETE FROM pending_airdrops p
+            USING (
+                SELECT user_id, slot FROM pending_airdrops
+                WHERE user_id = %s
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            ) oldest
+            WHERE p.user_id = oldest.user_id AND p.slot = oldest.slot
+            RETURNING p.level, p.question,
+                      p.require_captcha OR COALESCE(
+                          (SELECT is_suspicious FROM users u WHERE u.user_id = p.user_id), FALSE);
+        """, (user_id,))
+
+    def expire_pending(self, ttl_minutes):
+        self._execute("expire_pending_airdrops", """
+            DELETE FROM pending_airdrops
+            WHERE created_at < CURRENT_TIMESTAMP - make_interval(mins => %s);
+        """, (ttl_minutes,))
+        return self._cur.rowcount
+
+    def mark_reminders(self, older_than_minutes, limit):
+        return self._fetchall("mark_pending_reminders", """
+            WITH marked AS (
+                UPDATE pending_airdrops p
+                SET reminded = TRUE
+                FROM (
+                    SELECT user_id, slot FROM pending_airdrops
+                    WHERE NOT reminded
+                    AND created_at < CURRENT_TIMESTAMP - make_interval(mins => %s)
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) due
+                WHERE p.user_id = due.user_id AND p.slot = due.slot
+                RETURNING p.user_id, p.level, p.created_at
+            )
+            SELECT DISTINCT ON (m.user_id)
+                   m.user_id, m.level, m.created_at, u.device_fingerprint->>'language_code'
+            FROM marked m
+            JOIN users u ON u.user_id = m.user_id
+            ORDER BY m.user_id, m.created_at;
+        """, (older_than_minutes, limit))
+
+    def record_claim(self, user_id, slots):
+        claimed = self._fetchone("insert_airdrop_claim", """
+            INSERT INTO airdrop_claims (user_id, slot)
+            SELECT %s, candidate.slot
+            FROM unnest(%s::text[]) WITH ORDINALITY AS candidate(slot, position)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM airdrop_claims c WHERE c.user_id = %s AND c.slot = candidate.slot
+            )
+            ORDER BY candidate.position
+            LIMIT 1
+            ON CONFLICT DO NOTHING
+            RETURNING slot;
+        """, (user_id, list(slots), user_id))
+        return claimed[0] if claimed else None
+
+    def count_claim(self, user_id):
+        self._execute("count_claimed_airdrop", """
+            UPDATE users 
+            SET last_airdrop = CURRENT_TIMESTAMP,
+                airdrops_today = airdrops_today + 1
+            WHERE user_id = %s;
+        """, (user_id,))
+
+    def expire_claims(self, ttl_minutes):
+        self._execute("expire_airdrop_claims", """
+            DELETE FROM airdrop_claims
+            WHERE claimed_at < CURRENT_TIMESTAMP - make_interval(mins => %s);
+        """, (ttl_minutes,))
+
+    def start_run(self, slot, shard, instance):
+        return self._fetchone("start_airdrop_run", """
+            INSERT INTO airdrop_runs (slot, shard, instance)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (slot, shard) DO UPDATE
+            SET status = 'running', instance = EXCLUDED.instance, finished_at = NULL
+            WHERE airdrop_runs.status = 'paused'
+            RETURNING resume_after;
+        """, (slot, shard, instance))
+
+    def finish_run(self, slot, shard, assigned, sent, status, resume_after):
+        self._execute("finish_airdrop_run", """
+            UPDATE airdrop_runs 
+            SET finished_at = CURRENT_TIMESTAMP,
+                users_assigned = COALESCE(users_assigned, 0) + %s,
+                notifications_sent = COALESCE(notifications_sent, 0) + %s,
+                status = %s,
+                resume_after = %s
+            WHERE slot = %s AND shard = %s;
+        """, (assigned, sent, status, resume_after, slot, shard))
+
+    def notify_scheduler(self, payload):
+        self._execute("notify_scheduler", "SELECT pg_notify(%s, %s);", (SCHEDULE_CHANNEL, payload))
+
+    def rollup_ledger(self, batch_size):
+        return self._fetchone("rollup_ledger", """
+            WITH batch AS (
+                SELECT id FROM balance_ledger
+                WHERE NOT rolled_up
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), marked AS (
+                UPDATE balance_ledger l SET rolled_up = TRUE
+                FROM batch WHERE l.id = batch.id
+                RETURNING l.user_id, l.delta, l.correct_delta, l.questions_delta
+            ), sums AS (
+                SELECT user_id,
+                       SUM(delta) AS delta,
+                       SUM(correct_delta) AS correct_delta,
+                       SUM(questions_delta) AS questions_delta
+                FROM marked
+                GROUP BY user_id
+            ), applied AS (
+                UPDATE users u
+                SET balance = u.balance + s.delta,
+                    correct_answers = u.correct_answers + s.correct_delta,
+                    total_questions = u.total_questions + s.questions_delta
+                FROM sums s
+                WHERE u.user_id = s.user_id
+            )
+            SELECT COUNT(*) FROM marked;
+        """, (batch_size,))[0]
+
+    def task_calibration(self):
+        rows = self._fetchall("select_task_calibration",
+                              "SELECT level, question, suggested_reward FROM task_calibration;")
+        return {(level, question): reward for level, question, reward in rows}
+
+    def user_skills(self):
+        return self._fetchall("select_user_skill", "SELECT user_id, rating, answers FROM user_skill;")
+
+    def task_skills(self):
+        return self._fetchall("select_task_skill", "SELECT level, question, rating, answers FROM task_skill;")
+
+    def save_user_skills(self, rows):
+        user_ids, ratings, answers = zip(*rows)
+        self._execute("upsert_user_skill", """
+            INSERT INTO user_skill (user_id, rating, answers)
+            SELECT * FROM unnest(%s::bigint[], %s::real[], %s::integer[])
+            ON CONFLICT (user_id) DO UPDATE
+            SET rating = EXCLUDED.rating, answers = EXCLUDED.answers;
+        """, (list(user_ids), list(ratings), list(answers)))
+
+    def save_task_skills(self, rows):
+        levels, questions, ratings, answers = zip(*rows)
+        self._execute("upsert_task_skill", """
+            INSERT INTO task_skill (level, question, rating, answers)
+            SELECT * FROM unnest(%s::text[], %s::text[], %s::real[], %s::integer[])
+            ON CONFLICT (level, question) DO UPDATE
+            SET rating = EXCLUDED.rating, answers = EXCLUDED.answers;
+        """, (list(levels), list(questions), list(ratings), list(answers)))
+
+    def answer_history(self):
+        return self._stream("answer_history", """
+            SELECT user_id, level, question, is_correct FROM user_answers ORDER BY id;
+        """)
+
+    def answered_tasks(self, catalog, since):
+        rows = self._fetchall("select_answered_tasks", """
+            SELECT user_id, tasks, updated_at FROM user_answered_tasks
+            WHERE catalog = %s
+            AND (%s::timestamp IS NULL OR updated_at > %s::timestamp - INTERVAL '1 minute');
+        """, (catalog, since, since))
+        return [(user_id, bytes(tasks), updated_at) for user_id, tasks, updated_at in rows]
+
+    # Строки блокируются в порядке user_id: сохранения разных экземпляров ждут друг друга, а не взаимоблокируются
+    def lock_answered_tasks(self, catalog, user_ids):
+        self._execute("insert_empty_answered_tasks", """
+            INSERT INTO user_answered_tasks (user_id, catalog, tasks)
+            SELECT item.user_id, %s, %s FROM unnest(%s::bigint[]) AS item(user_id)
+            ON CONFLICT (user_id) DO NOTHING;
+        """, (catalog, EMPTY.encode(), list(user_ids)))
+        rows = self._fetchall("lock_answered_tasks", """
+            SELECT user_id, catalog, tasks FROM user_answered_tasks
+            WHERE user_id = ANY(%s::bigint[])
+            ORDER BY user_id
+            FOR UPDATE;
+        """, (list(user_ids),))
+        return [(user_id, bytes(tasks)) for user_id, row_catalog, tasks in rows if row_catalog == catalog]
+
+    def save_answered_tasks(self, catalog, rows):
+        user_ids, tasks = zip(*rows)
+        self._execute("upsert_answered_tasks", """
+            INSERT INTO user_answered_tasks (user_id, catalog, tasks)
+            SELECT item.user_id, %s, item.tasks
+            FROM unnest(%s::bigint[], %s::bytea[]) AS item(user_id, tasks)
+            ON CONFLICT (user_id) DO UPDATE
+            SET catalog = EXCLUDED.catalog, tasks = EXCLUDED.tasks, updated_at = CURRENT_TIMESTAMP;
+        """, (catalog, list(user_ids), list(tasks)))
@@ -0,0 +1,180 @@
+import mmap
+import struct
+import zlib
+from collections.abc import Sequence
+from typing import Any, Dict, FrozenSet, Iterable, Optional
+
+from answer_matching import accepted_answers, normalize_answer
+from answered_tasks import catalog_fingerprint
+
+# Скомпилированный банк задач (собирается build_task_bank.py из task_data.json).
+# Файл открывается через mmap только для чтения: процессы бота делят одни и те же страницы
+# кэша ОС, а задача декодируется из файла только при обращении к ней.
+#
+# Формат (little-endian, смещения - от начала файла, строки - UTF-8 в общей таблице строк):
+#   заголовок   HEADER: магия, версия, число уровней, число задач, число ячеек хеш-таблицы,
+#               смещения таблиц уровней, задач, хеш-таблицы и строк, отпечаток каталога
+#               (catalog_fingerprint уровней и вопросов в порядке задач файла)
+#   уровни      LEVEL x число уровней: имя (смещение, длина), первая задача, число задач
+#   задачи      TASK x число задач: вопрос, ответ, ключи ответа (смещение, длина), награда;
+#               ключи - нормализованные answer и aliases через "\n"
+#   хеш-таблица индекс задачи + 1 (0 - пусто) по crc32("уровень\0вопрос"), открытая адресация
+#   строки
+MAGIC = b"TBK1"
+VERSION = 2
+HEADER = struct.Struct("<4s9I")
+LEVEL = struct.Struct("<4I")
+TASK = struct.Struct("<6Ii")
+SLOT = struct.Struct("<I")
+KEY_SEPARATOR = "\n"
+
+
+def _task_key(level: str, question: str) -> bytes:
+    return f"{level}\0{question}".encode("utf-8")
+
+
+# Запись банка из словаря {уровень: [задачи]} в формате task_data.json
+def build_task_bank(tasks: Dict[str, Iterable[Dict[str, Any]]], path: str) -> int:
+    strings = bytearray()
+    string_offsets: Dict[str, int] = {}
+
+    def add_string(text: str):
+        data = text.encode("utf-8")
+        offset = string_offsets.get(text)
+        if offset is None:
+            offset = string_offsets[text] = len(strings)
+            strings.extend(data)
+        return offset, len(data)
+
+    levels = []
+    records = []
+    questions = []
+    for level, level_tasks in tasks.items():
+        first = len(records)
+        for task in level_tasks:
+            answer_keys = dict.fromkeys(key for key in map(normalize_answer, accepted_answers(task)) if key)
+            records.append(add_string(task["question"]) + add_string(str(task.get("answer", "")))
+                           + add_string(KEY_SEPARATOR.join(answer_keys)) + (int(task.get("reward", 1)),))
+            questions.append((level, task["question"]))
+        levels.append(add_string(level) + (first, len(records) - first))
+
+    slots = 1
+    while slots < len(records) * 2:
+        slots *= 2
+    table = [0] * slots
+    for index, (level, question) in enumerate(questions):
+        slot = zlib.crc32(_task_key(level, question)) & (slots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = index + 1
+
+    levels_offset = HEADER.size
+    tasks_offset = levels_offset + LEVEL.size * len(levels)
+    hash_offset = tasks_offset + TASK.size * len(records)
+    strings_offset = hash_offset + SLOT.size * slots
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(levels), len(records), slots,
+                            levels_offset, tasks_offset, hash_offset, strings_offset,
+                            catalog_fingerprint(questions)))
+        for level in levels:
+            f.write(LEVEL.pack(*level))
+        for record in records:
+            f.write(TASK.pack(*record))
+        f.write(struct.pack(f"<{slots}I", *table))
+        f.write(strings)
+    return len(records)
+
+
+# Задачи одного уровня как последовательность: len, индекс, перебор, random.choice
+class LevelTasks(Sequence):
+    def __init__(self, bank: "TaskBank", first: int, count: int):
+        self._bank = bank
+        self.first = first
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(self._count))]
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+        return self._bank.task(self.first + position)
+
+
+# Банк задач из файла: levels - {уровень: LevelTasks} вместо словаря из task_data.json,
+# find - задача по (уровень, вопрос), matches - проверка ответа по ключам, нормализованным при сборке,
+# catalog - отпечаток каталога из заголовка
+class TaskBank:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, level_count, self._task_count, self._slots, levels_offset, self._tasks_offset,
+         self._hash_offset, self._strings_offset, self.catalog) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: не банк задач версии {VERSION}")
+        self.levels: Dict[str, LevelTasks] = {}
+        for i in range(level_count):
+            name_offset, name_length, first, count = LEVEL.unpack_from(self._mmap, levels_offset + i * LEVEL.size)
+            self.levels[self._string(name_offset, name_length)] = LevelTasks(self, first, count)
+
+    def __len__(self) -> int:
+        return self._task_count
+
+    def close(self):
+        self._mmap.close()
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings_offset + offset
+        return self._mmap[start:start + length].decode("utf-8")
+
+    def _record(self, index: int):
+        return TASK.unpack_from(self._mmap, self._tasks_offset + index * TASK.size)
+
+    def task(self, index: int) -> Dict[str, Any]:
+        question_offset, question_length, answer_offset, answer_length, _, _, reward = self._record(index)
+        return {"question": self._string(question_offset, question_length),
+                "answer": self._string(answer_offset, answer_length),
+                "reward": reward}
+
+    # Глобальный индекс задачи (в порядке уровней файла) или None
+    def index(self, level: str, question: str) -> Optional[int]:
+        tasks = self.levels.get(level)
+        if tasks is None:
+            return None
+        key = question.encode("utf-8")
+        mask = self._slots - 1
+        slot = zlib.crc32(_task_key(level, question)) & mask
+        while True:
+            index = SLOT.unpack_from(self._mmap, self._hash_offset + slot * SLOT.size)[0] - 1
+            if index < 0:
+                return None
+            if tasks.first <= index < tasks.first + len(tasks):
+                question_offset, question_length = self._record(index)[:2]
+                start = self._strings_offset + question_offset
+                if question_length == len(key) and self._mmap[start:start + question_length] == key:
+                    return index
+            slot = (slot + 1) & mask
+
+    def find(self, level: str, question: str) -> Optional[Dict[str, Any]]:
+        index = self.index(level, question)
+        return self.task(index) if index is not None else None
+
+    # Как AnswerMatcher: ответ, пустой после нормализации ("!!!"), не засчитывается
+    def matches(self, level: str, question: str, answer: Optional[str]) -> bool:
+        key = normalize_answer(answer) if answer is not None else ""
+        if not key:
+            return False
+        index = self.index(level, question)
+        return index is not None and key in self.answer_keys(index)
+
+    # Нормализованные допустимые ответы; у задачи без таких ответов - пустое множество
+    def answer_keys(self, index: int) -> FrozenSet[str]:
+        keys_offset, keys_length = self._record(index)[4:6]
+        if not keys_length:
+            return frozenset()
+        return frozenset(self._string(keys_offset, keys_length).split(KEY_SEPARATOR))
@@ -0,0 +1,246 @@
+from functools import lru_cache
+from string import Formatter
+from typing import Callable, Dict, Optional, Tuple
+
+from telebot import types
+
+DEFAULT_LOCALE = "ru"
+
+# Подписи кнопок главного меню
+BUTTONS: Dict[str, Dict[str, str]] = {
+    "ru": {"balance": "Баланс", "stats": "Статистика", "help": "Помощь", "claim": "Claim Airdrop",
+           "claim_link": "🎁 Забрать airdrop"},
+    "en": {"balance": "Balance", "stats": "Stats", "help": "Help", "claim": "Claim Airdrop",
+           "claim_link": "🎁 Claim airdrop"},
+}
+
+# Названия уровней сложности (ключи совпадают с task_data.json)
+LEVEL_NAMES: Dict[str, Dict[str, str]] = {
+    "ru": {"легкий": "легкий", "средний": "средний", "сложный": "сложный"},
+    "en": {"легкий": "easy", "средний": "medium", "сложный": "hard"},
+}
+
+# Шаблоны сообщений
+MESSAGES: Dict[str, Dict[str, str]] = {
+    "ru": {
+        "welcome": (
+            "Привет, {first_name}! Вы успешно зарегистрированы. "
+            "Теперь вы будете получать ежедневные airdrop с вопросами разной сложности. "
+            "Используйте команду /claim чтобы получить вопрос, когда придет уведомление."
+        ),
+        "welcome_back": "С возвращением, {first_name}!",
+        "suspicious": (
+            "⚠️ Ваш аккаунт помечен как подозрительный. "
+            "Доступ к некоторым функциям может быть ограничен."
+        ),
+        "generic_error": "Произошла ошибка. Попробуйте позже.",
+        "no_airdrop": "У вас нет доступных airdrop. Ожидайте следующего уведомления.",
+        "claim_error": "Произошла ошибка при обработке запроса.",
+        "captcha_prompt": "Пожалуйста, введите текст с изображения для подтверждения:",
+        "captcha_expired": "Сессия капчи истекла. Попробуйте снова.",
+        "captcha_ok": "✅ Капча пройдена успешно!",
+        "captcha_failed": "❌ Неверный код. Доступ к этому airdrop'у закрыт. Ожидайте следующего уведомления.",
+        "question_error": "Произошла ошибка при получении вопроса. Ожидайте следующего airdrop.",
+        "question": (
+            "🎁 Airdrop вопрос ({level} уровень):\n{question}\n\n"
+            "У вас есть {seconds} секунд чтобы ответить!"
+        ),
+        "timeout": "⏳ Время на ответ истекло. Попробуйте получить новый airdrop позже.",
+        "correct": "✅ Правильно! Вы получили {reward} баллов за airdrop.",
+        "wrong": "❌ Неверно. Попробуйте получить новый airdrop позже.",
+        "answer_error": "Произошла ошибка при обработке ответа.",
+        "choose_action": "Выберите действие из меню.",
+        "balance": (
+            "💰 Баланс: {balance} баллов\n"
+            "✅ Правильных ответов: {correct}\n"
+            "📊 Всего вопросов: {total}\n"
+            "🎯 Точность: {accuracy:.1f}%"
+        ),
+        "user_not_found": "Пользователь не найден. Нажмите /start",
+        "balance_error": "Не удалось получить информацию о балансе.",
+        "cached_notice": "\n\n⚠️ База данных временно недоступна, показаны сохраненные данные.",
+        "stats_empty": "У вас пока нет статистики. Ответьте на несколько вопросов!",
+        "stats_header": "📊 Ваша статистика:\n\n",
+        "stats_row": (
+            "🏆 {level} уровень:\n"
+            "✅ {correct} из {total}\n"
+            "🎯 Точность: {accuracy:.1f}%\n\n"
+        ),
+        "stats_error": "Не удалось получить статистику.",
+        "help": (
+            "ℹ️ Помощь по боту:\n\n"
+            "Команды:\n"
+            "• Баланс - показать ваш текущий баланс\n"
+            "• Статистика - показать вашу статистику\n"
+            "• /check_multis - (для админов) проверить подозрительные аккаунты\n"
+            "• /timezone - часовой пояс, по которому приходят airdrop\n"
+            "• /slow_queries - (для админов) медленные SQL-запросы\n"
+            "Для начала работы нажмите /start"
+        ),
+        "airdrop_notice": (
+            "🎉 Вам пришел airdrop ({level} уровень)! "
+            "Используйте команду /claim чтобы получить вопрос и заработать баллы.\n"
+            "Сегодня вы получите {number}/{limit} airdrop."
+        ),
+        "airdrop_notice_captcha": (
+            "🎉 Вам пришел airdrop ({level} уровень)! "
+            "Но сначала подтвердите, что вы не бот - вам нужно будет ввести капчу.\n"
+            "Используйте команду /claim чтобы начать.\n"
+            "Сегодня вы получите {number}/{limit} airdrop."
+        ),
+        "airdrop_reminder": (
+            "⏳ Ваш airdrop ({level} уровень) сгорит через {minutes} мин. "
+            "Используйте команду /claim, чтобы получить вопрос."
+        ),
+        "airdrop_broadcast": (
+            "🎉 Новый airdrop! Нажмите кнопку ниже, чтобы получить вопрос и заработать баллы.\n"
+            "Airdrop доступен {minutes} мин."
+        ),
+        "timezone_current": (
+            "🕒 Ваш часовой пояс: {timezone}. Airdrop приходят по местному времени.\n"
+            "Изменить: /timezone Europe/Moscow"
+        ),
+        "timezone_set": "🕒 Часовой пояс изменен на {timezone}.",
+        "timezone_invalid": "Неизвестный часовой пояс {timezone}. Укажите его в формате Europe/Moscow.",
+    },
+    "en": {
+        "welcome": (
+            "Hi, {first_name}! You are registered. "
+            "You will now receive daily airdrops with questions of varying difficulty. "
+            "Use /claim to get your question when a notification arrives."
+        ),
+        "welcome_back": "Welcome back, {first_name}!",
+        "suspicious": (
+            "⚠️ Your account has been flagged as suspicious. "
+            "Some features may be restricted."
+        ),
+        "generic_error": "Something went wrong. Please try again later.",
+        "no_airdrop": "You have no airdrops available. Wait for the next notification.",
+        "claim_error": "Something went wrong while processing your request.",
+        "captcha_prompt": "Please enter the text from the image to confirm:",
+        "captcha_expired": "The captcha session has expired. Please try again.",
+        "captcha_ok": "✅ Captcha passed!",
+        "captcha_failed": "❌ Wrong code. This airdrop is closed. Wait for the next notification.",
+        "question_error": "Could not load the question. Wait for the next airdrop.",
+        "question": (
+            "🎁 Airdrop question ({level} level):\n{question}\n\n"
+            "You have {seconds} seconds to answer!"
+        ),
+        "timeout": "⏳ Time is up. Try the next airdrop later.",
+        "correct": "✅ Correct! You earned {reward} points for this airdrop.",
+        "wrong": "❌ Wrong. Try the next airdrop later.",
+        "answer_error": "Something went wrong while processing your answer.",
+        "choose_action": "Choose an action from the menu.",
+        "balance": (
+            "💰 Balance: {balance} points\n"
+            "✅ Correct answers: {correct}\n"
+            "📊 Total questions: {total}\n"
+            "🎯 Accuracy: {accuracy:.1f}%"
+        ),
+        "user_not_found": "User not found. Press /start",
+        "balance_error": "Could not load your balance.",
+        "cached_notice": "\n\n⚠️ The database is temporarily unavailable; showing saved data.",
+        "stats_empty": "You have no stats yet. Answer a few questions!",
+        "stats_header": "📊 Your stats:\n\n",
+        "stats_row": (
+            "🏆 {level} level:\n"
+            "✅ {correct} of {total}\n"
+            "🎯 Accuracy: {accuracy:.1f}%\n\n"
+        ),
+        "stats_error": "Could not load your stats.",
+        "help": (
+            "ℹ️ Bot help:\n\n"
+            "Commands:\n"
+            "• Balance - show your current balance\n"
+            "• Stats - show your stats\n"
+            "• /check_multis - (admins) review suspicious accounts\n"
+            "• /timezone - time zone used for airdrop delivery\n"
+            "• /slow_queries - (admins) slow SQL queries\n"
+            "Press /start to begin"
+        ),
+        "airdrop_notice": (
+            "🎉 You got an airdrop ({level} level)! "
+            "Use /claim to get the question and earn points.\n"
+            "Today you will receive {number}/{limit} airdrops."
+        ),
+        "airdrop_notice_captcha": (
+            "🎉 You got an airdrop ({level} level)! "
+            "First confirm you are not a bot - you will need to enter a captcha.\n"
+            "Use /claim to start.\n"
+            "Today you will receive {number}/{limit} airdrops."
+        ),
+        "airdrop_reminder": (
+            "⏳ Your airdrop ({level} level) expires in {minutes} min. "
+            "Use /claim to get the question."
+        ),
+        "airdrop_broadcast": (
+            "🎉 New airdrop! Tap the button below to get the question and earn points.\n"
+            "The airdrop is available for {minutes} min."
+        ),
+        "timezone_current": (
+            "🕒 Your time zone: {timezone}. Airdrops arrive by your local time.\n"
+            "Change it: /timezone Europe/London"
+        ),
+        "timezone_set": "🕒 Time zone changed to {timezone}.",
+        "timezone_invalid": "Unknown time zone {timezone}. Use the format Europe/London.",
+    },
+}
+
+
+# Шаблон без подстановок возвращается как есть, с подстановками - через связанный str.format
+def _compile(template: str) -> Callable[..., str]:
+    if all(field is None for _, field, _, _ in Formatter().parse(template)):
+        return lambda **_: template
+    return template.format
+
+
+_COMPILED: Dict[str, Dict[str, Callable[..., str]]] = {
+    locale: {key: _compile(text) for key, text in messages.items()}
+    for locale, messages in MESSAGES.items()
+}
+
+
+# "en-US" -> "en"; неизвестные языки получают локаль по умолчанию
+@lru_cache(maxsize=256)
+def resolve_locale(language_code: Optional[str]) -> str:
+    if not language_code:
+        return DEFAULT_LOCALE
+    locale = language_code.split("-", 1)[0].lower()
+    return locale if locale in _COMPILED else DEFAULT_LOCALE
+
+
+def render(key: str, locale: str = DEFAULT_LOCALE, **kwargs) -> str:
+    return _COMPILED.get(locale, _COMPILED[DEFAULT_LOCALE])[key](**kwargs)
+
+
+def level_name(level: str, locale: str = DEFAULT_LOCALE) -> str:
+    return LEVEL_NAMES.get(locale, LEVEL_NAMES[DEFAULT_LOCALE]).get(level, level)
+
+
+# Все варианты подписи кнопки во всех локалях (для регистрации маршрутов)
+def button_labels(key: str) -> Tuple[str, ...]:
+    return tuple(sorted({buttons[key] for buttons in BUTTONS.values()}))
+
+
+# Клавиатура строится один раз на локаль; telebot отправляет строку JSON без повторной сериализации
+@lru_cache(maxsize=None)
+def main_keyboard(locale: str = DEFAULT_LOCALE) -> str:
+    buttons = BUTTONS.get(locale, BUTTONS[DEFAULT_LOCALE])
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.row(buttons["balance"], buttons["stats"], buttons["help"])
+    markup.row(buttons["claim"])
+    return markup.to_json()
+
+
+# Кнопка со ссылкой на бота для объявления в канале
+@lru_cache(maxsize=16)
+def link_keyboard(locale: str, url: str) -> str:
+    buttons = BUTTONS.get(locale, BUTTONS[DEFAULT_LOCALE])
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(buttons["claim_link"], url=url))
+    return markup.to_json()
+
+
+@lru_cache(maxsize=None)
+def force_reply() -> str:
+    return types.ForceReply(selective=False).to_json()
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, List
+
+logger = logging.getLogger(__name__)
+
+
+# Журнал записей, не дошедших до БД (она недоступна): append-only JSON-строки на локальном диске,
+# каждая запись с fsync до ответа пользователю. Записи отправляются позже пачками (take/ack);
+# отправка должна быть идемпотентной: после падения посреди отправки журнал читается целиком
+# и уже отправленные записи повторяются. Файл очищается, когда отправлено все.
+class WriteSpool:
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._records: List[List[Any]] = []
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    # Записи, оставшиеся от прошлого запуска; оборванная при падении строка пропускается
+    def load(self) -> int:
+        with self._lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                lines = []
+            self._records = []
+            for line in lines:
+                try:
+                    self._records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Журнал записей %s: пропущена поврежденная строка", self.path)
+            if len(self._records) != len(lines):
+                self._rewrite()
+            return len(self._records)
+
+    def append(self, record: List[Any]):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._records.append(record)
+
+    # Первые limit записей без удаления; после успешной отправки - ack(len(пачки))
+    def take(self, limit: int) -> List[List[Any]]:
+        with self._lock:
+            return self._records[:limit]
+
+    def ack(self, count: int):
+        with self._lock:
+            del self._records[:count]
+            if not self._records:
+                self._rewrite()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _rewrite(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for record in self._records:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)